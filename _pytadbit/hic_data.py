@@ -4,6 +4,7 @@ December 12, 2014.
 """
 
 import os
+import json
 from sys                            import stderr, modules
 from collections                    import OrderedDict
 from warnings                       import warn
@@ -14,22 +15,31 @@ from numpy.linalg                   import LinAlgError
 from numpy                          import corrcoef, nansum, array, isnan, mean
 from numpy                          import meshgrid, asarray, exp, linspace, std
 from numpy                          import nanpercentile as npperc, log as nplog
-from numpy                          import nanmax, ma, zeros_like
+from numpy                          import nanmax, ma, zeros_like, zeros
+from numpy                          import fill_diagonal, int64, arange
+from numpy                          import repeat, diff, fromiter, unique
+from numpy                          import concatenate, add, maximum
+from numpy                          import bincount, floor, ix_, tril
+from numpy                          import subtract
 from scipy.stats                    import ttest_ind, spearmanr
 from scipy.special                  import gammaincc
 from scipy.cluster.hierarchy        import linkage, fcluster, dendrogram
 from scipy.sparse.linalg            import eigsh
-from scipy.sparse                   import csr_matrix
+from scipy.sparse                   import csr_matrix, diags
 
 from pytadbit.utils.extraviews      import plot_compartments
 from pytadbit.utils.extraviews      import plot_compartments_summary
 from pytadbit.utils.hic_filtering   import filter_by_mean, filter_by_zero_count
-from pytadbit.utils.normalize_hic   import iterative, expected
+from pytadbit.utils.normalize_hic   import iterative, expected, knight_ruiz
 from pytadbit.parsers.genome_parser import parse_fasta
 from pytadbit.parsers.bed_parser    import parse_bed
-from pytadbit.utils.file_handling   import mkdir
+from pytadbit.utils.file_handling   import mkdir, open_output
 from pytadbit.utils.hmm             import gaussian_prob, best_path, train
 from pytadbit.utils.tadmaths        import calinski_harabasz
+from pytadbit.utils.hic_storage     import ContactStorage, ArrayDict
+from pytadbit.utils.hic_storage     import save_array_dict, open_array_dict
+from pytadbit.utils.hic_storage     import dict_to_arrays
+from pytadbit.utils.hic_container   import ContainerWriter, ContainerReader
 try:
     from pytadbit.parsers.cooler_parser import cooler_file
 except ImportError:
@@ -51,6 +61,7 @@ class HiC_data(dict):
         super(HiC_data, self).__init__(items)
         self.__size = size
         self._size2 = size**2
+        self._csr_cache = None
         self._symmetricize()
         self.bias = None
         self.bads = masked or {}
@@ -96,17 +107,22 @@ class HiC_data(dict):
             count += 1
         if symmetric:  # may not reach 10 values
             return
+        keys = fromiter(self.iterkeys(), dtype=int64, count=dict.__len__(self))
+        vals = array(self.values())
+        rows, cols = divmod(keys, self.__size)
+        diag = rows == cols
+        # each cell and its symmetric, diagonal only once
+        all_keys, inverse = unique(concatenate((keys, (cols * self.__size +
+                                                       rows)[~diag])),
+                                   return_inverse=True)
         if to_sum:
-            for n in self.keys()[:]:
-                i = n / self.__size
-                j = n % self.__size
-                if i != j:
-                    self[j, i] = self[i, j] = self[j, i] + self[i, j]
+            new_vals = zeros(len(all_keys), dtype=vals.dtype)
+            add.at(new_vals, inverse, concatenate((vals, vals[~diag])))
         else:
-            for n in self.keys()[:]:
-                i = n / self.__size
-                j = n % self.__size
-                self[j, i] = self[i, j] = self[n]
+            new_vals = zeros(len(all_keys), dtype=vals.dtype) + vals.min()
+            maximum.at(new_vals, inverse, concatenate((vals, vals[~diag])))
+        super(HiC_data, self).update(zip(all_keys.tolist(), new_vals.tolist()))
+        self._csr_cache = None
 
     def _update_size(self, size):
         self.__size +=  size
@@ -153,23 +169,56 @@ class HiC_data(dict):
                     'ERROR: position %d larger than %s^2' % (row_col,
                                                              self.__size))
             super(HiC_data, self).__setitem__(row_col, val)
+        self._csr_cache = None
+
+    def __delitem__(self, pos):
+        super(HiC_data, self).__delitem__(pos)
+        self._csr_cache = None
+
+    def update(self, *args, **kwargs):
+        super(HiC_data, self).update(*args, **kwargs)
+        self._csr_cache = None
+
+    def setdefault(self, pos, default=None):
+        self._csr_cache = None
+        return super(HiC_data, self).setdefault(pos, default)
+
+    def pop(self, *args):
+        self._csr_cache = None
+        return super(HiC_data, self).pop(*args)
+
+    def popitem(self):
+        self._csr_cache = None
+        return super(HiC_data, self).popitem()
+
+    def clear(self):
+        super(HiC_data, self).clear()
+        self._csr_cache = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_csr_cache'] = None
+        return state
 
     def get_hic_data_as_csr(self):
         """
         Returns a scipy sparse matrix in Compressed Sparse Row format of the Hi-C data in the dictionary
 
+        The matrix is cached, and the same object is returned until the Hi-C
+        data is modified: it should not be modified in place.
+
         :returns: scipy sparse matrix in Compressed Sparse Row format
         """
-        values = []
-        cols = []
-        rows = []
-        for key, value in self.iteritems():
-            row, col = round(key / self.__size), key % self.__size
-            values.append(float(value))
-            cols.append(col)
-            rows.append(row)
+        if self._csr_cache is None:
+            self._csr_cache = self._build_csr()
+        return self._csr_cache
 
-        return csr_matrix((values, (rows, cols)), shape=(self.__size,self.__size))
+    def _build_csr(self):
+        keys = fromiter(self.iterkeys(), dtype=int64, count=dict.__len__(self))
+        vals = fromiter(self.itervalues(), dtype=float,
+                        count=dict.__len__(self))
+        rows, cols = divmod(keys, self.__size)
+        return csr_matrix((vals, (rows, cols)), shape=(self.__size, self.__size))
 
     def add_sections_from_fasta(self, fasta):
         """
@@ -369,24 +418,46 @@ class HiC_data(dict):
         self.expected = expected(self, bads=self.bads, **kwargs)
 
     def normalize_hic(self, iterations=0, max_dev=0.1, silent=False,
-                      sqrt=False, factor=1):
+                      sqrt=False, factor=1, ncpus=1, dtype='float64',
+                      normalization='ICE', cis_only=False, tol=1e-6):
         """
         Normalize the Hi-C data.
 
         It fills the Experiment.norm variable with the Hi-C values divided by
         the calculated weight.
 
-        :param 0 iteration: number of iterations
+        :param 'ICE' normalization: 'ICE' for iterative correction, or 'KR'
+           for Knight-Ruiz matrix balancing
+        :param 0 iteration: number of iterations (only for ICE)
         :param 0.1 max_dev: iterative process stops when the maximum deviation
            between the sum of row is equal to this number (0.1 means 10%)
+           (only for ICE)
+        :param False cis_only: balance each chromosome independently, using
+           only intra-chromosomal interactions (only for KR)
+        :param 1e-6 tol: maximum residual of the balancing (only for KR)
         :param False silent: does not warn when overwriting weights
         :param False sqrt: uses the square root of the computed biases
         :param 1 factor: final mean number of normalized interactions wanted
            per cell (excludes filtered, or bad, out columns)
+        :param 1 ncpus: number of threads used by the iterative correction
+        :param 'float64' dtype: precision of the iterative correction, use
+           'float32' to reduce memory usage
+
+        :returns: for KR, a dictionary with, per chromosome (or for 'genome'),
+           the number of Newton steps, of matrix-vector products and the final
+           residual of the balancing
         """
-        bias = iterative(self, iterations=iterations,
-                         max_dev=max_dev, bads=self.bads,
-                         verbose=not silent)
+        stats = None
+        if normalization == 'ICE':
+            bias = iterative(self, iterations=iterations,
+                             max_dev=max_dev, bads=self.bads,
+                             verbose=not silent, ncpus=ncpus, dtype=dtype)
+        elif normalization == 'KR':
+            bias, stats = knight_ruiz(self, bads=self.bads, tol=tol,
+                                      cis_only=cis_only, verbose=not silent)
+        else:
+            raise NotImplementedError('ERROR: normalization %s not implemented'
+                                      % normalization)
         if sqrt:
             bias = dict((b, bias[b]**0.5) for b in bias)
         if factor:
@@ -402,6 +473,7 @@ class HiC_data(dict):
             target = (norm_sum / float(len(self) * len(self) * factor))**0.5
             bias = dict([(b, bias[b] * target) for b in bias])
         self.bias = bias
+        return stats
 
     def save_biases(self, fnam, protocol=None):
         """
@@ -434,16 +506,293 @@ class HiC_data(dict):
         self.expected = biases['decay']
         self.bads     = biases['badcol']
 
+    def save(self, fnam, compression=6):
+        """
+        Save interactions, chromosomes, sections, biases, bad columns,
+        expected values and compartments in a single binary file (compressed
+        arrays plus a JSON header), to be loaded with :func:`HiC_data.load`.
+
+        Arrays are cut in chunks starting at each chromosome, so that a
+        single chromosome can be loaded without reading the whole file.
+
+        :param fnam: path to output file
+        :param 6 compression: compression level, from 0 (no compression) to 9
+        """
+        storage = self._contact_storage()
+        breaks  = sorted(set(p for pos in self.section_pos.itervalues()
+                             for p in pos))
+        out = ContainerWriter(fnam, level=compression)
+        out.add_array('indptr', storage.indptr, breaks=breaks)
+        breaks = storage.indptr[breaks].tolist()
+        out.add_array('indices', storage.indices, breaks=breaks)
+        out.add_array('data', storage.data, breaks=breaks)
+        metadata = {'size'         : len(self),
+                    'resolution'   : self.resolution,
+                    'symmetricized': self.symmetricized,
+                    'chromosomes'  : (self.chromosomes.items()
+                                      if self.chromosomes else None),
+                    'section_pos'  : [(crm, beg, end) for crm, (beg, end)
+                                      in self.section_pos.iteritems()],
+                    'sections'     : _section_runs(self.sections),
+                    'bias'         : None,
+                    'bads'         : None,
+                    'expected'     : None,
+                    'compartments' : self.compartments}
+        def _add_dict(name, dico, dtype=float):
+            keys, values = dict_to_arrays(dico, dtype)
+            out.add_array(name, values)
+            if keys is not None:
+                out.add_array(name + '_keys', keys)
+            return keys is not None
+        if self.bias:
+            metadata['bias'] = _add_dict('bias', self.bias)
+        if self.bads:
+            metadata['bads'] = _add_dict('bads', self.bads, dtype=bool)
+        if self.expected:
+            metadata['expected'] = [
+                (name, crm, _add_dict(name, dico))
+                for name, crm, dico in _expected_parts(self.expected)]
+        out.close(metadata)
+
+    @classmethod
+    def load(cls, fnam, chromosomes=None):
+        """
+        Load Hi-C data saved with :func:`HiC_data.save`.
+
+        :param fnam: path to input file
+        :param None chromosomes: name, or list of names, of chromosomes to
+           load (with the interactions between them). Only the corresponding
+           parts of the file are read. By default the whole matrix is loaded.
+
+        :returns: HiC_data object (or HiC_array if called as HiC_array.load)
+        """
+        reader   = ContainerReader(fnam)
+        metadata = reader.metadata
+        size     = metadata['size']
+        section_pos = dict((None if crm is None else str(crm), (beg, end))
+                           for crm, beg, end in metadata['section_pos'])
+        genome = None
+        if metadata['chromosomes']:
+            genome = OrderedDict((str(crm), crm_len)
+                                 for crm, crm_len in metadata['chromosomes'])
+        if chromosomes:
+            if isinstance(chromosomes, basestring):
+                chromosomes = [chromosomes]
+            missing = [crm for crm in chromosomes if not crm in section_pos]
+            if missing or not genome:
+                raise Exception('ERROR: chromosome(s) %s not found in %s' % (
+                    ', '.join(missing or chromosomes), fnam))
+            genome = OrderedDict((crm, genome[crm]) for crm in genome
+                                 if crm in chromosomes)
+            ranges = sorted(section_pos[crm] for crm in genome)
+            # new index of each bin (-1 for bins not loaded)
+            new_pos = zeros(size, dtype=int64) - 1
+            total = 0
+            for beg, end in ranges:
+                new_pos[beg:end] = arange(total, total + end - beg)
+                total += end - beg
+            def _blocks():
+                for beg, end in ranges:
+                    indptr  = reader.read('indptr', beg, end + 1)
+                    indices = reader.read('indices', indptr[0], indptr[-1])
+                    data    = reader.read('data', indptr[0], indptr[-1])
+                    rows    = repeat(arange(beg, end), diff(indptr))
+                    keep    = new_pos[indices] >= 0
+                    yield (new_pos[rows[keep]], new_pos[indices[keep]],
+                           data[keep])
+            storage = ContactStorage.from_row_blocks(
+                _blocks(), total, dtype=reader.arrays['data']['dtype'])
+        else:
+            new_pos = None
+            storage = ContactStorage(reader.read('indptr'),
+                                     reader.read('indices'),
+                                     reader.read('data'), size)
+
+        def _get_dict(name, keyed, reindex=True):
+            values = reader.read(name)
+            if keyed:
+                keys = reader.read(name + '_keys')
+            else:
+                keys = arange(len(values))
+            if reindex and new_pos is not None:
+                keep   = (keys >= 0) & (keys < size)
+                keys   = new_pos[keys[keep]]
+                values = values[keep][keys >= 0]
+                keys   = keys[keys >= 0]
+            return dict(zip(keys.tolist(), values.tolist()))
+
+        hic_data = cls._from_storage(
+            storage, chromosomes=genome,
+            dict_sec=_sections_from_runs(metadata['sections'], new_pos),
+            resolution=metadata['resolution'],
+            symmetricized=metadata['symmetricized'])
+        if new_pos is None:
+            hic_data.section_pos = section_pos
+        if metadata['bias'] is not None:
+            hic_data.bias = _get_dict('bias', metadata['bias'])
+        if metadata['bads'] is not None:
+            hic_data.bads = _get_dict('bads', metadata['bads'])
+        if metadata['expected'] is not None:
+            expected = {}
+            for name, crm, keyed in metadata['expected']:
+                if crm is None:
+                    expected = _get_dict(name, keyed, reindex=False)
+                elif new_pos is None or str(crm) in genome:
+                    expected[str(crm)] = _get_dict(name, keyed,
+                                                   reindex=False)
+            hic_data.expected = expected
+        hic_data.compartments = dict(
+            (str(crm), cmprts)
+            for crm, cmprts in (metadata['compartments'] or {}).iteritems()
+            if new_pos is None or str(crm) in genome)
+        reader.close()
+        return hic_data
+
+    def coarsen(self, factor, rebalance=False, **kwargs):
+        """
+        Builds a lower resolution version of the Hi-C data by summing blocks
+        of factor x factor bins. Bins are grouped inside each chromosome, the
+        last bin of a chromosome containing the remaining bins.
+
+        A new bin is considered bad if all the bins it contains are bad.
+        Expected values and compartments are not kept.
+
+        :param factor: number of bins to group (the new resolution will be
+           factor times the current one)
+        :param False rebalance: compute biases of the new matrix (with
+           :func:`HiC_data.normalize_hic`, to which extra keyword arguments
+           are passed)
+
+        :returns: a new HiC_data object (or HiC_array if called from an
+           HiC_array)
+        """
+        if factor < 1 or int(factor) != factor:
+            raise Exception('ERROR: factor should be a positive integer')
+        factor = int(factor)
+        size = len(self)
+        section_pos = self.section_pos or {None: (0, size)}
+        # new index of each bin (-1 for bins outside chromosomes)
+        new_pos = zeros(size, dtype=int64) - 1
+        new_section_pos = {}
+        chromosomes = OrderedDict()
+        sections = {}
+        total = 0
+        for crm, (beg, end) in sorted(section_pos.iteritems(),
+                                      key=lambda x: x[1]):
+            nbins = (end - beg + factor - 1) / factor
+            new_pos[beg:end] = total + arange(end - beg) / factor
+            new_section_pos[crm] = (total, total + nbins)
+            chromosomes[crm] = nbins
+            sections.update(((crm, i), total + i) for i in xrange(nbins))
+            total += nbins
+
+        contacts = self._contact_storage()
+        keys = []
+        vals = []
+        for rows, cols, values in contacts.iter_row_blocks():
+            rows = new_pos[rows]
+            cols = new_pos[cols]
+            keep = (rows >= 0) & (cols >= 0)
+            block, inverse = unique(rows[keep] * total + cols[keep],
+                                    return_inverse=True)
+            keys.append(block)
+            vals.append(bincount(inverse, weights=values[keep]))
+        keys = concatenate(keys) if keys else zeros(0, dtype=int64)
+        vals = concatenate(vals) if vals else zeros(0)
+        if contacts.dtype.kind != 'f':
+            vals = vals.round().astype(int64)
+        storage = ContactStorage.from_coo(keys / total, keys % total, vals,
+                                          total, sum_duplicates=True)
+
+        hic_data = self._from_storage(
+            storage, chromosomes=chromosomes if self.chromosomes else None,
+            dict_sec=sections if self.sections is not None else None,
+            resolution=self.resolution * factor,
+            symmetricized=self.symmetricized)
+        hic_data.section_pos = new_section_pos
+        if self.bads:
+            bads = array([b for b in self.bads if 0 <= b < size], dtype=int64)
+            bads = new_pos[bads]
+            nbads = bincount(bads[bads >= 0], minlength=total)
+            nbins = bincount(new_pos[new_pos >= 0], minlength=total)
+            hic_data.bads = dict((b, True)
+                                 for b in (nbads == nbins).nonzero()[0].tolist())
+        if rebalance:
+            kwargs.setdefault('silent', True)
+            hic_data.normalize_hic(**kwargs)
+        return hic_data
+
+    def pyramid(self, resolutions, rebalance=False, **kwargs):
+        """
+        Builds lower resolution versions of the Hi-C data (see
+        :func:`HiC_data.coarsen`), each one being derived from the closest
+        finer one already computed.
+
+        :param resolutions: list of resolutions, each one being a multiple of
+           the current resolution
+        :param False rebalance: compute biases of each new matrix (extra
+           keyword arguments are passed to :func:`HiC_data.normalize_hic`)
+
+        :returns: a dictionary of HiC_data objects, with resolutions as keys,
+           sorted from the finest to the coarsest resolution
+        """
+        levels = OrderedDict()
+        for reso in sorted(set(resolutions)):
+            if reso % self.resolution:
+                raise Exception('ERROR: resolution %d is not a multiple of %d'
+                                % (reso, self.resolution))
+            if reso == self.resolution:
+                levels[reso] = self
+                continue
+            finer = [r for r in levels if not reso % r]
+            source = levels[finer[-1]] if finer else self
+            levels[reso] = source.coarsen(reso / source.resolution,
+                                          rebalance=rebalance, **kwargs)
+        return levels
+
+    @classmethod
+    def _from_storage(cls, storage, **kwargs):
+        return cls(storage.iteritems(), storage.size, **kwargs)
+
+    def _contact_storage(self):
+        return ContactStorage.from_items(self, len(self))
+
     def get_as_tuple(self):
-        return tuple([self[i, j]
-                      for j in xrange(len(self))
-                      for i in xrange(len(self))])
+        matrix = self.get_region().toarray().ravel()
+        if not (matrix % 1).any(): # interaction counts
+            matrix = matrix.astype(int)
+        return tuple(matrix.tolist())
+
+    def get_region(self, focus=None):
+        """
+        Returns a view of a region of the matrix, without copying it (see
+        :class:`HiC_region`).
+
+        :param None focus: a tuple with the (start, end) position of the desired
+           window of data (start, starting at 1, and both start and end are
+           inclusive). Alternatively a chromosome name can be input or a tuple
+           of chromosome name, in order to retrieve a specific inter-chromosomal
+           region
+
+        :returns: HiC_region object
+        """
+        return HiC_region(self, focus)
+
+    def _csr_view(self):
+        return self.get_hic_data_as_csr()
 
     def write_coord_table(self, fname, focus=None, diagonal=True,
-                          normalized=False, format='BED'):
+                          normalized=False, format='BED', ncpus=1):
         """
         writes a coordinate table to a file.
 
+        Only non-zero cells are written, and only those of the upper triangle
+        when the region is symmetric (same start and end for rows and
+        columns). The matrix is processed by blocks of rows, so memory usage does not
+        depend on its size.
+
+        :param fname: path to output file. If it ends with '.gz' the output
+           is compressed with gzip.
         :param None focus: a tuple with the (start, end) position of the desired
            window of data (start, starting at 1, and both start and end are
            inclusive). Alternatively a chromosome name can be input or a tuple
@@ -457,78 +806,42 @@ class HiC_data(dict):
            or "long-range" format:
                chr1:111-222   \t   chr2:333-444   \t   55
                chr2:333-444   \t   chr1:111-222   \t   55
+        :param 1 ncpus: number of threads used to compress the output
         """
-        if focus:
-            if isinstance(focus, tuple) and isinstance(focus[0], int):
-                if len(focus) == 2:
-                    start1, end1 = focus
-                    start2, end2 = focus
-                    start1 -= 1
-                    start2 -= 1
-                else:
-                    start1, end1, start2, end2 = focus
-                    start1 -= 1
-                    start2 -= 1
-            elif isinstance(focus, tuple) and isinstance(focus[0], str):
-                start1, end1 = self.section_pos[focus[0]]
-                start2, end2 = self.section_pos[focus[1]]
-            else:
-                start1, end1 = self.section_pos[focus]
-                start2, end2 = self.section_pos[focus]
-        else:
-            start1 = start2 = 0
-            end1   = end2   = len(self)
-        out = open(fname, 'w')
+        start1, start2, end1, end2 = self._focus_coords(focus)
         if format == 'long-range':
-            rownam = ['%s:%d-%d' % (k[0],
-                                     k[1] * self.resolution,
-                                     (k[1] + 1) * self.resolution)
-                      for k in sorted(self.sections,
-                                      key=lambda x: self.sections[x])
-                      if start2 <= self.sections[k] < end2]
-            if not rownam:
-                raise Exception('ERROR: HiC data object should have genomic coordinates')
-            iter_rows = self.yield_matrix(focus=focus, diagonal=diagonal,
-                                          normalized=normalized)
+            rownam = self._bin_names(start2, end2, '%s:%d-%d')
+            colnam = self._bin_names(start1, end1, '%s:%d-%d')
             pair_string = '%s\t%s\t%f\n' if normalized else '%s\t%s\t%d\n'
-            for nrow, row in enumerate(rownam, 1):
-                line = iter_rows.next()
-                iter_cols = iter(line)
-                for col in rownam[nrow:]:
-                    val = iter_cols.next()
-                    if not val:
-                        continue
-                    out.write(pair_string % (row, col, val))
         elif format == 'BED':
-            rownam = ['%s\t%d\t%d' % (k[0],
-                                     k[1] * self.resolution,
-                                     (k[1] + 1) * self.resolution)
-                      for k in sorted(self.sections,
-                                      key=lambda x: self.sections[x])
-                      if start2 <= self.sections[k] < end2]
-            colnam = ['%s:%d-%d' % (k[0],
-                                     k[1] * self.resolution,
-                                     (k[1] + 1) * self.resolution)
-                      for k in sorted(self.sections,
-                                      key=lambda x: self.sections[x])
-                      if start2 <= self.sections[k] < end2]
-            if not rownam:
-                raise Exception('ERROR: Hi-C data object should have genomic coordinates')
-            iter_rows = self.yield_matrix(focus=focus, diagonal=diagonal,
-                                          normalized=normalized)
-            pair_string = '%s\t%s,%f\t%d\t.\n' if normalized else '%s\t%s,%d\t%d\t.\n'
-            count = 1
-            for nrow, row in enumerate(rownam, 1):
-                line = iter_rows.next()
-                iter_cols = iter(line)
-                for col in colnam[nrow:]:
-                    val = iter_cols.next()
-                    if not val:
-                        continue
-                    out.write(pair_string % (row, col, val, count))
-                    count += 1
+            rownam = self._bin_names(start2, end2, '%s\t%d\t%d')
+            colnam = self._bin_names(start1, end1, '%s:%d-%d')
+            pair_string = ('%s\t%s,%f\t%d\t.\n' if normalized else
+                           '%s\t%s,%d\t%d\t.\n')
         else:
             raise Exception('ERROR: format "%s" not found\n' % format)
+        if not rownam:
+            raise Exception('ERROR: Hi-C data object should have genomic coordinates')
+        out = open_output(fname, cpus=ncpus)
+        count = 1
+        for beg, block in self._iter_dense_blocks(start1, start2, end1, end2,
+                                                  diagonal, normalized):
+            rows, cols = block.nonzero()
+            values = block[rows, cols]
+            rows += beg - start2
+            if start1 == start2:  # upper triangle only
+                upper = rows <= cols
+                rows, cols, values = rows[upper], cols[upper], values[upper]
+            rows, cols, values = rows.tolist(), cols.tolist(), values.tolist()
+            if format == 'BED':
+                out.write(''.join(
+                    pair_string % (rownam[i], colnam[j], v, n)
+                    for n, (i, j, v) in enumerate(zip(rows, cols, values),
+                                                  count)))
+            else:
+                out.write(''.join(pair_string % (rownam[i], colnam[j], v)
+                                  for i, j, v in zip(rows, cols, values)))
+            count += len(values)
         out.close()
 
     def write_cooler(self, fname, normalized=False):
@@ -564,10 +877,16 @@ class HiC_data(dict):
             weights = [self.bias[i] if not i in self.bads else 0. for i in xrange(self.__size)]
             out.write_weights(weights, weights)
 
-    def write_matrix(self, fname, focus=None, diagonal=True, normalized=False):
+    def write_matrix(self, fname, focus=None, diagonal=True, normalized=False,
+                     ncpus=1):
         """
         writes the matrix to a file.
 
+        The matrix is formatted and written by blocks of rows, so memory usage
+        does not depend on its size.
+
+        :param fname: path to output file. If it ends with '.gz' the output
+           is compressed with gzip.
         :param None focus: a tuple with the (start, end) position of the desired
            window of data (start, starting at 1, and both start and end are
            inclusive). Alternatively a chromosome name can be input or a tuple
@@ -575,46 +894,29 @@ class HiC_data(dict):
            region
         :param True diagonal: if False, diagonal is replaced by zeroes
         :param False normalized: get normalized data
+        :param 1 ncpus: number of threads used to compress the output
         """
-        if focus:
-            if isinstance(focus, tuple) and isinstance(focus[0], int):
-                if len(focus) == 2:
-                    start1, end1 = focus
-                    start2, end2 = focus
-                    start1 -= 1
-                    start2 -= 1
-                else:
-                    start1, end1, start2, end2 = focus
-                    start1 -= 1
-                    start2 -= 1
-            elif isinstance(focus, tuple) and isinstance(focus[0], str):
-                start1, end1 = self.section_pos[focus[0]]
-                start2, end2 = self.section_pos[focus[1]]
-            else:
-                start1, end1 = self.section_pos[focus]
-                start2, end2 = self.section_pos[focus]
-        else:
-            start1 = start2 = 0
-            end1   = end2   = len(self)
-        out = open(fname, 'w')
+        start1, start2, end1, end2 = self._focus_coords(focus)
+        out = open_output(fname, cpus=ncpus)
         out.write('# MASKED %s\n' % (' '.join([str(k - start1)
                                                for k in self.bads.keys()
                                                if start1 <= k <= end1])))
-        rownam = ['%s\t%d-%d' % (k[0],
-                                 k[1] * self.resolution + 1,
-                                 (k[1] + 1) * self.resolution)
-                  for k in sorted(self.sections,
-                                  key=lambda x: self.sections[x])
-                  if start2 <= self.sections[k] < end2]
-        if rownam:
-            for line in self.yield_matrix(focus=focus, diagonal=diagonal,
-                                          normalized=normalized):
-                out.write(rownam.pop(0) + '\t' +
-                          '\t'.join([str(i) for i in line]) + '\n')
-        else:
-            for line in self.yield_matrix(focus=focus, diagonal=diagonal,
-                                          normalized=normalized):
-                out.write('\t'.join([str(i) for i in line]) + '\n')
+        rownam = self._bin_names(start2, end2, '%s\t%d-%d', first=1)
+        for beg, block in self._iter_dense_blocks(start1, start2, end1, end2,
+                                                  diagonal, normalized):
+            if normalized or (block.dtype.kind == 'f' and
+                              (floor(block) != block).any()):
+                line = '\t'.join(['%.12g'] * (end1 - start1)) + '\n'
+            else:
+                line = '\t'.join(['%d'] * (end1 - start1)) + '\n'
+            if rownam:
+                out.write(''.join(
+                    '%s\t%s' % (name, line % tuple(values))
+                    for name, values in zip(rownam[beg - start2:],
+                                            block.tolist())))
+            else:
+                out.write(''.join(line % tuple(values)
+                                  for values in block.tolist()))
         out.close()
 
     def get_matrix(self, focus=None, diagonal=True, normalized=False,
@@ -662,17 +964,82 @@ class HiC_data(dict):
                         matrix[i][i] = 1 if matrix[i][i] else 0
 
         if masked:
-            bads1 = [b - start1 for b in self.bads if start1 <= b < end1]
-            bads2 = [b - start2 for b in self.bads if start2 <= b < end2]
-            m = zeros_like(matrix)
-            for bad1 in bads1:
-                m[:,bad1] = 1
-                for bad2 in bads2:
-                    m[bad2,:] = 1
-            matrix = ma.masked_array(matrix, m)
+            matrix = self._mask_matrix(matrix, start1, start2, end1, end2)
 
         return matrix
 
+    def _mask_matrix(self, matrix, start1, start2, end1, end2):
+        bads1 = [b - start1 for b in self.bads if start1 <= b < end1]
+        bads2 = [b - start2 for b in self.bads if start2 <= b < end2]
+        m = zeros_like(matrix)
+        for bad1 in bads1:
+            m[:,bad1] = 1
+            for bad2 in bads2:
+                m[bad2,:] = 1
+        return ma.masked_array(matrix, m)
+
+    def _bias_array(self, bias, start=0, end=None):
+        end = len(self) if end is None else end
+        if isinstance(bias, ArrayDict):
+            return bias.slice(start, end)
+        return array([bias[i] for i in xrange(start, end)], dtype=float)
+
+    def _bads_mask(self, bads):
+        mask = zeros(len(self), dtype=bool)
+        if isinstance(bads, ArrayDict):
+            mask[bads.keys_array if bads.keys_array is not None else
+                 slice(0, len(bads))] = True
+        elif bads:
+            mask[[b for b in bads if 0 <= b < len(self)]] = True
+        return mask
+
+    def _dense_block(self, start1, end1, start2, end2):
+        """
+        :returns: dense 2D NumPy array with the values of rows start1 to end1
+           and columns start2 to end2 (end excluded)
+        """
+        return self.get_hic_data_as_csr()[start1:end1, start2:end2].toarray()
+
+    def _iter_dense_blocks(self, start1, start2, end1, end2, diagonal=True,
+                           normalized=False, max_cells=1000000):
+        """
+        Same as :func:`HiC_data.yield_matrix`, but yielding blocks of rows as
+        NumPy arrays, each of at most max_cells cells.
+
+        :yields: the index of the first row of the block, and the block
+        """
+        if normalized and not self.bias:
+            raise Exception('ERROR: experiment not normalized yet')
+        bads = self._bads_mask(self.bads)
+        if normalized:
+            bias1 = self._bias_array(self.bias, start1, end1)
+        step = max(1, max_cells / max(1, end1 - start1))
+        for beg in xrange(start2, end2, step):
+            end = min(beg + step, end2)
+            block = self._dense_block(beg, end, start1, end1)
+            if normalized:
+                block = (block / self._bias_array(self.bias, beg, end)[:, None]
+                         / bias1[None, :])
+            block[bads[beg:end]] = 0
+            if not diagonal and start1 == start2:
+                diag = arange(max(beg, start1), min(end, end1))
+                block[diag - beg, diag - start1] = 0
+            yield beg, block
+
+    def _bin_names(self, start, end, template, first=0):
+        """
+        :param template: string with the chromosome name, start and end of
+           the bin
+        :param 0 first: added to the start position of each bin
+
+        :returns: list of names of the bins from start to end (excluded), or
+           an empty list if sections are not defined
+        """
+        return [template % (k[0], k[1] * self.resolution + first,
+                            (k[1] + 1) * self.resolution)
+                for k in sorted(self.sections, key=lambda x: self.sections[x])
+                if start <= self.sections[k] < end]
+
     def _focus_coords(self, focus):
         siz = len(self)
         if focus:
@@ -721,6 +1088,32 @@ class HiC_data(dict):
             end1   = end2   = siz
         return start1, start2, end1, end2
 
+    def _obs_exp_matrix(self, sec):
+        """
+        Matrix of a chromosome normalized by biases and expected values,
+        without bad columns, and made symmetric by copying its lower
+        triangle.
+
+        :returns: a NumPy array, empty if there are no expected values for
+           this chromosome
+        """
+        beg, end = self.section_pos[sec]
+        good = array([i for i in xrange(beg, end) if not i in self.bads],
+                     dtype=int) - beg
+        if sec in self.expected:
+            expc = self.expected[sec]
+        else:
+            expc = self.expected
+        if not len(good) or not expc:
+            return []
+        expc = array([expc[d] for d in xrange(good[-1] - good[0] + 1)],
+                     dtype=float)
+        bias = self._bias_array(self.bias, beg, end)[good]
+        matrix = self.get_region(sec).toarray()[ix_(good, good)]
+        matrix = (matrix / expc[abs(subtract.outer(good, good))]
+                  / bias[:, None] / bias[None, :])
+        return tril(matrix) + tril(matrix, -1).T
+
     def find_compartments(self, crms=None, savefig=None, savedata=None,
                           savecorr=None, show=False, suffix='', ev_index=None,
                           rich_in_A=None, format='png', savedir=None,
@@ -831,32 +1224,12 @@ class HiC_data(dict):
             if kwargs.get('verbose', False):
                 print 'Processing chromosome', sec
             # get chromosomal matrix
-            try:
-                matrix = [[(float(self[i,j]) / self.expected[sec][abs(j-i)]
-                            / self.bias[i] / self.bias[j])
-                        for i in xrange(*self.section_pos[sec])
-                        if not i in self.bads]
-                        for j in xrange(*self.section_pos[sec])
-                        if not j in self.bads]
-            except KeyError:
-                if sec in self.expected and not self.expected[sec]:
-                    matrix = []
-                else:
-                    matrix = [[(float(self[i,j]) / self.expected[abs(j-i)]
-                                / self.bias[i] / self.bias[j])
-                            for i in xrange(*self.section_pos[sec])
-                            if not i in self.bads]
-                            for j in xrange(*self.section_pos[sec])
-                            if not j in self.bads]
-            if not matrix: # MT chromosome will fall there
+            matrix = self._obs_exp_matrix(sec)
+            if not len(matrix): # MT chromosome will fall there
                 warn('Chromosome %s is probably MT :)' % (sec))
                 cmprts[sec] = []
                 count += 1
                 continue
-            # enforce symmetry
-            for i in xrange(len(matrix)):
-                for j in xrange(i+1, len(matrix)):
-                    matrix[i][j] = matrix[j][i]
             # compute correlation coefficient
             try:
                 matrix = [list(m) for m in corrcoef(matrix)]
@@ -1135,20 +1508,12 @@ class HiC_data(dict):
                 continue
             if kwargs.get('verbose', False):
                 print 'Processing chromosome', sec
-            matrix = [[(float(self[i,j]) / self.expected[abs(j-i)]
-                       / self.bias[i] / self.bias[j])
-                      for i in xrange(*self.section_pos[sec])
-                       if not i in self.bads]
-                     for j in xrange(*self.section_pos[sec])
-                      if not j in self.bads]
-            if not matrix: # MT chromosome will fall there
+            matrix = self._obs_exp_matrix(sec)
+            if not len(matrix): # MT chromosome will fall there
                 warn('Chromosome %s is probably MT :)' % (sec))
                 cmprts[sec] = []
                 count += 1
                 continue
-            for i in xrange(len(matrix)):
-                for j in xrange(i+1, len(matrix)):
-                    matrix[i][j] = matrix[j][i]
             try:
                 matrix = [list(m) for m in corrcoef(matrix)]
             except TypeError:
@@ -1561,6 +1926,580 @@ class HiC_data(dict):
                            [self[i, j] for j in xrange(i + 1, end1)])
 
 
+MMAP_VERSION = 1
+
+
+class HiC_array(HiC_data):
+    """
+    HiC_data object storing interactions in sorted NumPy arrays (see
+    :class:`pytadbit.utils.hic_storage.ContactStorage`) instead of a Python
+    dictionary. Item access (``hic_data[i, j]``, ``get``, ``iteritems``...) is
+    the same as in :class:`HiC_data`, but memory usage is about ten times
+    lower, and bulk accessors (rows, diagonals, blocks) are available for
+    vectorized computations.
+
+    Same parameters as :class:`HiC_data`, plus:
+
+    :param None dtype: type of the stored values. By default uint32 if all
+       values are positive integers, float32 otherwise.
+    :param True check_symmetry: check that the matrix is symmetric, and
+       symmetricize it if not. Can be skipped for data known to be symmetric
+       (e.g. loaded from a TADbit BAM file), to avoid reading all the
+       interactions.
+    """
+    def __init__(self, items, size, chromosomes=None, dict_sec=None,
+                 resolution=1, masked=None, symmetricized=False, dtype=None,
+                 check_symmetry=True):
+        if isinstance(items, ContactStorage):
+            self._storage = items
+        else:
+            self._storage = ContactStorage.from_items(items, size, dtype=dtype)
+        self._check_symmetry = check_symmetry
+        super(HiC_array, self).__init__((), size, chromosomes=chromosomes,
+                                        dict_sec=dict_sec,
+                                        resolution=resolution, masked=masked,
+                                        symmetricized=symmetricized)
+        self._check_symmetry = True
+
+    @classmethod
+    def from_hic_data(cls, hic_data, dtype=None):
+        """
+        Converts a dictionary based HiC_data object into an HiC_array, keeping
+        sections, biases, bad columns, expected values and compartments.
+
+        :param hic_data: HiC_data object
+        :param None dtype: type of the stored values
+        """
+        new = cls(hic_data, len(hic_data), dtype=dtype,
+                  resolution=hic_data.resolution,
+                  symmetricized=hic_data.symmetricized)
+        for attr in ['bias', 'bads', 'chromosomes', 'sections', 'section_pos',
+                     'expected', 'compartments']:
+            setattr(new, attr, getattr(hic_data, attr))
+        return new
+
+    def __reduce__(self):
+        return _rebuild_hic_array, (self.__class__, self.__getstate__())
+
+    def _symmetricize(self):
+        """
+        Same as :func:`HiC_data._symmetricize`, but checking all cells.
+        """
+        if not self._check_symmetry:
+            return
+        matrix = self._storage.tocsr()
+        trans  = matrix.T.tocsr()
+        differ = matrix != trans
+        if not differ.nnz:
+            return
+        if differ.multiply(matrix).multiply(trans).nnz:
+            diag = diags(matrix.diagonal(), 0, shape=matrix.shape, format='csr')
+            matrix = matrix + trans - diag
+        else:
+            matrix = matrix.maximum(trans)
+        matrix.eliminate_zeros()
+        self._storage = ContactStorage.from_csr(matrix)
+        self._csr_cache = None
+
+    def _pos_to_coords(self, row_col):
+        size = len(self)
+        try:
+            row, col = row_col
+            if not (0 <= row < size and 0 <= col < size):
+                raise IndexError(
+                    'ERROR: row or column larger than %s' % size)
+        except TypeError:
+            if not 0 <= row_col < self._size2:
+                raise IndexError(
+                    'ERROR: position %d larger than %s^2' % (row_col, size))
+            row, col = divmod(row_col, size)
+        return row, col
+
+    def __getitem__(self, row_col):
+        return self._storage.get(*self._pos_to_coords(row_col))
+
+    def __setitem__(self, row_col, val):
+        row, col = self._pos_to_coords(row_col)
+        self._storage.set(row, col, val)
+        self._csr_cache = None
+
+    def __delitem__(self, row_col):
+        self.pop(row_col)
+
+    def pop(self, row_col, *default):
+        try:
+            val = self._storage.remove(*self._pos_to_coords(row_col))
+        except IndexError:
+            val = None
+        if val is None:
+            if default:
+                return default[0]
+            raise KeyError(row_col)
+        self._csr_cache = None
+        return val
+
+    def popitem(self):
+        for pos, val in self._storage.iteritems():
+            break
+        else:
+            raise KeyError('popitem(): dictionary is empty')
+        del self[pos]
+        return pos, val
+
+    def setdefault(self, pos, default=None):
+        if not pos in self:
+            self[pos] = default
+        return self[pos]
+
+    def clear(self):
+        self._storage.clear()
+        self._csr_cache = None
+
+    def __contains__(self, pos):
+        try:
+            return self._storage.get(*self._pos_to_coords(pos),
+                                     default=None) is not None
+        except IndexError:
+            return False
+
+    def get(self, pos, default=None):
+        try:
+            return self._storage.get(*self._pos_to_coords(pos), default=default)
+        except IndexError:
+            return default
+
+    def iteritems(self):
+        return self._storage.iteritems()
+
+    def iterkeys(self):
+        return (k for k, _ in self._storage.iteritems())
+
+    def itervalues(self):
+        return (v for _, v in self._storage.iteritems())
+
+    __iter__ = iterkeys
+
+    def items(self):
+        return list(self.iteritems())
+
+    def keys(self):
+        return list(self.iterkeys())
+
+    def values(self):
+        return list(self.itervalues())
+
+    def update(self, other):
+        if hasattr(other, 'iteritems'):
+            other = other.iteritems()
+        for pos, val in other:
+            self[pos] = val
+
+    def copy(self):
+        return dict(self.iteritems())
+
+    def _build_csr(self):
+        return self._storage.tocsr().astype(float)
+
+    def _csr_view(self):
+        return self._storage.tocsr()
+
+    def get_row(self, row, start=0, end=None):
+        """
+        :param row: index of the row
+        :param 0 start: first column
+        :param None end: last column (excluded), by default the size of the
+           matrix
+
+        :returns: dense NumPy array with the values of a given row
+        """
+        return self._storage.get_row(row, start, end)
+
+    def get_band(self, k=0):
+        """
+        :param 0 k: distance to the main diagonal
+
+        :returns: dense NumPy array with the values of the cells (i, i + k)
+        """
+        return self._storage.get_band(k)
+
+    def get_block(self, start1, end1, start2, end2):
+        """
+        :param start1: first row
+        :param end1: last row (excluded)
+        :param start2: first column
+        :param end2: last column (excluded)
+
+        :returns: dense 2D NumPy array with the values of the block
+        """
+        return self._storage.get_block(start1, end1, start2, end2)
+
+    def _dense_block(self, start1, end1, start2, end2):
+        return self._storage.get_block(start1, end1, start2, end2)
+
+    def write_mmap(self, dirname):
+        """
+        Writes interactions, biases, bad columns and expected values into raw
+        binary files, together with a header (header.json) describing them.
+        The files can be memory-mapped, and shared between processes, with
+        :func:`pytadbit.parsers.hic_parser.load_hic_data_from_mmap`.
+
+        :param dirname: path to the output directory (created if needed)
+        """
+        mkdir(dirname)
+        header = {'version'      : MMAP_VERSION,
+                  'resolution'   : self.resolution,
+                  'symmetricized': self.symmetricized,
+                  'chromosomes'  : (self.chromosomes.items()
+                                    if self.chromosomes else None),
+                  'sections'     : _section_runs(self.sections),
+                  'contacts'     : self._storage.save_mmap(dirname),
+                  'bias'         : None,
+                  'bads'         : None,
+                  'expected'     : None}
+        if self.bias:
+            header['bias'] = save_array_dict(self.bias, dirname, 'bias')
+        if self.bads:
+            header['bads'] = save_array_dict(self.bads, dirname, 'bads',
+                                             dtype=bool)
+        if self.expected:
+            header['expected'] = [
+                (name, crm, save_array_dict(dico, dirname, name))
+                for name, crm, dico in _expected_parts(self.expected)]
+        out = open(os.path.join(dirname, 'header.json'), 'w')
+        json.dump(header, out, indent=1)
+        out.close()
+
+    @classmethod
+    def from_mmap(cls, dirname, mode='r'):
+        """
+        Opens Hi-C data written with :func:`HiC_array.write_mmap`.
+        Interactions, biases, bad columns and expected values are
+        memory-mapped: only the parts accessed are read from disk, and the
+        same files can be opened by several processes.
+
+        :param dirname: path to the directory containing the binary files
+        :param 'r' mode: 'r' to open files read-only, 'r+' to modify the
+           values on disk, 'c' for copy-on-write (modifications kept in memory)
+
+        :returns: HiC_array object
+        """
+        header = json.load(open(os.path.join(dirname, 'header.json')))
+        if header['version'] > MMAP_VERSION:
+            raise Exception('ERROR: files written by a newer version of TADbit')
+        contacts = ContactStorage.open_mmap(
+            dirname, header['contacts']['size'], header['contacts']['nnz'],
+            str(header['contacts']['dtype']), mode=mode)
+        chromosomes = None
+        if header['chromosomes']:
+            chromosomes = OrderedDict((str(crm), crm_len)
+                                      for crm, crm_len in header['chromosomes'])
+        hic_data = cls(contacts, contacts.size, chromosomes=chromosomes,
+                       dict_sec=_sections_from_runs(header['sections']),
+                       resolution=header['resolution'],
+                       symmetricized=header['symmetricized'],
+                       check_symmetry=False)
+        if header['bias']:
+            hic_data.bias = open_array_dict(dirname, 'bias', header['bias'],
+                                            mode)
+        if header['bads']:
+            hic_data.bads = open_array_dict(dirname, 'bads', header['bads'],
+                                            mode)
+        if header['expected']:
+            hic_data.expected = {}
+            for name, crm, desc in header['expected']:
+                expc = open_array_dict(dirname, name, desc, mode)
+                if crm is None:
+                    hic_data.expected = expc
+                else:
+                    hic_data.expected[str(crm)] = expc
+        return hic_data
+
+    @classmethod
+    def _from_storage(cls, storage, **kwargs):
+        return cls(storage, storage.size, check_symmetry=False, **kwargs)
+
+    def _contact_storage(self):
+        self._storage.consolidate()
+        return self._storage
+
+    def sum(self, bias=None, bads=None):
+        """
+        Sum Hi-C data matrix
+        WARNING: parameters are not meant to be used by external users
+
+        :params None bias: expects a dictionary of biases to use normalized matrix
+        :params None bads: extends computed bad columns
+
+        :returns: the sum of the Hi-C matrix skipping bad columns
+        """
+        bads = self._bads_mask(bads or self.bads)
+        if bias:
+            bias = self._bias_array(bias)
+        norm_sum = 0
+        for rows, cols, vals in self._storage.iter_row_blocks():
+            keep = ~(bads[rows] | bads[cols])
+            vals = vals[keep]
+            if bias is not None:
+                norm_sum += (vals / bias[rows[keep]] / bias[cols[keep]]).sum()
+            else:
+                norm_sum += vals.sum(
+                    dtype=float if vals.dtype.kind == 'f' else int64).item()
+        return norm_sum
+
+    def get_matrix(self, focus=None, diagonal=True, normalized=False,
+                   masked=False):
+        """
+        returns a matrix.
+
+        :param None focus: a tuple with the (start, end) position of the desired
+           window of data (start, starting at 1, and both start and end are
+           inclusive). Alternatively a chromosome name can be input or a tuple
+           of chromosome name, in order to retrieve a specific inter-chromosomal
+           region
+        :param True diagonal: if False, diagonal is replaced by ones, or zeroes
+           if normalized
+        :param False normalized: get normalized data
+        :param False masked: return masked arrays using the definition of bad
+           columns
+
+        :returns: matrix (a list of lists of values)
+        """
+        if normalized and not self.bias:
+            raise Exception('ERROR: experiment not normalized yet')
+        start1, start2, end1, end2 = self._focus_coords(focus)
+        matrix = self._storage.get_block(start2, end2, start1, end1).T
+        if normalized:
+            matrix = (matrix / self._bias_array(self.bias, start1, end1)[:, None]
+                      / self._bias_array(self.bias, start2, end2)[None, :])
+        if not diagonal and start1 == start2:
+            fill_diagonal(matrix, 0 if normalized else (matrix.diagonal() != 0))
+        matrix = matrix.tolist()
+        if masked:
+            matrix = self._mask_matrix(matrix, start1, start2, end1, end2)
+        return matrix
+
+    def yield_matrix(self, focus=None, diagonal=True, normalized=False):
+        """
+        Yields a matrix line by line.
+        Bad row/columns are returned as null row/columns.
+
+        :param None focus: a tuple with the (start, end) position of the desired
+           window of data (start, starting at 1, and both start and end are
+           inclusive). Alternatively a chromosome name can be input or a tuple
+           of chromosome name, in order to retrieve a specific inter-chromosomal
+           region
+        :param True diagonal: if False, diagonal is replaced by zeroes
+        :param False normalized: get normalized data
+
+        :yields: matrix line by line (a line being a list of values)
+        """
+        if normalized and not self.bias:
+            raise Exception('ERROR: experiment not normalized yet')
+        start1, start2, end1, end2 = self._focus_coords(focus)
+        if normalized:
+            bias1 = self._bias_array(self.bias, start1, end1)
+        for i in xrange(start2, end2):
+            if i in self.bads:
+                yield [0.0 if normalized else 0] * (end1 - start1)
+                continue
+            row = self._storage.get_row(i, start1, end1)
+            if normalized:
+                row = row / self.bias[i] / bias1
+            if not diagonal and start1 == start2 and start1 <= i < end1:
+                row[i - start1] = 0
+            yield row.tolist()
+
+
+class HiC_region(object):
+    """
+    View of a region of an Hi-C matrix: a chromosome, a pair of chromosomes,
+    or a pair of 'chr:start-end' regions (see :func:`HiC_data.get_region`).
+
+    The view only holds the coordinates of the region and a reference to the
+    Hi-C data. Cells are extracted from the parent storage when one of the
+    accessors is called, and only those inside the region. Rows correspond
+    to the first region and columns to the second one, as in
+    :func:`HiC_data.get_matrix`.
+
+    :param hic_data: HiC_data object
+    :param None focus: same as in :func:`HiC_data.get_matrix`
+    """
+    def __init__(self, hic_data, focus=None):
+        self.hic_data = hic_data
+        self.focus    = focus
+        (self.start1, self.start2,
+         self.end1, self.end2) = hic_data._focus_coords(focus)
+
+    def __repr__(self):
+        return 'HiC_region(%s, rows %d-%d, columns %d-%d)' % (
+            self.focus, self.start1, self.end1, self.start2, self.end2)
+
+    def __len__(self):
+        return self.end1 - self.start1
+
+    @property
+    def shape(self):
+        return (self.end1 - self.start1, self.end2 - self.start2)
+
+    @property
+    def bad_rows(self):
+        """
+        boolean array marking bad rows of the region
+        """
+        return self.hic_data._bads_mask(self.hic_data.bads)[self.start1:self.end1]
+
+    @property
+    def bad_columns(self):
+        """
+        boolean array marking bad columns of the region
+        """
+        return self.hic_data._bads_mask(self.hic_data.bads)[self.start2:self.end2]
+
+    def _biases(self):
+        if not self.hic_data.bias:
+            raise Exception('ERROR: experiment not normalized yet')
+        return (self.hic_data._bias_array(self.hic_data.bias,
+                                          self.start1, self.end1),
+                self.hic_data._bias_array(self.hic_data.bias,
+                                          self.start2, self.end2))
+
+    def toarray(self, normalized=False, diagonal=True):
+        """
+        :param False normalized: get normalized data
+        :param True diagonal: if False, diagonal is replaced by zeroes
+
+        :returns: dense NumPy array with the values of the region
+        """
+        matrix = self.hic_data._dense_block(self.start2, self.end2,
+                                            self.start1, self.end1).T
+        if normalized:
+            bias1, bias2 = self._biases()
+            matrix = matrix / bias1[:, None] / bias2[None, :]
+        if not diagonal and self.start1 == self.start2:
+            matrix = matrix.copy()
+            fill_diagonal(matrix, 0)
+        return matrix
+
+    def tocsr(self, normalized=False):
+        """
+        :param False normalized: get normalized data
+
+        :returns: scipy sparse matrix in Compressed Sparse Row format with the
+           values of the region
+        """
+        matrix = self.hic_data._csr_view()[self.start2:self.end2,
+                                           self.start1:self.end1].T.tocsr()
+        if normalized:
+            bias1, bias2 = self._biases()
+            matrix = diags(1. / bias1) * matrix * diags(1. / bias2)
+        return matrix
+
+    def diagonals(self, k=0, normalized=False):
+        """
+        :param 0 k: distance to the main diagonal of the region (k > 0 above
+           the diagonal)
+        :param False normalized: get normalized data
+
+        :returns: dense NumPy array with the values of the cells (i, i + k)
+        """
+        return self.tocsr(normalized=normalized).diagonal(k)
+
+    def to_hic_data(self):
+        """
+        Copies a square region into a new Hi-C data object (of the same class
+        as the parent) with its own sections, chromosomes, biases and bad
+        columns.
+        """
+        if (self.start1, self.end1) != (self.start2, self.end2):
+            raise Exception('ERROR: only square regions can be converted')
+        parent = self.hic_data
+        start, end = self.start1, self.end1
+        chromosomes = None
+        if parent.chromosomes:
+            chromosomes = OrderedDict()
+            for crm, (beg, fin) in sorted(parent.section_pos.iteritems(),
+                                          key=lambda x: x[1]):
+                if min(fin, end) > max(beg, start):
+                    chromosomes[crm] = min(fin, end) - max(beg, start)
+        sections = None
+        if parent.sections is not None:
+            sections = dict((k, v - start)
+                            for k, v in parent.sections.iteritems()
+                            if start <= v < end)
+        hic_data = parent._from_storage(
+            ContactStorage.from_csr(parent._csr_view()[start:end, start:end]),
+            chromosomes=chromosomes,
+            dict_sec=sections, resolution=parent.resolution,
+            symmetricized=parent.symmetricized)
+        if parent.bias:
+            hic_data.bias = dict(enumerate(
+                self.hic_data._bias_array(parent.bias, start, end).tolist()))
+        hic_data.bads = dict((b, True)
+                             for b in self.bad_rows.nonzero()[0].tolist())
+        if parent.expected:
+            if chromosomes and all(crm in parent.expected
+                                   for crm in chromosomes):
+                hic_data.expected = dict((crm, parent.expected[crm])
+                                         for crm in chromosomes)
+            else:
+                hic_data.expected = parent.expected
+        return hic_data
+
+
+def _section_runs(sections):
+    """
+    Compacts a dictionary of sections ({(chromosome, bin): index}) into runs
+    of consecutive bins: [chromosome, first bin, first index, number of bins]
+    """
+    if sections is None:
+        return None
+    runs = []
+    for (crm, pos), idx in sorted(sections.iteritems(), key=lambda x: x[1]):
+        if (runs and runs[-1][0] == crm and
+            runs[-1][1] + runs[-1][3] == pos and
+            runs[-1][2] + runs[-1][3] == idx):
+            runs[-1][3] += 1
+        else:
+            runs.append([crm, pos, idx, 1])
+    return runs
+
+
+def _sections_from_runs(runs, new_pos=None):
+    """
+    Inverse of :func:`_section_runs`, optionally re-indexing sections (bins
+    with a new index of -1 are dropped).
+    """
+    if runs is None:
+        return None
+    sections = {}
+    for crm, pos, idx, num in runs:
+        crm = None if crm is None else str(crm)
+        if new_pos is None:
+            sections.update(((crm, pos + i), idx + i) for i in xrange(num))
+        else:
+            sections.update(((crm, pos + i), n) for i, n in
+                            enumerate(new_pos[idx:idx + num].tolist())
+                            if n >= 0)
+    return sections
+
+
+def _expected_parts(expected):
+    """
+    Splits expected values into (name, chromosome, dictionary) parts, the
+    chromosome being None if expected values are common to all chromosomes.
+    """
+    if all(isinstance(v, (dict, ArrayDict)) for v in expected.itervalues()):
+        return [('expected.%d' % i, crm, expected[crm])
+                for i, crm in enumerate(expected)]
+    return [('expected', None, expected)]
+
+
+def _rebuild_hic_array(cls, state):
+    hic_data = dict.__new__(cls)
+    hic_data.__dict__.update(state)
+    return hic_data
+
+
 def _hmm_refine_compartments(xsec, models, bads, verbose):
     prevll = float('-inf')
     prevdf = 0
@@ -7,16 +7,20 @@ import re
 import copy
 import multiprocessing  as mu
 from warnings import warn
+from collections import OrderedDict
 from tempfile import gettempdir, mkstemp
 from subprocess import CalledProcessError, PIPE, STDOUT, Popen
 from pysam import Samfile
 
 from pytadbit.utils.file_handling import mkdir, which, is_fastq
 from pytadbit.utils.file_handling import magic_open, get_free_space_mb
-from pytadbit.parsers.sam_parser import parse_gem_3c, merge_sort
+from pytadbit.utils.file_handling import merge_sorted_files
+from pytadbit.parsers.sam_parser import parse_gem_3c, write_paired_reads
+from pytadbit.parsers.sam_parser import _paired_read_key
 from pytadbit.mapping.restriction_enzymes import religateds
 from pytadbit.mapping.restriction_enzymes import RESTRICTION_ENZYMES
-from pytadbit.mapping.restriction_enzymes import map_re_sites
+from pytadbit.mapping.restriction_enzymes import index_re_sites
+from pytadbit.parsers.genome_parser import genome_cache_prefix
 from pytadbit.mapping.restriction_enzymes import iupac2regex
 
 
@@ -756,6 +760,8 @@ def fast_fragment_mapping(mapper_index_path, fastq_path1, fastq_path2, r_enz,
     :param gem-mapper mapper_binary: path to the binary mapper
     :param None mapper_params: extra parameters for the mapper
     :param samtools samtools: path to samtools binary.
+    :param None genome_path: path to the FASTA file(s) of the genome. If given,
+       RE sites are cached next to it, and loaded from this cache in next runs
 
     :returns: outfile with the intersected read pairs
     """
@@ -829,9 +835,12 @@ def fast_fragment_mapping(mapper_index_path, fastq_path1, fastq_path2, r_enz,
     #sort sam file
     os.system(samtools + ' sort -n -O SAM -@ %d -T %s -o %s %s'
                       % (nthreads, out_map_path, out_map_path, out_map_path))
-    genome_lengths = dict((crm, len(genome_seq[crm])) for crm in genome_seq)
-    frag_chunk = kwargs.get('frag_chunk', 100000)
-    frags = map_re_sites(r_enz, genome_seq, frag_chunk=frag_chunk)
+    genome_lengths = OrderedDict((crm, len(genome_seq[crm])) for crm in genome_seq)
+    if kwargs.get('genome_path'):
+        cache_prefix = genome_cache_prefix(kwargs['genome_path'])
+    else:
+        cache_prefix = None
+    re_sites = index_re_sites(r_enz, genome_seq, cache_prefix=cache_prefix)
     if samtools and nthreads > 1:
         print 'Splitting sam file'
         # headers
@@ -854,11 +863,10 @@ def fast_fragment_mapping(mapper_index_path, fastq_path1, fastq_path2, r_enz,
         procs = []
         pool = mu.Pool(nthreads)
         for i in xrange(nthreads):
-            frags_shared = copy.deepcopy(frags)
             procs.append(pool.apply_async(
                 parse_gem_3c, args=('%s_%d' % (out_map_path,(i+1)),
                                     '%s_parsed_%d' % (out_map_path,(i+1)),
-                                    copy.deepcopy(genome_lengths), frags_shared,
+                                    copy.deepcopy(genome_lengths), re_sites,
                                     False, True), kwds=kwargs))
             #results.append('%s_parsed_%d' % (out_map_path,(i+1)))
         pool.close()
@@ -869,35 +877,16 @@ def fast_fragment_mapping(mapper_index_path, fastq_path1, fastq_path2, r_enz,
                 print '   x removing tmp mapped %s_%d' % (out_map_path,(i+1))
                 os.system('rm -f %s_%d' % (out_map_path,(i+1)))
 
-        #Final sort and merge
-        nround = 0
-        while len(results) > 1:
-            nround += 1
-            num_procs = min(nthreads,int(len(results)/2))
-            pool = mu.Pool(num_procs)
-            procs = [pool.apply_async(
-                merge_sort,
-                (results.pop(0), results.pop(0), out_map_path+'_%d' % nround, i, True)
-            ) for i in xrange(num_procs)]
-            pool.close()
-            pool.join()
-            results = [proc.get() for proc in procs if proc.get()]
-
-        map_out = open(out_map, 'w')
-        tmp_reads_fh = open(results[0],'rb')
-        for crm in genome_seq:
-            map_out.write('# CRM %s\t%d\n' % (crm, len(genome_seq[crm])))
-        for read_line in tmp_reads_fh:
-            read = read_line.split('\t')
-            map_out.write('\t'.join([read[0]]+read[2:8]+read[9:]))
-        map_out.close()
+        #Final sort and merge, in a single pass over all parsed files
         if clean:
-            print '   x removing tmp mapped %s' % results[0]
-            os.system('rm -f %s' % (results[0]))
+            print '   x removing tmp mapped %s' % ', '.join(results)
+        write_paired_reads(merge_sorted_files(results, _paired_read_key,
+                                              clean=clean),
+                           out_map, genome_lengths)
 
     else:
         print 'Parsing result...'
-        parse_gem_3c(out_map_path, out_map, genome_lengths, frags, verbose=False,
+        parse_gem_3c(out_map_path, out_map, genome_lengths, re_sites, verbose=False,
                      tmp_format=False, **kwargs)
 
         # clean
@@ -6,10 +6,14 @@ Definition and mapping of restriction enymes
 
 from re import compile
 from warnings import warn
+from collections import OrderedDict
+import os
 
+import numpy as np
 from scipy.stats import binom_test
 
 from pytadbit.utils.file_handling import magic_open
+from pytadbit.parsers.genome_parser import genome_checksum
 
 
 def iupac2regex(restring):
@@ -110,6 +114,165 @@ def map_re_sites_nochunk(enzyme_name, genome_seq, verbose=False):
     return frags
 
 
+def _enzyme_names(enzyme_name):
+    if isinstance(enzyme_name, basestring):
+        return [enzyme_name]
+    return list(enzyme_name)
+
+
+def _re_pattern(enzyme_name):
+    """
+    Regexp matching (with an empty string) the cut sites of one or several
+    restriction enzymes
+    """
+    enzyme_names = _enzyme_names(enzyme_name)
+    enzymes = {}
+    for name in enzyme_names:
+        enzymes[name] = RESTRICTION_ENZYMES[name]
+    # we match the full cut-site but report the position after the cut site
+    # (third group of the regexp)
+    restring = ('%s') % ('|'.join(['(?<=%s(?=%s))' % tuple(enzymes[n].split('|'))
+                                   for n in enzymes]))
+    # IUPAC conventions
+    restring = iupac2regex(restring)
+    return compile(restring)
+
+
+def index_re_sites(enzyme_name, genome_seq, verbose=False, cache_prefix=None):
+    """
+    map all restriction enzyme (RE) sites of a given enzyme in a genome.
+    Position of a RE site is defined as the genomic coordinate of the first
+    nucleotide after the first cut (genomic coordinate starts at 1), see
+    :func:`map_re_sites`.
+
+    :param enzyme_name: name of the enzyme to map (upper/lower case are
+       important), or list of names
+    :param genome_seq: a dictionary containing the genomic sequence by
+       chromosome
+    :param None cache_prefix: prefix of the path to a cache of the RE sites
+       (e.g. from :func:`pytadbit.parsers.genome_parser.genome_cache_prefix`,
+       to store it next to the genome). The name of the cache file contains
+       the enzyme names and the checksum of the genome. If the file exists, RE
+       sites are memory-mapped from it, otherwise they are computed and saved
+       in it.
+
+    :returns: a dictionary with, for each chromosome, the sorted array of its
+       RE sites, starting with 1 and ending with the length of the chromosome.
+       RE sites around given positions are found with :func:`find_re_sites`
+    """
+    if cache_prefix:
+        fnam = '%sre_sites_%s_%s.npy' % (
+            cache_prefix, '-'.join(sorted(_enzyme_names(enzyme_name))),
+            genome_checksum(genome_seq))
+        if os.path.exists(fnam):
+            if verbose:
+                print('Loading cached RE sites')
+            return _load_re_sites(fnam, genome_seq)
+    sites = _search_re_sites(enzyme_name, genome_seq, verbose=verbose)
+    if cache_prefix:
+        _save_re_sites(fnam, sites)
+    return sites
+
+
+def _search_re_sites(enzyme_name, genome_seq, verbose=False):
+    enz_pattern = _re_pattern(enzyme_name)
+    sites = OrderedDict()
+    count = 0
+    for crm in genome_seq:
+        seq = genome_seq[crm]
+        positions = [1]
+        positions.extend(match.end() + 1 for match in enz_pattern.finditer(seq))
+        count += len(positions) - 1
+        positions.append(len(seq))
+        sites[crm] = np.sort(np.array(positions, dtype=np.int64))
+    if verbose:
+        print('Found %d RE sites' % count)
+    return sites
+
+
+def _save_re_sites(fnam, sites):
+    """
+    Saves RE sites in a single NumPy file: the offsets of each chromosome
+    followed by the RE sites of all chromosomes.
+    """
+    offsets = np.cumsum([0] + [len(sites[crm]) for crm in sites], dtype=np.int64)
+    # written under a temporary name, in case of concurrent runs
+    tmp_fnam = '%s_%d.tmp' % (fnam, os.getpid())
+    try:
+        out = open(tmp_fnam, 'wb')
+        np.save(out, np.concatenate([offsets] + sites.values()))
+        out.close()
+        os.rename(tmp_fnam, fnam)
+    except (IOError, OSError):
+        warn('WARNING: could not save RE sites in %s\n' % fnam)
+
+
+def _load_re_sites(fnam, genome_seq):
+    values  = np.load(fnam, mmap_mode='r')
+    start   = len(genome_seq) + 1
+    offsets = np.array(values[:start])
+    sites   = OrderedDict()
+    for i, crm in enumerate(genome_seq):
+        sites[crm] = values[start + offsets[i]:start + offsets[i + 1]]
+    return sites
+
+
+def find_re_sites(sites, positions, lengths):
+    """
+    Finds, for many positions of a chromosome at once, the closest RE sites
+    upstream and downstream.
+
+    :param sites: sorted array of RE sites of the chromosome (as returned by
+       :func:`index_re_sites`)
+    :param positions: array of positions of the reads
+    :param lengths: array of lengths of the mapped reads. Reads mapped beyond the
+       end of the chromosome are moved back inside it, if they do not exceed
+       it by more than this length.
+
+    :returns: the positions (moved inside the chromosome if needed), the
+       upstream and the downstream RE sites
+    """
+    positions = np.array(positions, dtype=np.int64)
+    outside = positions >= sites[-1]
+    if outside.any():
+        # case where part of the read is mapped outside chromosome
+        if (positions[outside] - sites[-1] + 1 >=
+            np.asarray(lengths)[outside]).any():
+            raise Exception('Read mapped mostly outside ' +
+                            'chromosome\n')
+        positions[outside] = sites[-1] - 1
+    idx = sites.searchsorted(positions, side='right')
+    return positions, sites[np.maximum(idx - 1, 0)], sites[idx]
+
+
+def find_reads_re_sites(re_sites, crms, positions, lengths):
+    """
+    Finds the closest RE sites upstream and downstream of many reads mapped on
+    different chromosomes (see :func:`find_re_sites`).
+
+    :param re_sites: dictionary of arrays of RE sites per chromosome (as
+       returned by :func:`index_re_sites`)
+    :param crms: list of the chromosomes of the reads
+    :param positions: list of positions of the reads
+    :param lengths: list of lengths of the mapped reads
+
+    :returns: the positions (moved inside the chromosome if needed), the
+       upstream and the downstream RE sites, as arrays in the order of the reads
+    """
+    positions = np.array(positions, dtype=np.int64)
+    lengths   = np.asarray(lengths)
+    prev_re   = np.empty_like(positions)
+    next_re   = np.empty_like(positions)
+    groups = {}
+    for i, crm in enumerate(crms):
+        groups.setdefault(crm, []).append(i)
+    for crm, idx in groups.iteritems():
+        idx = np.array(idx)
+        positions[idx], prev_re[idx], next_re[idx] = find_re_sites(
+            re_sites[crm], positions[idx], lengths[idx])
+    return positions, prev_re, next_re
+
+
 def map_re_sites(enzyme_name, genome_seq, frag_chunk=100000, verbose=False):
     """
     map all restriction enzyme (RE) sites of a given enzyme in a genome.
@@ -127,6 +290,8 @@ def map_re_sites(enzyme_name, genome_seq, frag_chunk=100000, verbose=False):
 
     In this example the coordinate of the RE site would be 7.
 
+    Note: :func:`index_re_sites` returns the same RE sites as one sorted array
+    per chromosome, faster to search.
 
     :param enzyme_name: name of the enzyme to map (upper/lower case are
        important)
@@ -134,61 +299,19 @@ def map_re_sites(enzyme_name, genome_seq, frag_chunk=100000, verbose=False):
        chromosome
     :param 100000 frag_chunk: in order to optimize the search for nearby RE
        sites, each chromosome is splitted into chunks.
-    """
-    if isinstance(enzyme_name, basestring):
-        enzyme_names = [enzyme_name]
-    elif isinstance(enzyme_name, list):
-        enzyme_names = enzyme_name
-    enzymes = {}
-    for name in enzyme_names:
-        enzymes[name] = RESTRICTION_ENZYMES[name]
-    # we match the full cut-site but report the position after the cut site
-    # (third group of the regexp)
-    restring = ('%s') % ('|'.join(['(?<=%s(?=%s))' % tuple(enzymes[n].split('|'))
-                                   for n in enzymes]))
-    # IUPAC conventions
-    restring = iupac2regex(restring)
-
-    enz_pattern = compile(restring)
 
+    :returns: a dictionary with, for each chromosome, a dictionary of chunks
+       with the list of the RE sites in each chunk, preceded by the last RE
+       site of the previous chunks, and followed by the first RE site of the
+       next chunks
+    """
+    index = index_re_sites(enzyme_name, genome_seq, verbose=verbose)
     frags = {}
-    count = 0
-    for crm in genome_seq:
-        seq = genome_seq[crm]
-        frags[crm] = dict([(i, []) for i in range(int(len(seq) // frag_chunk + 1))])
-        frags[crm][0] = [1]
-        for match in enz_pattern.finditer(seq):
-            pos = match.end() + 1
-            frags[crm][pos // frag_chunk].append(pos)
-            count += 1
-        # at the end of last chunk we add the chromosome length
-        frags[crm][len(seq) // frag_chunk].append(len(seq))
-        # now we need to assign as first RE site of a fragment the last RE site
-        # of previsou fragment, and as last RE site, the first RE site of the
-        # next fragment.
-        for i in range(int(len(seq) // frag_chunk + 1)):
-            try:
-                try:
-                    frags[crm][i].insert(0, frags[crm][i - 1][-2])
-                except IndexError:
-                    # in case there was no RE site in previous fragment
-                    frags[crm][i].insert(0, frags[crm][i - 1][-1])
-            except KeyError:
-                # it is the very first chunk
-                pass
-            plus = 1
-            while True:
-                try:
-                    frags[crm][i].append(frags[crm][i + plus][0])
-                    break
-                except IndexError:
-                    # no RE site in this fragment, get "next RE site" from next
-                    plus += 1
-                except KeyError:
-                    # end of the chromosome
-                    break
-    if verbose:
-        print('Found %d RE sites' % count)
+    for crm, sites in index.iteritems():
+        nchunks = int(len(genome_seq[crm]) // frag_chunk + 1)
+        bounds = sites.searchsorted(np.arange(nchunks + 1) * frag_chunk)
+        frags[crm] = dict((i, sites[max(bounds[i] - 1, 0):bounds[i + 1] + 1].tolist())
+                          for i in xrange(nchunks))
     return frags
 
 
@@ -0,0 +1,219 @@
+"""
+18 Oct 2026
+
+Sidecar index of the contacts of a TADbit BAM file.
+
+For each chromosome, the positions of both read-ends and the filtering flag of
+each read are stored in a container file (see
+:mod:`pytadbit.utils.hic_container`). Reads are sorted by blocks of the genome:
+first by block of the first read-end (row block), then by block of the second
+read-end (column block). A 2D index of these blocks gives the position of the
+reads of each pair of blocks, so that the reads of a sub-matrix are found, and
+filtered, without decoding any BAM record.
+"""
+
+import os
+from array import array
+
+import numpy as np
+from pysam import AlignmentFile
+
+from pytadbit.utils.hic_container import ContainerWriter, ContainerReader
+
+INDEX_EXTENSION = '.tci'
+BLOCK           = 1000000  # size of the blocks of the 2D index (in bases)
+INDEX_CHUNK     = 2**16    # number of reads compressed together
+
+
+def contact_index_path(inbam):
+    """
+    :returns: path to the sidecar index of a BAM file
+    """
+    return inbam + INDEX_EXTENSION
+
+
+def _bam_signature(inbam):
+    """
+    Size and modification time of a BAM file, to check that its index is up to
+    date
+    """
+    stat = os.stat(inbam)
+    return [stat.st_size, int(stat.st_mtime)]
+
+
+def _int_array(values, dtype=np.int32):
+    if not values:
+        return np.zeros(0, dtype=dtype)
+    return np.frombuffer(values, dtype=np.int32).astype(dtype, copy=False)
+
+
+def build_contact_index(inbam, fnam=None, block=BLOCK, level=6, verbose=False):
+    """
+    Builds the sidecar index of a TADbit BAM file. The BAM file is read once,
+    one chromosome at a time.
+
+    :param inbam: path to a TADbit BAM file (sorted and indexed)
+    :param None fnam: path to the output index, by default the path to the BAM
+       file with the '.tci' extension (where :func:`get_contact_index` looks
+       for it)
+    :param 1000000 block: size (in bases) of the blocks of the 2D index. Reads
+       are looked up by blocks, smaller blocks make queries of small regions
+       faster, and the index larger.
+    :param 6 level: zlib compression level
+
+    :returns: path to the index
+    """
+    fnam = fnam or contact_index_path(inbam)
+    bamfile = AlignmentFile(inbam, 'rb')
+    references = list(bamfile.references)
+    lengths    = list(bamfile.lengths)
+    # index of the first block of each chromosome in the genome
+    first_block = np.cumsum([0] + [l / block + 1 for l in lengths[:-1]])
+    writer = ContainerWriter(fnam, level=level)
+    for crm in references:
+        if verbose:
+            print '   - indexing reads of %s' % crm
+        poss1 = array('i')
+        crms2 = array('i')
+        poss2 = array('i')
+        flags = array('i')
+        for r in bamfile.fetch(crm, multiple_iterators=True):
+            poss1.append(r.reference_start + 1)
+            crms2.append(r.mrnm)
+            poss2.append(r.mpos + 1)
+            flags.append(r.flag)
+        poss1 = _int_array(poss1)
+        crms2 = _int_array(crms2)
+        poss2 = _int_array(poss2)
+        flags = _int_array(flags, dtype=np.uint16)
+        rows = poss1 / block
+        cols = first_block[crms2] + poss2 / block
+        order = np.lexsort((poss2, poss1, cols, rows))
+        keys = rows[order].astype(np.int64) << 32 | cols[order]
+        keys, starts = np.unique(keys, return_index=True)
+        writer.add_array('pos1:'  + crm, poss1[order], chunk=INDEX_CHUNK)
+        writer.add_array('pos2:'  + crm, poss2[order], chunk=INDEX_CHUNK)
+        writer.add_array('flag:'  + crm, flags[order], chunk=INDEX_CHUNK)
+        writer.add_array('block_row:' + crm, (keys >> 32).astype(np.int32))
+        writer.add_array('block_col:' + crm,
+                         (keys & 0xFFFFFFFF).astype(np.int32))
+        writer.add_array('block_start:' + crm, np.append(starts, len(order)))
+    bamfile.close()
+    writer.close(metadata={'references': references,
+                           'lengths'   : lengths,
+                           'block'     : block,
+                           'bam'       : _bam_signature(inbam)})
+    return fnam
+
+
+def get_contact_index(inbam):
+    """
+    :param inbam: path to a TADbit BAM file
+
+    :returns: the ContactIndex of the BAM file, or None if it has no index, or
+       if the BAM file was modified after the index was built
+    """
+    fnam = contact_index_path(inbam)
+    if not os.path.exists(fnam):
+        return None
+    index = ContactIndex(fnam)
+    if index.signature != _bam_signature(inbam):
+        index.close()
+        return None
+    return index
+
+
+class ContactIndex(object):
+    """
+    Reads the sidecar index of a TADbit BAM file (see
+    :func:`build_contact_index`).
+
+    :param fnam: path to the index
+    """
+    def __init__(self, fnam):
+        self.reader     = ContainerReader(fnam)
+        metadata        = self.reader.metadata
+        self.references = [str(crm) for crm in metadata['references']]
+        self.lengths    = metadata['lengths']
+        self.block      = metadata['block']
+        self.signature  = metadata['bam']
+        self.first_block = np.cumsum(
+            [0] + [l / self.block + 1 for l in self.lengths[:-1]])
+        self._blocks = {}
+
+    def close(self):
+        self.reader.close()
+
+    def _block_index(self, crm):
+        if not crm in self._blocks:
+            self._blocks[crm] = (self.reader.read('block_row:'   + crm),
+                                 self.reader.read('block_col:'   + crm),
+                                 self.reader.read('block_start:' + crm))
+        return self._blocks[crm]
+
+    def contacts(self, region1, start1=None, end1=None, region2=None,
+                 start2=None, end2=None, filter_exclude=0):
+        """
+        Gets the reads with a first read-end in region1 and a second read-end
+        in region2. Positions are 1-based, as in the BAM file, start positions
+        are included and end positions are not.
+
+        :param region1: chromosome name of the first read-end
+        :param None start1: start of the region of the first read-end
+        :param None end1: end of the region of the first read-end
+        :param None region2: chromosome name of the second read-end, if None,
+           all the genome
+        :param None start2: start of the region of the second read-end
+        :param None end2: end of the region of the second read-end
+        :param 0 filter_exclude: reads with any of these bits in their
+           filtering flag are skipped
+
+        :returns: the positions of the first read-ends, the chromosome indexes
+           and the positions of the second read-ends
+        """
+        block = self.block
+        start1 = start1 or 0
+        # positions beyond the end of a chromosome would fall in the blocks
+        # of the next one
+        length1 = self.lengths[self.references.index(region1)] + 1
+        end1    = min(end1 or length1, length1)
+        rows, cols, starts = self._block_index(region1)
+        wanted = (rows >= start1 / block) & (rows <= (end1 - 1) / block)
+        if region2:
+            icrm2   = self.references.index(region2)
+            start2  = start2 or 0
+            length2 = self.lengths[icrm2] + 1
+            end2    = min(end2 or length2, length2)
+            first   = self.first_block[icrm2]
+            wanted &= ((cols >= first + start2 / block) &
+                       (cols <= first + (end2 - 1) / block))
+        wanted = np.flatnonzero(wanted)
+        # consecutive pairs of blocks are read at once
+        runs = np.split(wanted, np.flatnonzero(np.diff(wanted) != 1) + 1)
+        poss1 = []
+        poss2 = []
+        flags = []
+        crms2 = []
+        for run in runs:
+            if not len(run):
+                continue
+            beg, end = starts[run[0]], starts[run[-1] + 1]
+            poss1.append(self.reader.read('pos1:' + region1, beg, end))
+            poss2.append(self.reader.read('pos2:' + region1, beg, end))
+            flags.append(self.reader.read('flag:' + region1, beg, end))
+            crms2.append(np.repeat(
+                np.searchsorted(self.first_block, cols[run], side='right') - 1,
+                np.diff(starts[run[0]:run[-1] + 2])))
+        if not poss1:
+            empty = np.zeros(0, dtype=np.int32)
+            return empty, empty, empty
+        poss1 = np.concatenate(poss1)
+        poss2 = np.concatenate(poss2)
+        flags = np.concatenate(flags)
+        crms2 = np.concatenate(crms2).astype(np.int32)
+        keep = (poss1 >= start1) & (poss1 < end1)
+        if region2:
+            keep &= (crms2 == icrm2) & (poss2 >= start2) & (poss2 < end2)
+        if filter_exclude:
+            keep &= (flags & filter_exclude) == 0
+        return poss1[keep], crms2[keep], poss2[keep]
@@ -4,13 +4,181 @@
 convert a bunch of fasta files, or a single multi fasta file, into a dictionary
 """
 
-from collections import OrderedDict
-import multiprocessing as mu
+from collections import OrderedDict, Mapping
+from hashlib import md5
+from struct import pack, unpack, calcsize
+from warnings import warn
+import json
+import mmap
+import os
 from os import path
 import re
 
+import numpy as np
+
 from pytadbit.utils.file_handling import magic_open
 
+# binary genome cache: magic string, version of the format and position of
+# the JSON header (chromosome names, offsets and lengths), the sequences are
+# stored in between, one byte per base
+GENOME_MAGIC   = 'TADbitGS'
+GENOME_VERSION = 1
+_GENOME_PREFIX = '<8sIQ'
+
+GC_BLOCK = 10000000  # number of bases read at once to compute GC content
+
+
+def genome_cache_prefix(f_names):
+    """
+    :param f_names: list of paths to FASTA files, or just a single path
+
+    :returns: the prefix of the paths of the files cached next to the genome
+       (e.g. the parsed genome or its RE sites)
+    """
+    if isinstance(f_names, str):
+        f_names = [f_names]
+    if len(f_names) == 1:
+        return f_names[0] + '_'
+    return path.join(path.commonprefix(f_names), '')
+
+
+def genome_checksum(genome_seq):
+    """
+    :param genome_seq: a dictionary generated by :func:`parse_fasta`
+
+    :returns: MD5 checksum of the names and sequences of the chromosomes
+    """
+    if isinstance(genome_seq, CachedGenome):
+        return genome_seq.checksum
+    digest = md5()
+    for crm in genome_seq:
+        digest.update('>%s\n' % crm)
+        digest.update(genome_seq[crm])
+    return digest.hexdigest()
+
+
+class CachedGenome(Mapping):
+    """
+    Read-only dictionary of chromosome sequences, memory-mapped from a binary
+    genome cache (see :func:`parse_fasta`). Opening it does not read any
+    sequence, each chromosome is read when accessed, and only the last one
+    accessed is kept in memory.
+
+    :param fnam: path to the binary genome cache
+    """
+    def __init__(self, fnam):
+        self.fnam = fnam
+        handler = open(fnam, 'rb')
+        header = _read_genome_header(handler)
+        self._map = mmap.mmap(handler.fileno(), 0, access=mmap.ACCESS_READ)
+        handler.close()
+        self.checksum = str(header['checksum'])
+        self._chromosomes = OrderedDict(
+            (str(crm), (offset, length))
+            for crm, offset, length in header['chromosomes'])
+        self._last = None, None
+
+    def __getitem__(self, crm):
+        if self._last[0] != crm:
+            offset, length = self._chromosomes[crm]
+            self._last = crm, self._map[offset:offset + length]
+        return self._last[1]
+
+    def __iter__(self):
+        return iter(self._chromosomes)
+
+    def __len__(self):
+        return len(self._chromosomes)
+
+    def __contains__(self, crm):
+        return crm in self._chromosomes
+
+    def __reduce__(self):
+        return CachedGenome, (self.fnam, )
+
+    def keys(self):
+        return self._chromosomes.keys()
+
+    def lengths(self):
+        """
+        :returns: a sorted dictionary with chromosome names as keys, and
+           their length as values
+        """
+        return OrderedDict((crm, length)
+                           for crm, (_, length) in self._chromosomes.iteritems())
+
+    def sequence_array(self, crm):
+        """
+        :param crm: chromosome name
+
+        :returns: the sequence of the chromosome as a read-only NumPy array of
+           bytes, mapped to the cache file (nothing is read before it is
+           used)
+        """
+        offset, length = self._chromosomes[crm]
+        return np.frombuffer(self._map, dtype=np.uint8, count=length,
+                             offset=offset)
+
+
+def _read_genome_header(handler):
+    """
+    :returns: the JSON header of a binary genome cache
+    """
+    prefix = handler.read(calcsize(_GENOME_PREFIX))
+    if (len(prefix) != calcsize(_GENOME_PREFIX) or
+        unpack(_GENOME_PREFIX, prefix)[0] != GENOME_MAGIC):
+        raise Exception('ERROR: %s is not a TADbit genome cache\n' %
+                        handler.name)
+    _, version, header_pos = unpack(_GENOME_PREFIX, prefix)
+    if version > GENOME_VERSION:
+        raise Exception('ERROR: %s written by a newer version of TADbit, use '
+                        'reload_cache=True\n' % handler.name)
+    handler.seek(header_pos)
+    return json.loads(handler.read())
+
+
+def _save_genome(fnam, genome_seq):
+    """
+    Saves a genome in a binary cache, one byte per base.
+    """
+    # written under a temporary name, in case of concurrent runs
+    tmp_fnam = '%s_%d.tmp' % (fnam, os.getpid())
+    try:
+        out = open(tmp_fnam, 'wb')
+        out.write(pack(_GENOME_PREFIX, GENOME_MAGIC, GENOME_VERSION, 0))
+        chromosomes = []
+        for crm in genome_seq:
+            chromosomes.append((crm, out.tell(), len(genome_seq[crm])))
+            out.write(genome_seq[crm])
+        header_pos = out.tell()
+        out.write(json.dumps({'chromosomes': chromosomes,
+                              'checksum'   : genome_checksum(genome_seq)}))
+        out.seek(0)
+        out.write(pack(_GENOME_PREFIX, GENOME_MAGIC, GENOME_VERSION,
+                       header_pos))
+        out.close()
+        os.rename(tmp_fnam, fnam)
+    except (IOError, OSError):
+        warn('WARNING: could not save genome in %s\n' % fnam)
+
+
+def _load_text_genome(fnam, only_length=False):
+    """
+    Loads a genome cached by former versions of TADbit (in FASTA format, one
+    line per chromosome).
+    """
+    genome_seq = OrderedDict()
+    for line in open(fnam):
+        if line.startswith('>'):
+            c = line[1:].strip()
+        else:
+            if only_length:
+                genome_seq[c] = len(line.strip())
+            else:
+                genome_seq[c] = line.strip()
+    return genome_seq
+
+
 def parse_fasta(f_names, chr_names=None, chr_filter=None, chr_regexp=None,
                 verbose=True, save_cache=True, reload_cache=False, only_length=False):
     """
@@ -24,32 +192,37 @@ def parse_fasta(f_names, chr_names=None, chr_filter=None, chr_regexp=None,
     :param None chr_filter: use only chromosome in the input list
     :param None chr_regexp: use only chromosome matching
     :param True save_cache: save a cached version of this file for faster
-       loadings (~4 times faster)
+       loadings. The cache is a binary file, with one byte per base, that is
+       memory-mapped when loaded (see :class:`CachedGenome`)
     :param False reload_cache: reload cached genome
     :param False only_length: returns dictionary with length of genome,not sequence
 
     :returns: a sorted dictionary with chromosome names as keys, and sequences
-       as values (sequence in upper case)
+       as values (sequence in upper case). If the genome is loaded from the
+       cache, a read-only :class:`CachedGenome`
     """
     if isinstance(f_names, str):
         f_names = [f_names]
 
-    if len(f_names) == 1:
-        fname = f_names[0] + '_genome.TADbit'
-    else:
-        fname = path.join(path.commonprefix(f_names), 'genome.TADbit')
+    fname = genome_cache_prefix(f_names) + 'genome_bin.TADbit'
+    # cache written by former versions of TADbit, in FASTA format
+    text_fname = genome_cache_prefix(f_names) + 'genome.TADbit'
     if path.exists(fname) and not reload_cache:
         if verbose:
             print 'Loading cached genome'
-        genome_seq = OrderedDict()
-        for line in open(fname):
-            if line.startswith('>'):
-                c = line[1:].strip()
-            else:
-                if only_length:
-                    genome_seq[c] = len(line.strip())
-                else:
-                    genome_seq[c] = line.strip()
+        if only_length:
+            handler = open(fname, 'rb')
+            header = _read_genome_header(handler)
+            handler.close()
+            return OrderedDict((str(crm), length)
+                               for crm, _, length in header['chromosomes'])
+        return CachedGenome(fname)
+    if path.exists(text_fname) and not reload_cache:
+        if verbose:
+            print 'Loading cached genome'
+        genome_seq = _load_text_genome(text_fname, only_length=only_length)
+        if save_cache and not only_length:
+            _save_genome(fname, genome_seq)
         return genome_seq
 
     if isinstance(chr_names, str):
@@ -123,14 +296,7 @@ def parse_fasta(f_names, chr_names=None, chr_filter=None, chr_regexp=None,
     if save_cache and not only_length:
         if verbose:
             print 'saving genome in cache'
-        if len(f_names) == 1:
-            fname = f_names[0] + '_genome.TADbit'
-        else:
-            fname = path.join(path.commonprefix(f_names), 'genome.TADbit')
-        out = open(fname, 'w')
-        for c in genome_seq:
-            out.write('>%s\n%s\n' % (c, genome_seq[c]))
-        out.close()
+        _save_genome(fname, genome_seq)
     return genome_seq
 
 
@@ -142,46 +308,35 @@ def get_gc_content(genome, resolution, chromosomes=None, n_cpus=None, by_chrom=F
     :param genome: a TADbit parsed genome object
     :param resolution:
     :param None chromosomes: GC content only calculated over these chromosomes
-    :param None n_cpus: parallelize (can't parallelize more than the number of
-       chromosomes)
+    :param None n_cpus: not used, kept for backward compatibility (GC content
+       is counted with NumPy, by blocks of the genome)
     :param False by_chrom: if False returns a unique list for the full genome
     """
     chromosomes = chromosomes if chromosomes else genome.keys()
-    if not n_cpus:
-        n_cpus = mu.cpu_count()
-    pool = mu.Pool(n_cpus)
-    get_chr_gc = _get_chr_gc_dico if by_chrom else _get_chr_gc_list
-    jobs = {}
-    for crm in chromosomes:
-        jobs[crm] = pool.apply_async(get_chr_gc, args=(genome[crm], resolution))
-    pool.close()
-    pool.join()
     if by_chrom:
-        gc_content = dict((crm, jobs[crm].get()) for crm in chromosomes)
-    else:
-        gc_content = reduce(lambda x,y: x + y, (jobs[crm].get() for crm in chromosomes))
-    return gc_content
-
-
-def _get_chr_gc_list(chrom, resolution):
+        return dict((crm, dict(enumerate(_get_chr_gc(genome, crm, resolution))))
+                    for crm in chromosomes)
     gc_content = []
-    for pos in xrange(0, len(chrom), resolution):
-        seq = chrom[pos:pos + resolution]
-        try:
-            gc_content.append(float(seq.count('G') + seq.count('C')) /
-                              (len(seq) - seq.count('N')))
-        except ZeroDivisionError:
-            gc_content.append(float('nan'))
+    for crm in chromosomes:
+        gc_content.extend(_get_chr_gc(genome, crm, resolution))
     return gc_content
 
 
-def _get_chr_gc_dico(chrom, reso):
-    gc_content = {}
-    for pos in xrange(0, len(chrom), reso):
-        seq = chrom[pos:pos + reso]
-        try:
-            gc_content[pos  /reso] = (float(seq.count('G') + seq.count('C')) /
-                                      (len(seq) - seq.count('N')))
-        except ZeroDivisionError:
-            gc_content[pos  /reso] = float('nan')
+def _get_chr_gc(genome, crm, resolution):
+    if isinstance(genome, CachedGenome):
+        chrom = genome.sequence_array(crm)
+    else:
+        chrom = np.frombuffer(genome[crm], dtype=np.uint8)
+    # blocks of the chromosome are read at once, to keep memory usage low
+    block = max(1, GC_BLOCK / resolution) * resolution
+    gc_content = []
+    for beg in xrange(0, len(chrom), block):
+        seq = chrom[beg:beg + block]
+        bins = np.arange(0, len(seq), resolution)
+        gcs = np.add.reduceat((seq == ord('G')) | (seq == ord('C')), bins,
+                              dtype=np.int64)
+        nns = np.add.reduceat(seq == ord('N'), bins, dtype=np.int64)
+        lens = np.diff(np.append(bins, len(seq)))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            gc_content.extend((gcs / (lens - nns).astype(float)).tolist())
     return gc_content
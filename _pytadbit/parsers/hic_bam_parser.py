@@ -4,18 +4,23 @@ into compressed BAM format.
 
 """
 
-from cPickle                      import load, dump
+from cPickle                      import load, dump, HIGHEST_PROTOCOL
 from time                         import sleep, time
+from array                        import array
+from struct                       import unpack
 from collections                  import OrderedDict
 from subprocess                   import Popen, PIPE
 from random                       import getrandbits
 from tarfile                      import open as taropen
 from StringIO                     import StringIO
 from shutil                       import copyfile
+from zlib                         import crc32
 import datetime
 from sys                          import stdout, stderr, exc_info, modules
 from distutils.version            import LooseVersion
+from warnings                     import warn
 import os
+import heapq
 import multiprocessing as mu
 
 try:
@@ -23,16 +28,30 @@ try:
 except ImportError:
     pass  # silently pass, very specific need
 
-from pysam                        import AlignmentFile
+from pysam                        import AlignmentFile, AlignmentHeader
+from pysam                        import AlignedSegment
+from pysam                        import index as pysam_index
+import numpy as np
 
 from pytadbit.utils.file_handling   import mkdir, which
 from pytadbit.utils.extraviews      import nicer
 from pytadbit.mapping.filter        import MASKED
+from pytadbit.utils.hic_storage     import ContactStorage
+from pytadbit.parsers.contact_index import get_contact_index
 try:
     from pytadbit.parsers.cooler_parser import cooler_file
 except ImportError:
     pass
 
+# CIGAR operations used to tag the first (padding) and the second (soft
+# clipping) copy of each read
+BAM_CPAD       = 6
+BAM_CSOFT_CLIP = 4
+
+# maximum number of BAM records held in memory while sorting
+SORT_BUFFER = 1000000
+
+
 def filters_to_bin(filters):
     return sum((k in filters) * 2**(k-1) for k in MASKED)
 
@@ -174,7 +193,192 @@ def _map2sam_long(line, flag):
     return r1r2
 
 
-def bed2D_to_BAMhic(infile, valid, ncpus, outbam, frmt, masked=None, samtools='samtools'):
+def _map2rec_short(line, flag, refs):
+    """
+    translate map + flag into two hic-bam records (see _map2sam_short), as
+    tuples of: reference id, 0-based position, read name, flag, CIGAR, mate
+    reference id, mate 0-based position, template length and tags
+    """
+    (qname,
+     rname, pos, _, _, _, _,
+     rnext, pnext, _) = line.strip().split('\t', 9)
+
+    # multicontact?
+    try:
+        tc = int(qname.split('#')[1].split('/')[1])
+    except IndexError:
+        tc = 1
+    # trans contact?
+    if rname != rnext:
+        flag += 1024 # filter_keys['trans-chromosomic'] = 2**10
+    rname, pos   = refs[rname], int(pos) - 1
+    rnext, pnext = refs[rnext], int(pnext) - 1
+    tags = (('TC', tc), )
+    return ((rname, pos, qname, flag, ((BAM_CPAD, 1), ), rnext, pnext, 0, tags),
+            (rnext, pnext, qname, flag, ((BAM_CSOFT_CLIP, 1), ), rname, pos, 0, tags))
+
+
+def _map2rec_mid(line, flag, refs):
+    """
+    translate map + flag into two hic-bam records (see _map2sam_mid and
+    _map2rec_short)
+    """
+    (qname,
+     rname, pos, s1, l1, _, _,
+     rnext, pnext, s2, l2, _) = line.strip().split('\t', 11)
+
+    # multicontact?
+    try:
+        tc = int(qname.split('#')[1].split('/')[1])
+    except IndexError:
+        tc = 1
+    # trans contact?
+    if rname != rnext:
+        flag += 1024 # filter_keys['trans-chromosomic'] = 2**10
+    rname, pos   = refs[rname], int(pos) - 1
+    rnext, pnext = refs[rnext], int(pnext) - 1
+    l1, l2 = int(l1), int(l2)
+    tags = (('TC', tc), ('S1', int(s1)), ('S2', int(s2)))
+    return ((rname, pos, qname, flag, ((BAM_CPAD, l1), ), rnext, pnext, l2, tags),
+            (rnext, pnext, qname, flag, ((BAM_CSOFT_CLIP, l2), ), rname, pos, l1, tags))
+
+
+def _map2rec_long(line, flag, refs):
+    """
+    translate map + flag into two hic-bam records (see _map2sam_long and
+    _map2rec_short)
+    """
+    (qname,
+     rname, pos, s1, l1, e1, e2,
+     rnext, pnext, s2, l2, e3, e4) = line.strip().split('\t')
+
+    # multicontact?
+    try:
+        tc = int(qname.split('#')[1].split('/')[1])
+    except IndexError:
+        tc = 1
+    # trans contact?
+    if rname != rnext:
+        flag += 1024 # filter_keys['trans-chromosomic'] = 2**10
+    rname, pos   = refs[rname], int(pos) - 1
+    rnext, pnext = refs[rnext], int(pnext) - 1
+    l1, l2 = int(l1), int(l2)
+    s1, s2 = int(s1), int(s2)
+    e1, e2, e3, e4 = int(e1), int(e2), int(e3), int(e4)
+    return ((rname, pos, qname, flag, ((BAM_CPAD, l1), ), rnext, pnext, l2,
+             (('TC', tc), ('S1', s1), ('S2', s2),
+              ('E1', e1), ('E2', e2), ('E3', e3), ('E4', e4))),
+            (rnext, pnext, qname, flag, ((BAM_CSOFT_CLIP, l2), ), rname, pos, l1,
+             (('TC', tc), ('S1', s2), ('S2', s1),
+              ('E3', e3), ('E4', e4), ('E1', e1), ('E2', e2))))
+
+
+def _write_records(outbam, records):
+    """
+    Writes hic-bam records (see _map2rec_short) into an open BAM file
+    """
+    read = AlignedSegment(outbam.header)
+    read.mapping_quality = 0
+    for (rname, pos, qname, flag, cigar,
+         rnext, pnext, tlen, tags) in records:
+        read.query_name           = qname
+        read.flag                 = flag
+        read.reference_id         = rname
+        read.reference_start      = pos
+        read.cigartuples          = cigar
+        read.next_reference_id    = rnext
+        read.next_reference_start = pnext
+        read.template_length      = tlen
+        read.set_tags(tags)
+        outbam.write(read)
+
+
+def _dump_sorted(records, fnam):
+    """
+    Sorts records and writes them, by batches, into a temporary file
+    """
+    records.sort()
+    out = open(fnam, 'wb')
+    for beg in xrange(0, len(records), 10000):
+        dump(records[beg:beg + 10000], out, HIGHEST_PROTOCOL)
+    out.close()
+
+
+def _load_sorted(fnam):
+    """
+    Iterates over the records written by _dump_sorted
+    """
+    handler = open(fnam, 'rb')
+    while True:
+        try:
+            batch = load(handler)
+        except EOFError:
+            break
+        for record in batch:
+            yield record
+    handler.close()
+
+
+def _write_sorted_bam(records, header, outbam, ncpus=1, max_records=SORT_BUFFER):
+    """
+    Writes a coordinate-sorted and indexed BAM file with pysam.
+
+    Records are sorted by chunks of max_records, each written into a temporary
+    file, and then merged while writing the BAM file (so that at most
+    max_records are held in memory).
+
+    :param records: iterable of hic-bam records (see _map2rec_short)
+    :param header: SAM header (text)
+    :param outbam: path to the output BAM file
+    :param 1 ncpus: number of threads used to compress the BAM file
+    :param 1000000 max_records: maximum number of records held in memory
+    """
+    header = AlignmentHeader.from_text(header)
+    tmp_files = []
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) >= max_records:
+            tmp_files.append('%s_sort_%d.tmp' % (outbam, len(tmp_files)))
+            _dump_sorted(chunk, tmp_files[-1])
+            chunk = []
+    out = AlignmentFile(outbam, 'wb', header=header, threads=ncpus)
+    if tmp_files:
+        tmp_files.append('%s_sort_%d.tmp' % (outbam, len(tmp_files)))
+        _dump_sorted(chunk, tmp_files[-1])
+        del(chunk)
+        _write_records(out, heapq.merge(*[_load_sorted(fnam)
+                                          for fnam in tmp_files]))
+        for fnam in tmp_files:
+            os.remove(fnam)
+    else:
+        chunk.sort()
+        _write_records(out, chunk)
+    out.close()
+    pysam_index(outbam)
+
+
+def _flag_lines(fhandler, filter_line, filter_handler, filter_keys):
+    """
+    Iterates over the lines of the file of reads, adding the filtering flag of
+    each read.
+    """
+    for line in fhandler:
+        flag = 0
+        # check if read matches any filter
+        rid = line.split("\t")[0]
+        for i in filter_line:
+            if filter_line[i] == rid:
+                flag += filter_keys[i]
+                try:
+                    filter_line[i] = filter_handler[i].next().strip()
+                except StopIteration:
+                    pass
+        yield line, flag
+
+
+def bed2D_to_BAMhic(infile, valid, ncpus, outbam, frmt, masked=None,
+                    samtools=None, max_records=SORT_BUFFER):
     """
     function adapted from Enrique Vidal <enrique.vidal@crg.eu> scipt to convert
     2D beds into compressed BAM format.
@@ -197,12 +401,20 @@ def bed2D_to_BAMhic(infile, valid, ncpus, outbam, frmt, masked=None, samtools='s
        - S1 and S2 tags are the strand orientation of the left and right read-end
 
     Each pair of contacts produces two lines in the output BAM
+
+    :param None samtools: path to samtools binary. If given, SAM lines are
+       piped to samtools to be compressed, sorted and indexed. By default BAM
+       records are built, sorted, compressed (using ncpus threads) and indexed
+       with pysam.
+    :param 1000000 max_records: maximum number of BAM records held in memory
+       while sorting without samtools. Above, records are sorted by chunks
+       written to temporary files, and merged.
     """
-    samtools = which(samtools)
-    if not samtools:
-        raise Exception('ERROR: samtools is needed to save a compressed '
-                        'version of the results. Check '
-                        'http://samtools.sourceforge.net/ \n')
+    if samtools:
+        samtools = which(samtools)
+        if not samtools:
+            raise Exception('ERROR: samtools not found. Check '
+                            'http://samtools.sourceforge.net/ \n')
 
     # define filter codes
     filter_keys = OrderedDict()
@@ -249,48 +461,50 @@ def bed2D_to_BAMhic(infile, valid, ncpus, outbam, frmt, masked=None, samtools='s
     if not valid:
         filter_line, filter_handler = get_filters(infile, masked)
     fhandler.seek(pos_fh)
-    # check samtools version number and modify command line
-    version = LooseVersion([l.split()[1]
-                            for l in Popen(samtools, stderr=PIPE).communicate()[1].split('\n')
-                            if 'Version' in l][0])
-    pre = '-o' if version >= LooseVersion('1.3') else ''
-
-    proc = Popen(samtools + ' view -Shb -@ %d - | samtools sort -@ %d - %s %s' % (
-        ncpus, ncpus, pre,
-        outbam + '.bam' if  version >= LooseVersion('1.3') else ''),  # in new version '.bam' is no longer added
-                 shell=True, stdin=PIPE)
-    proc.stdin.write(output)
     if frmt == 'mid':
         map2sam = _map2sam_mid
+        map2rec = _map2rec_mid
     elif frmt == 'long':
         map2sam = _map2sam_long
+        map2rec = _map2rec_long
     else:
         map2sam = _map2sam_short
+        map2rec = _map2rec_short
 
     if valid:
-        for line in fhandler:
-            flag = 0
-            # get output in sam format
-            proc.stdin.write(map2sam(line, flag))
+        lines = ((line, 0) for line in fhandler)
     else:
-        for line in fhandler:
-            flag = 0
-            # check if read matches any filter
-            rid = line.split("\t")[0]
-            for i in filter_line:
-                if filter_line[i] == rid:
-                    flag += filter_keys[i]
-                    try:
-                        filter_line[i] = filter_handler[i].next().strip()
-                    except StopIteration:
-                        pass
+        lines = _flag_lines(fhandler, filter_line, filter_handler, filter_keys)
+
+    if samtools:
+        # check samtools version number and modify command line
+        version = LooseVersion([l.split()[1]
+                                for l in Popen(samtools, stderr=PIPE).communicate()[1].split('\n')
+                                if 'Version' in l][0])
+        pre = '-o' if version >= LooseVersion('1.3') else ''
+
+        proc = Popen(samtools + ' view -Shb -@ %d - | samtools sort -@ %d - %s %s' % (
+            ncpus, ncpus, pre,
+            outbam + '.bam' if  version >= LooseVersion('1.3') else ''),  # in new version '.bam' is no longer added
+                     shell=True, stdin=PIPE)
+        proc.stdin.write(output)
+        for line, flag in lines:
             # get output in sam format
             proc.stdin.write(map2sam(line, flag))
-    proc.stdin.close()
-    proc.wait()
+        proc.stdin.close()
+        proc.wait()
 
-    # Index BAM
-    _ = Popen(samtools + ' index %s.bam' % (outbam), shell=True).communicate()
+        # Index BAM
+        _ = Popen(samtools + ' index %s.bam' % (outbam), shell=True).communicate()
+    else:
+        output = output.replace('SO:queryname', 'SO:coordinate')
+        refs = dict((l.split('\t')[1][3:], i) for i, l in
+                    enumerate(l for l in output.split('\n')
+                              if l.startswith('@SQ')))
+        _write_sorted_bam((record for line, flag in lines
+                           for record in map2rec(line, flag, refs)),
+                          output, outbam + '.bam', ncpus=ncpus,
+                          max_records=max_records)
 
     # close file handlers
     fhandler.close()
@@ -333,59 +547,218 @@ def get_filters(infile, masked):
     return filter_line, filter_handler
 
 
-def _read_bam_frag(inbam, filter_exclude, all_bins, sections1, sections2,
-                   rand_hash, resolution, tmpdir, region, start, end,
-                   half=False, sum_columns=False):
+# size of the windows of the linear index of BAI files, and bin holding the
+# span of each reference
+BAI_WINDOW     = 2**14
+BAI_PSEUDO_BIN = 37450
+
+# interactions of a chunk of the BAM file: chromosome index of the contact (-1
+# for inter-chromosomal), row, column and number of reads
+CHUNK_DTYPE = np.dtype([('crm', np.int32), ('row', np.int32),
+                        ('col', np.int32), ('count', np.uint32)])
+
+
+def _chunk_fname(tmpdir, rand_hash, region, start, end, resolution):
+    return os.path.join(tmpdir, '_tmp_%s' % (rand_hash),
+                        '%s:%d-%d_%d.npy' % (region, start, end, resolution))
+
+
+def _int_array(values):
+    """
+    :returns: a NumPy array sharing the memory of an array('i')
+    """
+    if not values:
+        return np.zeros(0, dtype=np.int32)
+    return np.frombuffer(values, dtype=np.int32)
+
+
+def _fmix32(values):
+    """
+    Finalizer of MurmurHash3 applied to an array of 32 bit integers (spreads
+    the bits of each value over its whole hash)
+    """
+    values = np.asarray(values, dtype=np.uint32)
+    values = values ^ (values >> np.uint32(16))
+    values = values * np.uint32(0x85ebca6b)
+    values = values ^ (values >> np.uint32(13))
+    values = values * np.uint32(0xc2b2ae35)
+    return values ^ (values >> np.uint32(16))
+
+
+def sample_reads(hashes, fraction, seed=0):
+    """
+    Deterministic sampling of reads from the CRC32 of their names. The two
+    copies of a read in a TADbit BAM file having the same name, both are kept
+    or both are discarded.
+
+    :param hashes: array with the CRC32 (unsigned) of the names of the reads
+    :param fraction: fraction of reads to keep
+    :param 0 seed: different seeds select different (independent) samples
+
+    :returns: a boolean array, True for the reads to keep
+    """
+    seed = _fmix32(np.array([seed & 0xFFFFFFFF]))[0]
+    return _fmix32(np.asarray(hashes, dtype=np.uint32) ^ seed) < int(
+        fraction * 2**32)
+
+
+def _count_valid_reads(inbam, filter_exclude, region):
+    """
+    Counts the reads of a chromosome that pass the filters
+    """
     bamfile = AlignmentFile(inbam, 'rb')
-    refs = bamfile.references
-    bam_start = start - 2
-    bam_start = max(0, bam_start)
+    count = sum(1 for r in bamfile.fetch(region, multiple_iterators=True)
+                if not r.flag & filter_exclude)
+    bamfile.close()
+    return count
+
+
+def count_valid_contacts(inbam, filter_exclude, ncpus=8):
+    """
+    Counts the number of contacts (pairs of read-ends) passing the filters in
+    a TADbit BAM file. Only the filtering flags are read, from the sidecar
+    index of the BAM if it is up to date (see
+    :func:`pytadbit.parsers.contact_index.build_contact_index`).
+
+    :param inbam: path to a TADbit BAM file
+    :param filter_exclude: reads with any of these bits in their filtering
+       flag are not counted
+    :param 8 ncpus: number of cpus used to read the BAM file (one chromosome
+       per process)
+
+    :returns: number of contacts, each one being stored twice in the BAM file
+    """
+    index = get_contact_index(inbam)
+    if index:
+        count = sum(int(((index.reader.read('flag:' + crm) &
+                          filter_exclude) == 0).sum())
+                    for crm in index.references)
+        index.close()
+        return count / 2
+    bamfile = AlignmentFile(inbam, 'rb')
+    regions = bamfile.references
+    bamfile.close()
+    pool = mu.Pool(ncpus)
+    procs = [pool.apply_async(_count_valid_reads,
+                              args=(inbam, filter_exclude, region))
+             for region in regions]
+    pool.close()
+    pool.join()
+    return sum(p.get() for p in procs) / 2
+
+
+def sampling_fraction(inbam, filter_exclude, downsample_to=None,
+                      fraction=None, ncpus=8, verbose=False):
+    """
+    :param None downsample_to: number of contacts (pairs of read-ends passing
+       the filters) to sample
+    :param None fraction: fraction of contacts to sample (ignored if
+       downsample_to is given)
+
+    :returns: the fraction of reads to keep, or None to keep them all
+    """
+    if downsample_to:
+        total = count_valid_contacts(inbam, filter_exclude, ncpus=ncpus)
+        if verbose:
+            printime('  - Downsampling %d contacts to %d' % (total,
+                                                           downsample_to))
+        if downsample_to >= total:
+            warn('WARNING: only %d valid contacts, no downsampling' % total)
+            return None
+        return downsample_to / float(total)
+    if fraction is None or fraction >= 1:
+        return None
+    if fraction <= 0:
+        raise Exception('ERROR: fraction of reads to keep should be positive')
+    return fraction
+
+
+def _read_bam_frag(inbam, filter_exclude, offsets, bin_coords, rand_hash,
+                   resolution, tmpdir, region, start, end,
+                   half=False, sum_columns=False, fraction=None, seed=0):
+    """
+    Counts the interactions of the reads found in a chunk of the BAM file, and
+    saves them as a NumPy array (see CHUNK_DTYPE).
+
+    As chunks are fetched with an overlap (reads overlapping the start of the
+    chunk are also returned by pysam), only the reads starting in the bins of
+    the chunk are counted.
+
+    :param offsets: array with the first bin of each chromosome in the genome
+       (in the order of the BAM header)
+    :param bin_coords: coordinates of the matrix in the genome (start_bin1,
+       end_bin1, start_bin2, end_bin2)
+
+    If resolution is a list of resolutions (offsets and bin_coords being then
+    lists of the corresponding values), the interactions are counted at all
+    resolutions while reading the chunk once, and one array is saved per
+    resolution. The chunk is defined at the largest resolution.
+
+    :param False sum_columns: if True, returns the marginals of the chunk (see
+       :func:`_sum_chunk_columns`)
+    :param None fraction: if given, only this fraction of the reads is
+       counted (see :func:`sample_reads`)
+    :param 0 seed: seed of the sampling of reads
+    """
+    multi = isinstance(resolution, (list, tuple))
+    if not multi:
+        resolution = [resolution]
+        offsets    = [offsets]
+        bin_coords = [bin_coords]
+    bamfile = AlignmentFile(inbam, 'rb')
+    chunk_reso = max(resolution)
+    first_pos = start / chunk_reso * chunk_reso
+    last_pos  = ((end - 1) / chunk_reso + 1) * chunk_reso
+    bam_start = first_pos - 2
+    bam_start = max(0, bam_start)  # coords starts at 0
     try:
-        dico = {}
+        crms1 = array('i')
+        poss1 = array('i')
+        crms2 = array('i')
+        poss2 = array('i')
+        hashes = array('I')
         for r in bamfile.fetch(region=region,
-                               start=bam_start, end=end,  # coords starts at 0
+                               start=bam_start, end=last_pos,
                                multiple_iterators=True):
             if r.flag & filter_exclude:
                 continue
-            crm1 = r.reference_name
             pos1 = r.reference_start + 1
-            crm2 = refs[r.mrnm]
-            pos2 = r.mpos + 1
-            try:
-                pos1 = sections1[(crm1, pos1 / resolution)]
-                pos2 = sections2[(crm2, pos2 / resolution)]
-            except KeyError:
-                continue  # not in the subset matrix we want
-            crm = crm1 * (crm1 == crm2)
-            try:
-                dico[(crm, pos1, pos2)] += 1
-            except KeyError:
-                dico[(crm, pos1, pos2)] = 1
-            # print '%-50s %5s %9s %5s %9s' % (r.query_name,
-            #                                  crm1, r.reference_start + 1,
-            #                                  crm2, r.mpos + 1)
-        if half:
-            for c, i, j in dico:
-                if i < j:
-                    del dico[(c, i, j)]
-        out = open(os.path.join(tmpdir, '_tmp_%s' % (rand_hash),
-                                '%s:%d-%d.tsv' % (region, start, end)), 'w')
-        out.write(''.join('%s\t%d\t%d\t%d\n' % (c, a, b, v)
-                          for (c, a, b), v in dico.iteritems()))
-        out.close()
+            if not first_pos <= pos1 < last_pos:
+                continue  # belongs to the previous chunk
+            crms1.append(r.reference_id)
+            poss1.append(pos1)
+            crms2.append(r.mrnm)
+            poss2.append(r.mpos + 1)
+            if fraction:
+                hashes.append(crc32(r.query_name) & 0xFFFFFFFF)
+        crms1 = _int_array(crms1)
+        poss1 = _int_array(poss1)
+        crms2 = _int_array(crms2)
+        poss2 = _int_array(poss2)
+        if fraction:
+            keep = sample_reads(np.frombuffer(hashes, dtype=np.uint32)
+                                if hashes else [], fraction, seed)
+            crms1 = crms1[keep]
+            poss1 = poss1[keep]
+            crms2 = crms2[keep]
+            poss2 = poss2[keep]
+        crms = np.where(crms1 == crms2, crms1, -1)
+        sums = []
+        for reso, offs, (start_bin1, end_bin1,
+                         start_bin2, end_bin2) in zip(resolution, offsets,
+                                                      bin_coords):
+            rows = offs[crms1] + poss1 / reso - start_bin1
+            cols = offs[crms2] + poss2 / reso - start_bin2
+            # only the bins of the subset matrix we want
+            keep = ((rows >= 0) & (rows < end_bin1 - start_bin1) &
+                    (cols >= 0) & (cols < end_bin2 - start_bin2))
+            dico = _count_chunk(rows[keep], cols[keep], crms[keep], half)
+            np.save(_chunk_fname(tmpdir, rand_hash, region, start, end, reso),
+                    dico)
+            if sum_columns:
+                sums.append(_sum_chunk_columns(dico))
         if sum_columns:
-            sumcol = {}
-            cisprc = {}
-            for (c, i, j), v in dico.iteritems():
-                # out.write('%d\t%d\t%d\n' % (i, j, v))
-                try:
-                    sumcol[i] += v
-                    cisprc[i][all_bins[i][0] == all_bins[j][0]] += v
-                except KeyError:
-                    sumcol[i]  = v
-                    cisprc[i]  = [0, 0]
-                    cisprc[i][all_bins[i][0] == all_bins[j][0]] += v
-            return sumcol, cisprc
+            return sums if multi else sums[0]
     except Exception, e:
         exc_type, exc_obj, exc_tb = exc_info()
         fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
@@ -393,12 +766,54 @@ def _read_bam_frag(inbam, filter_exclude, all_bins, sections1, sections2,
         print(exc_type, fname, exc_tb.tb_lineno)
 
 
-def read_bam(inbam, filter_exclude, resolution, ncpus=8,
-             region1=None, start1=None, end1=None,
-             region2=None, start2=None, end2=None, nchunks=100,
-             tmpdir='.', verbose=True, normalize=False, max_size=None):
+def _count_chunk(rows, cols, crms, half=False):
+    """
+    Counts the number of reads per pair of bins.
 
-    bamfile = AlignmentFile(inbam, 'rb')
+    :param rows: array with the row of each read
+    :param cols: array with the column of each read
+    :param crms: array with the chromosome index of each read (-1 for
+       inter-chromosomal)
+
+    :returns: a NumPy array with the interactions (see CHUNK_DTYPE)
+    """
+    keys = rows.astype(np.int64) << 32 | cols
+    keys, first, counts = np.unique(keys, return_index=True,
+                                    return_counts=True)
+    dico = np.empty(len(keys), dtype=CHUNK_DTYPE)
+    dico['crm']   = crms[first]
+    dico['row']   = rows[first]
+    dico['col']   = cols[first]
+    dico['count'] = counts
+    if half:
+        dico = dico[dico['row'] >= dico['col']]
+    return dico
+
+
+def _sum_chunk_columns(dico):
+    """
+    :returns: the rows with interactions (sorted), and the sum of their
+       interactions and of their cis interactions
+    """
+    rows, index = np.unique(dico['row'], return_inverse=True)
+    counts = dico['count'].astype(np.int64)
+    total = np.bincount(index, weights=counts, minlength=len(rows))
+    cis   = np.bincount(index, weights=counts * (dico['crm'] >= 0),
+                        minlength=len(rows))
+    return rows, total.astype(np.int64), cis.astype(np.int64)
+
+
+def _bam_bins(bamfile, resolution, region1=None, start1=None, end1=None,
+              region2=None, start2=None, end2=None):
+    """
+    Defines the bins of the genome, and the bins of the regions wanted, at a
+    given resolution.
+
+    :returns: number of bins per chromosome, array with the first bin of each
+       chromosome in the genome (in the order of the BAM header), and the
+       coordinates of the matrix in the genome (start_bin1, end_bin1,
+       start_bin2, end_bin2)
+    """
     sections = OrderedDict(zip(bamfile.references,
                                [x / resolution + 1 for x in bamfile.lengths]))
     # get chromosomes and genome sizes
@@ -407,27 +822,14 @@ def read_bam(inbam, filter_exclude, resolution, ncpus=8,
     for crm in sections:
         section_pos[crm] = (total, total + sections[crm])
         total += sections[crm]
-
-    # define genomic bins
-    bins = []
-    for crm in sections:
-        len_crm = sections[crm]
-        bins.extend([(crm, i) for i in xrange(len_crm)])
-    if not bins:
-        raise Exception('ERROR: Chromosome %s smaller than bin size\n' % (crm))
+    if not total:
+        raise Exception('ERROR: no chromosome found in BAM header\n')
+    offsets = np.array([section_pos[crm][0] for crm in sections],
+                       dtype=np.int64)
 
     # define start, end position of region to grab
-    start_bin1 = 0
-    end_bin1   = len(bins) + 1
-    regions = bamfile.references
-    if region1:
-        regions = [region1]
-        if region2:
-            regions.append(region2)
-    else:
-        total = len(bins)
-        if start1 is not None or end1:
-            raise Exception('ERROR: Cannot use start/end1 without region')
+    if not region1 and (start1 is not None or end1):
+        raise Exception('ERROR: Cannot use start/end1 without region')
 
     if start1 is not None:
         start_bin1 = section_pos[region1][0] + start1 / resolution
@@ -436,95 +838,274 @@ def read_bam(inbam, filter_exclude, resolution, ncpus=8,
             start_bin1 = section_pos[region1][0]
         else:
             start_bin1 = 0
-        start1 = 0
     if end1 is not None:
         end_bin1 = section_pos[region1][0] + end1 / resolution
     else:
         if region1:
             end_bin1 = section_pos[region1][1]
-            end1 = sections[region1] * resolution
         else:
             end_bin1 = total
-            end1 = total * resolution
-
-    # define chunks, using at most 100 sub-divisions of region1
-    total = end_bin1 - start_bin1
-    regs  = []
-    begs  = []
-    ends  = []
-
-    njobs = min(total, nchunks) + 1
 
-    nbins = total / njobs + 1
-    for i in xrange(start_bin1, end_bin1, nbins):
-        if i + nbins > end_bin1:  # make sure that we stop at the right place
-            nbins = end_bin1 - i
-        try:
-            (crm1, beg1), (crm2, fin2) = bins[i], bins[i + nbins - 1]
-        except IndexError:
-            (crm1, beg1), (crm2, fin2) = bins[i], bins[-1]
-        if crm1 != crm2:
-            fin1 = sections[crm1]
-            beg2 = 0
-            regs.append(crm1)
-            regs.append(crm2)
-            begs.append(beg1 * resolution)
-            begs.append(beg2 * resolution)
-            ends.append(fin1 * resolution + resolution)  # last nt included
-            ends.append(fin2 * resolution + resolution - 1)  # last nt not included (overlap with next window)
-        else:
-            regs.append(crm1)
-            begs.append(beg1 * resolution)
-            ends.append(fin2 * resolution + resolution - 1)
-    ends[-1] += 1  # last nucleotide included
-    # reduce dictionaries
-    all_bins = []
-    seenbins = set()
-    for crm in regions:
-        beg_crm = section_pos[crm][0]
-        if region1:
-            start = start_bin1 - beg_crm
-            end   = end_bin1   - beg_crm
-        else:
-            start = 0
-            end   = section_pos[crm][1] - section_pos[crm][0]
-        all_bins.extend([(crm, i) for i in xrange(start, end)
-                          if not (crm, i) in seenbins])
-        seenbins = set(all_bins)
-    del(seenbins)
-
-    bins_dict1 = dict((j, i) for i, j in enumerate(all_bins))
     if region2:
         if not region2 in section_pos:
             raise Exception('ERROR: chromosome %s not found' % region2)
-        bins = []
-        beg_crm = section_pos[region2][0]
         if start2 is not None:
             start_bin2 = section_pos[region2][0] + start2 / resolution
         else:
             start_bin2 = section_pos[region2][0]
-            start2 = 0
         if end2 is not None:
             end_bin2   = section_pos[region2][0] + end2   / resolution
         else:
             end_bin2   = section_pos[region2][1]
-            end2       = sections[region2] * resolution
-        start = start_bin2 - beg_crm
-        end   = end_bin2   - beg_crm
-        bins = [(region2, i) for i in xrange(start, end)]
-        bins_dict2 = dict([(j, i) for i, j in enumerate(bins)])
     else:
         start_bin2 = start_bin1
         end_bin2 = end_bin1
-        bins_dict2 = bins_dict1
+    bin_coords = start_bin1, end_bin1, start_bin2, end_bin2
+    return sections, offsets, bin_coords
 
-    size1 = end_bin1 - start_bin1
-    size2 = end_bin2 - start_bin2
-    if verbose:
-        printime('\n  (Matrix size %dx%d)' % (size1, size2))
-    if max_size and max_size < size1 * size2:
-        raise Exception(('ERROR: matrix too large ({0}x{1}) should be at most '
-                         '{2}x{2}').format(size1, size2, int(max_size**0.5)))
+
+def _bai_linear_index(inbam):
+    """
+    Reads the linear index of the BAI file of a BAM file.
+
+    :param inbam: path to BAM file
+
+    :returns: a list with, for each reference of the BAM file, an array with
+       the file offsets of the first read overlapping each window of 16 kb, and
+       the file offset of the end of the reads of the reference (None if no
+       read). File offsets are the offsets of the compressed BGZF blocks. None
+       if no index is found.
+    """
+    for fnam in (inbam + '.bai', os.path.splitext(inbam)[0] + '.bai'):
+        if os.path.exists(fnam):
+            break
+    else:
+        return None
+    fhandler = open(fnam, 'rb')
+    if fhandler.read(4) != 'BAI\1':
+        fhandler.close()
+        return None
+    n_ref, = unpack('<i', fhandler.read(4))
+    index = []
+    for _ in xrange(n_ref):
+        n_bin, = unpack('<i', fhandler.read(4))
+        ref_end = None
+        for _ in xrange(n_bin):
+            bin_id, n_chunk = unpack('<Ii', fhandler.read(8))
+            chunks = np.frombuffer(fhandler.read(16 * n_chunk), dtype='<u8')
+            if bin_id == BAI_PSEUDO_BIN:  # reference span and read counts
+                ref_end = int(chunks[1]) >> 16
+        n_intv, = unpack('<i', fhandler.read(4))
+        offsets = np.frombuffer(fhandler.read(8 * n_intv), dtype='<u8')
+        index.append(((offsets >> np.uint64(16)).astype(np.int64), ref_end))
+    fhandler.close()
+    return index
+
+
+def _bin_weights(inbam, sections, resolution):
+    """
+    Estimates the number of reads starting in each bin of the genome, from the
+    number of reads mapped on each chromosome, distributed along the
+    chromosome proportionally to the size of the BAM file covering each window
+    of 16 kb (from the linear index of the BAI file).
+
+    :param inbam: path to BAM file
+    :param sections: dictionary with the number of bins of each chromosome
+    :param resolution: size of the bins
+
+    :returns: an array with the estimated number of reads per bin (ones if the
+       BAM file has no index)
+    """
+    index = _bai_linear_index(inbam)
+    if index is None:
+        return np.ones(sum(sections.values()))
+    bamfile = AlignmentFile(inbam, 'rb')
+    mapped = dict((stat.contig, stat.mapped)
+                  for stat in bamfile.get_index_statistics())
+    weights = []
+    for crm, (offsets, ref_end) in zip(bamfile.references, index):
+        nbins = sections[crm]
+        edges = np.arange(nbins + 1) * resolution
+        nreads = mapped.get(crm, 0)
+        if not nreads or ref_end is None or not len(offsets):
+            weights.append(np.ones(nbins) * float(nreads) / nbins)
+            continue
+        # windows without reads have offset 0 before the first read
+        offsets = np.maximum.accumulate(offsets)
+        size = np.diff(np.append(offsets, max(ref_end, offsets[-1])))
+        if not size.sum():  # all reads in one compressed block
+            size = np.ones(len(size))
+        reads = np.append(0, np.cumsum(size * float(nreads) / size.sum()))
+        windows = np.arange(len(reads)) * BAI_WINDOW
+        weights.append(np.diff(np.interp(edges, windows, reads)))
+    bamfile.close()
+    return np.concatenate(weights)
+
+
+def plan_chunks(inbam, sections, start_bin, end_bin, resolution, nchunks):
+    """
+    Cuts a region of the genome into chunks holding roughly the same number of
+    reads (estimated from the BAM index, see :func:`_bin_weights`). Chunks
+    start and end on bin boundaries and do not span several chromosomes.
+
+    :param inbam: path to BAM file
+    :param sections: dictionary with the number of bins of each chromosome,
+       in the order of the BAM header
+    :param start_bin: first bin of the region
+    :param end_bin: last bin of the region (not included)
+    :param resolution: size of the bins
+    :param nchunks: number of chunks wanted (chromosome boundaries may add
+       some)
+
+    :returns: list of chromosome names, of start positions, of end positions
+       (not included) and of estimated number of reads of each chunk
+    """
+    weights = _bin_weights(inbam, sections, resolution)[start_bin:end_bin]
+    nbins = end_bin - start_bin
+    cumw = np.append(0, np.cumsum(weights))
+    cuts = set([0, nbins])
+    if cumw[-1] > 0:
+        targets = np.arange(1, nchunks) * cumw[-1] / nchunks
+        cuts.update(np.searchsorted(cumw, targets).tolist())
+    else:
+        cuts.update(range(0, nbins, nbins / nchunks + 1))
+    crm_starts = np.cumsum([0] + sections.values())
+    cuts.update((crm_starts - start_bin).tolist())
+    cuts = sorted(c for c in cuts if 0 <= c <= nbins)
+    names = sections.keys()
+    regs  = []
+    begs  = []
+    ends  = []
+    nreads = []
+    for beg, end in zip(cuts[:-1], cuts[1:]):
+        icrm = np.searchsorted(crm_starts, beg + start_bin, side='right') - 1
+        regs.append(names[icrm])
+        begs.append((beg + start_bin - crm_starts[icrm]) * resolution)
+        ends.append((end + start_bin - crm_starts[icrm]) * resolution)
+        nreads.append(cumw[end] - cumw[beg])
+    return regs, begs, ends, nreads
+
+
+def largest_first(nreads):
+    """
+    :param nreads: estimated number of reads of each chunk
+
+    :returns: the indexes of the chunks, sorted by decreasing number of reads
+       (so that the longest jobs are started first)
+    """
+    return sorted(range(len(nreads)), key=lambda i: -nreads[i])
+
+
+def timed_call(func, *args):
+    """
+    Calls a function and returns the time it took (in seconds), and its result
+    """
+    t0 = time()
+    result = func(*args)
+    return time() - t0, result
+
+
+def chunk_timing_report(chunks, nreads, times, fnam=None, verbose=True):
+    """
+    Summarizes the time spent parsing each chunk of a BAM file, to check the
+    balance between chunks.
+
+    :param chunks: list of chromosome names, of start and of end positions of
+       each chunk
+    :param nreads: estimated number of reads of each chunk
+    :param times: time spent (in seconds) parsing each chunk
+    :param None fnam: path to a file where to write the time spent on each
+       chunk
+    :param True verbose: print the time spent on the fastest, on the slowest
+       chunk and on average
+    """
+    if fnam:
+        out = open(fnam, 'w')
+        out.write('# region\tstart\tend\testimated reads\tseconds\n')
+        for (region, beg, end), nread, tim in zip(zip(*chunks), nreads, times):
+            out.write('%s\t%d\t%d\t%d\t%.3f\n' % (region, beg, end, nread, tim))
+        out.close()
+    if not verbose or not times:
+        return
+    slowest = max(range(len(times)), key=lambda i: times[i])
+    print ('     chunk times: min %.1fs, mean %.1fs, max %.1fs (%s:%d-%d, ~%d '
+           'reads)\n') % (min(times), sum(times) / len(times), times[slowest],
+                          chunks[0][slowest], chunks[1][slowest],
+                          chunks[2][slowest], nreads[slowest])
+
+
+def read_bam(inbam, filter_exclude, resolution, ncpus=8,
+             region1=None, start1=None, end1=None,
+             region2=None, start2=None, end2=None, nchunks=100,
+             tmpdir='.', verbose=True, max_size=None,
+             timing_report=None, fraction=None, seed=0):
+    """
+    Parses a BAM file in chunks, counting the interactions of each chunk into
+    a temporary file. Chunks hold roughly the same number of reads (see
+    :func:`plan_chunks`), and the largest are parsed first.
+
+    :param resolution: resolution, or list of resolutions, at which to count
+       interactions. With a list, the BAM file is read only once and the
+       interactions are counted at all resolutions at the same time (each
+       resolution should divide the largest one).
+    :param 100 nchunks: number of chunks into which to cut the BAM
+    :param None timing_report: path to a file where to write the time spent
+       parsing each chunk
+    :param None fraction: if given, only this fraction of the reads is
+       counted (see :func:`sample_reads`)
+    :param 0 seed: seed of the sampling of reads
+
+    :returns: the list of regions, the hash of the temporary folder, the
+       coordinates of the matrix in the genome (a dictionary of coordinates per
+       resolution if resolution is a list) and the chunks parsed
+    """
+    multi = isinstance(resolution, (list, tuple))
+    resolutions = list(resolution) if multi else [resolution]
+    chunk_reso = max(resolutions)
+    if any(chunk_reso % reso for reso in resolutions):
+        raise Exception('ERROR: all resolutions should divide the largest one '
+                        '(%d)' % chunk_reso)
+
+    bamfile = AlignmentFile(inbam, 'rb')
+    regions = bamfile.references
+    if region1:
+        regions = [region1]
+        if region2:
+            regions.append(region2)
+
+    all_coords = {}
+    all_offsets = []
+    for reso in resolutions:
+        sections, offsets, bin_coords = _bam_bins(
+            bamfile, reso, region1, start1, end1, region2, start2, end2)
+        start_bin1, end_bin1, start_bin2, end_bin2 = bin_coords
+        size1 = end_bin1 - start_bin1
+        size2 = end_bin2 - start_bin2
+        if verbose:
+            printime('\n  (Matrix size %dx%d)' % (size1, size2))
+        if max_size and max_size < size1 * size2:
+            raise Exception(('ERROR: matrix too large ({0}x{1}) should be at '
+                             'most {2}x{2}').format(size1, size2,
+                                                    int(max_size**0.5)))
+        all_coords[reso] = bin_coords
+        all_offsets.append(offsets)
+        if reso == chunk_reso:
+            chunk_bins = sections, offsets, bin_coords
+
+    # define chunks, with similar number of reads, at the largest resolution
+    # (so that each chunk holds complete rows at all resolutions)
+    sections, offsets, bin_coords = chunk_bins
+    start_bin, end_bin = bin_coords[:2]
+    if end1 is not None:
+        # the last rows at the finest resolution may end after the last row
+        # at the largest one
+        fine = min(resolutions)
+        icrm = sections.keys().index(region1)
+        end_bin = min(offsets[icrm] + sections[region1],
+                      offsets[icrm] + (end1 / fine * fine + chunk_reso - 1) /
+                      chunk_reso)
+    regs, begs, ends, nreads = plan_chunks(inbam, sections, start_bin,
+                                           end_bin, chunk_reso, nchunks)
 
     pool = mu.Pool(ncpus)
     # create random hash associated to the run:
@@ -534,31 +1115,46 @@ def read_bam(inbam, filter_exclude, resolution, ncpus=8,
     if verbose:
         printime('\n  - Parsing BAM (%d chunks)' % (len(regs)))
     mkdir(os.path.join(tmpdir, '_tmp_%s' % (rand_hash)))
-    # empty all_bins array if we are not going to normalize
-    if not normalize:
-        all_bins = []
-    procs = []
-    for i, (region, b, e) in enumerate(zip(regs, begs, ends)):
+    # bins are computed from the offset of each chromosome in the genome
+    if multi:
+        resolution = resolutions
+        offsets    = all_offsets
+        bin_coords = [all_coords[reso] for reso in resolutions]
+    else:
+        offsets    = all_offsets[0]
+    procs = {}
+    times = {}
+    for i in largest_first(nreads):
+        args = (_read_bam_frag, inbam, filter_exclude, offsets, bin_coords,
+                rand_hash, resolution, tmpdir, regs[i], begs[i], ends[i],
+                False, False, fraction, seed)
         if ncpus == 1:
-            _read_bam_frag(inbam, filter_exclude, all_bins,
-                           bins_dict1, bins_dict2, rand_hash,
-                           resolution, tmpdir, region, b, e,)
+            times[i] = timed_call(*args)
         else:
-            procs.append(pool.apply_async(
-                _read_bam_frag, args=(inbam, filter_exclude, all_bins,
-                                      bins_dict1, bins_dict2, rand_hash,
-                                      resolution, tmpdir, region, b, e,)))
+            procs[i] = pool.apply_async(timed_call, args=args)
     pool.close()
     if verbose:
-        print_progress(procs)
+        print_progress(procs.values())
     pool.join()
-    bin_coords = start_bin1, end_bin1, start_bin2, end_bin2
+    times.update((i, procs[i].get()) for i in procs)
+    times = [times[i][0] for i in xrange(len(regs))]
     chunks = regs, begs, ends
-    return regions, rand_hash, bin_coords, chunks
+    chunk_timing_report(chunks, nreads, times, timing_report, verbose)
+    if multi:
+        return regions, rand_hash, all_coords, chunks
+    return regions, rand_hash, all_coords[resolution], chunks
 
 
-def _iter_matrix_frags(chunks, tmpdir, rand_hash, clean=False, verbose=True,
-                       include_chunk_count=False):
+def _iter_chunk_arrays(chunks, tmpdir, rand_hash, resolution, clean=False,
+                       verbose=True):
+    """
+    Iterates over the interactions parsed from a BAM file, chunk by chunk.
+
+    :param resolution: resolution of the interactions to load
+
+    :yields: the index of the chunk, and a NumPy array with the interactions
+       of the chunk (see CHUNK_DTYPE)
+    """
     if verbose:
         stdout.write('     ')
     countbin = 0
@@ -571,14 +1167,8 @@ def _iter_matrix_frags(chunks, tmpdir, rand_hash, clean=False, verbose=True,
             stdout.write('.')
             stdout.flush()
 
-        fname = os.path.join(tmpdir, '_tmp_%s' % (rand_hash),
-                             '%s:%d-%d.tsv' % (region, start, end))
-        for l in open(fname):
-            c, a, b, v = l.split('\t')
-            if include_chunk_count:
-                yield countbin, c, int(a), int(b), int(v)
-            else:
-                yield c, int(a), int(b), int(v)
+        fname = _chunk_fname(tmpdir, rand_hash, region, start, end, resolution)
+        yield countbin, np.load(fname)
         if clean:
             os.system('rm -f %s' % fname)
     if verbose:
@@ -586,6 +1176,266 @@ def _iter_matrix_frags(chunks, tmpdir, rand_hash, clean=False, verbose=True,
                             '%s/%s' % (len(chunks[0]),len(chunks[0])))
 
 
+def _iter_matrix_frags(chunks, tmpdir, rand_hash, resolution, refs,
+                       clean=False, verbose=True, include_chunk_count=False):
+    """
+    Iterates over the interactions parsed from a BAM file.
+
+    :param resolution: resolution of the interactions to load
+    :param refs: names of the chromosomes, in the order of the BAM header
+
+    :yields: chromosome name ('' for inter-chromosomal interactions), row,
+       column and number of reads of each interaction
+    """
+    return _iter_array_frags(
+        _iter_chunk_arrays(chunks, tmpdir, rand_hash, resolution,
+                           clean=clean, verbose=verbose),
+        refs, include_chunk_count=include_chunk_count)
+
+
+def _iter_array_frags(arrays, refs, include_chunk_count=False):
+    """
+    :param arrays: iterable of chunk indexes and arrays of interactions (see
+       CHUNK_DTYPE)
+    :param refs: names of the chromosomes, in the order of the BAM header
+
+    :yields: chromosome name ('' for inter-chromosomal interactions), row,
+       column and number of reads of each interaction
+    """
+    names = list(refs) + ['']  # index -1 for inter-chromosomal
+    for countbin, dico in arrays:
+        for c, a, b, v in zip(dico['crm'].tolist(), dico['row'].tolist(),
+                              dico['col'].tolist(), dico['count'].tolist()):
+            if include_chunk_count:
+                yield countbin, names[c], a, b, v
+            else:
+                yield names[c], a, b, v
+
+
+def _iter_matrix_blocks(chunks, tmpdir, rand_hash, resolution, clean=False,
+                        verbose=True):
+    """
+    Iterates over the interactions parsed from a BAM file, chunk by chunk.
+
+    :param resolution: resolution of the interactions to load
+
+    :yields: NumPy arrays of rows, columns and values of each chunk
+    """
+    for _, dico in _iter_chunk_arrays(chunks, tmpdir, rand_hash, resolution,
+                                      clean=clean, verbose=verbose):
+        yield dico['row'], dico['col'], dico['count']
+
+
+# fields of the batches of contacts yielded by iter_contacts
+CONTACT_DTYPE = np.dtype([('crm1'   , np.int32), ('pos1'   , np.int32),
+                          ('crm2'   , np.int32), ('pos2'   , np.int32),
+                          ('strand1', np.int8 ), ('strand2', np.int8 ),
+                          ('flag'   , np.uint16), ('tc'    , np.int16)])
+
+# resolution at which the BAM is cut into chunks to iterate over contacts
+CONTACT_CHUNK_RESO = 10000
+
+
+def _fetch_contacts(inbam, filter_exclude, region, start, end):
+    """
+    Gets the reads of a chunk of a BAM file, with a first read-end starting
+    in [start, end) (1-based coordinates).
+
+    :returns: a NumPy array of contacts (see CONTACT_DTYPE)
+    """
+    bamfile = AlignmentFile(inbam, 'rb')
+    crms1 = array('i')
+    poss1 = array('i')
+    crms2 = array('i')
+    poss2 = array('i')
+    strands1 = array('b')
+    strands2 = array('b')
+    flags = array('i')
+    tcs   = array('i')
+    has_tc = has_strands = None
+    for r in bamfile.fetch(region=region, start=max(0, start - 2), end=end,
+                           multiple_iterators=True):
+        if r.flag & filter_exclude:
+            continue
+        pos1 = r.reference_start + 1
+        if not start <= pos1 < end:
+            continue  # belongs to the previous chunk
+        crms1.append(r.reference_id)
+        poss1.append(pos1)
+        crms2.append(r.mrnm)
+        poss2.append(r.mpos + 1)
+        flags.append(r.flag)
+        if has_tc is None:
+            has_tc      = r.has_tag('TC')
+            has_strands = r.has_tag('S1')  # 'short' BAM files have no strand
+        if has_tc:
+            tcs.append(r.get_tag('TC'))
+        if has_strands:
+            strands1.append(r.get_tag('S1'))
+            strands2.append(r.get_tag('S2'))
+    bamfile.close()
+    contacts = np.zeros(len(crms1), dtype=CONTACT_DTYPE)
+    contacts['crm1'] = _int_array(crms1)
+    contacts['pos1'] = _int_array(poss1)
+    contacts['crm2'] = _int_array(crms2)
+    contacts['pos2'] = _int_array(poss2)
+    contacts['flag'] = _int_array(flags)
+    contacts['tc']   = _int_array(tcs) if has_tc else 1
+    if has_strands:
+        contacts['strand1'] = np.frombuffer(strands1, dtype=np.int8)
+        contacts['strand2'] = np.frombuffer(strands2, dtype=np.int8)
+    else:
+        contacts['strand1'] = contacts['strand2'] = -1
+    return contacts
+
+
+def _fetch_contacts_star(args):
+    return _fetch_contacts(*args)
+
+
+def iter_contacts(inbam, filter_exclude=(1, 2, 3, 4, 6, 7, 8, 9, 10),
+                  region=None, start=None, end=None, batch_size=100000,
+                  ncpus=1, nchunks=100):
+    """
+    Iterates over the contacts of a TADbit BAM file, by batches stored in
+    NumPy record arrays with the fields (see CONTACT_DTYPE):
+
+       - crm1: index of the chromosome of the first read-end (in the order of
+         the BAM header)
+       - pos1: position of the first read-end (1-based)
+       - crm2: index of the chromosome of the second read-end
+       - pos2: position of the second read-end (1-based)
+       - strand1: strand of the first read-end (1: positive, 0: negative,
+         -1: not stored in the BAM file)
+       - strand2: strand of the second read-end
+       - flag: filtering flag (see codes in the BAM header)
+       - tc: number of times a sequenced fragment is involved in a pairwise
+         contact (TC tag, 1 if not stored in the BAM file)
+
+    Each contact is stored twice in TADbit BAM files, once from each
+    read-end, and is thus yielded twice when iterating over the whole genome.
+
+    :param inbam: path to a TADbit BAM file (sorted and indexed)
+    :param (1, 2, 3, 4, 6, 7, 8, 9, 10) filter exclude: filters to define the
+       set of valid pair of reads.
+    :param None region: chromosome name of the first read-end, if None, all
+       the genome
+    :param None start: start position of the first read-end (1-based,
+       included)
+    :param None end: end position of the first read-end (not included)
+    :param 100000 batch_size: maximum number of contacts per batch
+    :param 1 ncpus: number of processes reading the BAM file. Chunks of the
+       BAM (holding roughly the same number of reads) are read in parallel,
+       and batches are yielded in the order of the BAM file.
+    :param 100 nchunks: number of chunks into which to cut the BAM file
+
+    :yields: NumPy record arrays of contacts
+    """
+    if not isinstance(filter_exclude, int):
+        filter_exclude = filters_to_bin(filter_exclude)
+    bamfile = AlignmentFile(inbam, 'rb')
+    if region and end is not None:
+        length = bamfile.lengths[bamfile.references.index(region)]
+        # the bin of the end position is included
+        bin_end = (end + CONTACT_CHUNK_RESO - 1 if end + CONTACT_CHUNK_RESO - 1
+                   <= length else None)
+    else:
+        bin_end = None
+    sections, _, (start_bin, end_bin, _, _) = _bam_bins(
+        bamfile, CONTACT_CHUNK_RESO, region, start, bin_end)
+    bamfile.close()
+    regs, begs, ends, _ = plan_chunks(inbam, sections, start_bin, end_bin,
+                                      CONTACT_CHUNK_RESO, nchunks)
+    start = start or 0
+    end = end or float('inf')
+    jobs = [(inbam, filter_exclude, reg, max(beg, start), min(stop, end))
+            for reg, beg, stop in zip(regs, begs, ends)]
+    if ncpus > 1:
+        pool = mu.Pool(ncpus)
+        chunks = pool.imap(_fetch_contacts_star, jobs)
+    else:
+        chunks = (_fetch_contacts(*job) for job in jobs)
+    try:
+        for contacts in chunks:
+            for beg in xrange(0, len(contacts), batch_size):
+                yield contacts[beg:beg + batch_size]
+    finally:  # also when the iteration is stopped before the end
+        if ncpus > 1:
+            pool.terminate()
+
+
+def get_contact_storage(inbam, resolution,
+                        filter_exclude=(1, 2, 3, 4, 6, 7, 8, 9, 10),
+                        region=None, size=None, dirname=None, clean=True,
+                        tmpdir='.', ncpus=8, nchunks=100, verbose=False,
+                        downsample_to=None, fraction=None, seed=0):
+    """
+    Get the interaction matrix from a BAM file as sorted NumPy arrays (see
+    :class:`pytadbit.utils.hic_storage.ContactStorage`). Interactions are
+    never held in Python dictionaries, and can be written directly to disk.
+
+    :param inbam: path to BAM file (generated byt TADbit)
+    :param resolution: resolution at which we want to write the matrix. It can
+       also be a list of resolutions, in which case the BAM file is read only
+       once, and a dictionary of ContactStorage per resolution is returned
+    :param (1, 2, 3, 4, 6, 7, 8, 9, 10) filter exclude: filters to define the
+       set of valid pair of reads.
+    :param None region: chromosome name, if None, all genome will be loaded
+    :param None size: size of the matrix, by default the number of bins of the
+       region (or of the genome). With a list of resolutions, a dictionary of
+       sizes per resolution.
+    :param None dirname: path to an existing directory where to write the
+       arrays. If given, the returned storage is memory-mapped on these files.
+       With a list of resolutions, arrays are written in one sub-directory per
+       resolution.
+    :param '.' tmpdir: where to write temporary files
+    :param 8 ncpus: number of cpus to use to read the BAM file
+    :param 100 nchunks: maximum number of chunks into which to cut the BAM
+    :param None downsample_to: number of contacts to sample (see
+       :func:`get_matrix`)
+    :param None fraction: fraction of contacts to sample
+    :param 0 seed: seed of the sampling of contacts
+
+    :returns: a ContactStorage object
+    """
+    if not isinstance(filter_exclude, int):
+        filter_exclude = filters_to_bin(filter_exclude)
+
+    fraction = sampling_fraction(inbam, filter_exclude, downsample_to,
+                                 fraction, ncpus=ncpus, verbose=verbose)
+    _, rand_hash, bin_coords, chunks = read_bam(
+        inbam, filter_exclude, resolution, ncpus=ncpus, region1=region,
+        tmpdir=tmpdir, nchunks=nchunks, verbose=verbose, fraction=fraction,
+        seed=seed)
+
+    multi = isinstance(resolution, (list, tuple))
+    if not multi:
+        bin_coords = {resolution: bin_coords}
+        size = {resolution: size}
+    elif size is None:
+        size = {}
+
+    storages = {}
+    for reso in (resolution if multi else [resolution]):
+        start_bin, end_bin = bin_coords[reso][:2]
+        reso_dir = dirname
+        if dirname and multi:
+            reso_dir = os.path.join(dirname, str(reso))
+            mkdir(reso_dir)
+        if verbose:
+            printime('  - Getting matrices')
+        storages[reso] = ContactStorage.from_row_blocks(
+            _iter_matrix_blocks(chunks, tmpdir, rand_hash, reso, clean=clean,
+                                verbose=verbose),
+            size.get(reso) or end_bin - start_bin, dtype=np.uint32,
+            dirname=reso_dir)
+    if clean:
+        os.system('rm -rf %s' % (os.path.join(tmpdir, '_tmp_%s' % (rand_hash))))
+    if multi:
+        return storages
+    return storages[resolution]
+
+
 def get_biases_region(biases, bin_coords, check_resolution=None):
     """
     Retrieve biases, decay, and bad bins from a dictionary, and re-index it
@@ -627,7 +1477,8 @@ def get_matrix(inbam, resolution, biases=None,
                region1=None, start1=None, end1=None,
                region2=None, start2=None, end2=None, dico=None, clean=False,
                return_headers=False, tmpdir='.', normalization='raw', ncpus=8,
-               nchunks=100, verbose=False, max_size=None):
+               nchunks=100, verbose=False, max_size=None, use_index=True,
+               downsample_to=None, fraction=None, seed=0):
     """
     Get matrix from a BAM file containing interacting reads. The matrix
     will be extracted from the genomic BAM, the genomic coordinates of this
@@ -636,8 +1487,12 @@ def get_matrix(inbam, resolution, biases=None,
     than the second coodinate can be skipped.
 
     :param inbam: path to BAM file (generated byt TADbit)
-    :param resolution: resolution at which we want to write the matrix
-    :param biases: path to a file with biases
+    :param resolution: resolution at which we want to write the matrix. It can
+       also be a list of resolutions (each one dividing the largest), in which
+       case the BAM file is read only once and a dictionary with one matrix
+       per resolution is returned
+    :param biases: path to a file with biases (with a list of resolutions, a
+       dictionary of paths per resolution)
     :param (1, 2, 3, 4, 6, 7, 8, 9, 10) filter exclude: filters to define the
        set of valid pair of reads.
     :param 'raw' normalization: normalizations to use, can be 'decay',
@@ -660,6 +1515,22 @@ def get_matrix(inbam, resolution, biases=None,
     :param 8 ncpus: number of cpus to use to read the BAM file
     :param True verbose: speak
     :param 100 nchunks: maximum number of chunks into which to cut the BAM
+    :param None dico: object to fill with the interactions (e.g. an HiC_data
+       object). With a list of resolutions, a dictionary of objects per
+       resolution.
+    :param True use_index: if region1 is given and the BAM file has an up to
+       date sidecar index (see
+       :func:`pytadbit.parsers.contact_index.build_contact_index`), the
+       interactions are read from this index instead of the BAM file (except
+       when downsampling, as read names are not indexed)
+    :param None downsample_to: number of contacts (pairs of read-ends passing
+       the filters, in all the genome) to sample. Contacts are sampled
+       randomly while reading the BAM file, from a hash of their read names,
+       their final number is thus close to (not exactly) this number.
+    :param None fraction: fraction of contacts to sample (ignored if
+       downsample_to is given)
+    :param 0 seed: seed of the sampling of contacts, the same seed gives the
+       same sample of a BAM file (whatever the region or resolution)
 
     :returns: dictionary with keys being tuples of the indexes of interacting
        bins: dico[(bin1, bin2)] = interactions
@@ -668,17 +1539,105 @@ def get_matrix(inbam, resolution, biases=None,
     if not isinstance(filter_exclude, int):
         filter_exclude = filters_to_bin(filter_exclude)
 
+    fraction = sampling_fraction(inbam, filter_exclude, downsample_to,
+                                 fraction, ncpus=ncpus, verbose=verbose)
+
+    index = None
+    if (use_index and region1 and not fraction and
+        not isinstance(resolution, (list, tuple))):
+        index = get_contact_index(inbam)
+    if index:
+        return _get_matrix_from_index(
+            index, inbam, filter_exclude, resolution, biases, region1, start1,
+            end1, region2, start2, end2, normalization, dico, return_headers,
+            verbose, max_size)
+
     regions, rand_hash, bin_coords, chunks = read_bam(
         inbam, filter_exclude, resolution, ncpus=ncpus,
         region1=region1, start1=start1, end1=end1,
         region2=region2, start2=start2, end2=end2,
-        tmpdir=tmpdir, nchunks=nchunks, verbose=verbose, max_size=max_size)
+        tmpdir=tmpdir, nchunks=nchunks, verbose=verbose, max_size=max_size,
+        fraction=fraction, seed=seed)
 
     if region1:
         regions = [region1]
         if region2:
             regions.append(region2)
 
+    if isinstance(resolution, (list, tuple)):
+        biases = biases or {}
+        dico = dico or {}
+        matrices = dict((reso, _get_matrix_from_chunks(
+            inbam, reso, biases.get(reso),
+            _iter_chunk_arrays(chunks, tmpdir, rand_hash, reso, clean=clean,
+                               verbose=verbose),
+            regions, bin_coords[reso], (start1, start2), (end1, end2),
+            normalization, dico.get(reso), return_headers, verbose))
+                        for reso in resolution)
+    else:
+        matrices = _get_matrix_from_chunks(
+            inbam, resolution, biases,
+            _iter_chunk_arrays(chunks, tmpdir, rand_hash, resolution,
+                               clean=clean, verbose=verbose),
+            regions, bin_coords, (start1, start2), (end1, end2),
+            normalization, dico, return_headers, verbose)
+
+    if clean:
+        os.system('rm -rf %s' % (os.path.join(tmpdir, '_tmp_%s' % (rand_hash))))
+    return matrices
+
+
+def _get_matrix_from_index(index, inbam, filter_exclude, resolution, biases,
+                           region1, start1, end1, region2, start2, end2,
+                           normalization, dico, return_headers, verbose,
+                           max_size):
+    """
+    Gets the matrix of a region from the sidecar index of a BAM file (see
+    :func:`get_matrix`).
+    """
+    bamfile = AlignmentFile(inbam, 'rb')
+    regions = [region1]
+    if region2:
+        regions.append(region2)
+    _, offsets, bin_coords = _bam_bins(bamfile, resolution, region1, start1,
+                                       end1, region2, start2, end2)
+    start_bin1, end_bin1, start_bin2, end_bin2 = bin_coords
+    size1 = end_bin1 - start_bin1
+    size2 = end_bin2 - start_bin2
+    if verbose:
+        printime('\n  (Matrix size %dx%d)' % (size1, size2))
+    if max_size and max_size < size1 * size2:
+        raise Exception(('ERROR: matrix too large ({0}x{1}) should be at '
+                         'most {2}x{2}').format(size1, size2,
+                                                int(max_size**0.5)))
+    icrm1 = bamfile.references.index(region1)
+    icrm2 = bamfile.references.index(region2 or region1)
+    poss1, crms2, poss2 = index.contacts(
+        region1, (start_bin1 - offsets[icrm1]) * resolution,
+        (end_bin1 - offsets[icrm1]) * resolution,
+        region2 or region1, (start_bin2 - offsets[icrm2]) * resolution,
+        (end_bin2 - offsets[icrm2]) * resolution, filter_exclude)
+    index.close()
+    rows = offsets[icrm1] + poss1 / resolution - start_bin1
+    cols = offsets[crms2] + poss2 / resolution - start_bin2
+    crms = np.where(crms2 == icrm1, icrm1, -1).astype(np.int32)
+    return _get_matrix_from_chunks(
+        inbam, resolution, biases, [(0, _count_chunk(rows, cols, crms))],
+        regions, bin_coords, (start1, start2), (end1, end2), normalization,
+        dico, return_headers, verbose)
+
+
+def _get_matrix_from_chunks(inbam, resolution, biases, arrays, regions,
+                            bin_coords, starts, ends, normalization, dico,
+                            return_headers, verbose):
+    """
+    Gathers the interactions parsed by :func:`read_bam` at a given resolution
+    (see :func:`get_matrix`).
+
+    :param arrays: iterable of chunk indexes and arrays of interactions (see
+       CHUNK_DTYPE)
+    """
+    refs = AlignmentFile(inbam, 'rb').references
     if biases:
         bias1, bias2, decay, bads1, bads2 = get_biases_region(biases, bin_coords)
     elif normalization != 'raw':
@@ -715,28 +1674,119 @@ def get_matrix(inbam, resolution, biases=None,
     return_something = False
     if dico is None:
         return_something = True
-        dico = dict(((i, j), transform_value(c, i, j, v))
-                    for c, i, j, v in _iter_matrix_frags(
-                        chunks, tmpdir, rand_hash, clean=clean, verbose=verbose)
-                    if i not in bads1 and j not in bads2)
+        if normalization == 'raw' and not bads1 and not bads2:
+            dico = {}
+            for _, chunk in arrays:
+                dico.update(zip(zip(chunk['row'].tolist(),
+                                    chunk['col'].tolist()),
+                                chunk['count'].tolist()))
+        else:
+            dico = dict(((i, j), transform_value(c, i, j, v))
+                        for c, i, j, v in _iter_array_frags(arrays, refs)
+                        if i not in bads1 and j not in bads2)
         # pull all sub-matrices and write full matrix
     else: # dico probably an HiC data object
-        for _, i, j, v in _iter_matrix_frags(
-                chunks, tmpdir, rand_hash,
-                clean=clean, verbose=verbose):
+        for _, i, j, v in _iter_array_frags(arrays, refs):
             if i not in bads1 and j not in bads2:
                 dico[i, j] = v
 
-    if clean:
-        os.system('rm -rf %s' % (os.path.join(tmpdir, '_tmp_%s' % (rand_hash))))
     if return_something:
         if return_headers:
             # define output file name
-            name = _generate_name(regions, (start1, start2), (end1, end2), resolution)
+            name = _generate_name(regions, starts, ends, resolution)
             return dico, bads1, bads2, regions, name, bin_coords
         return dico
 
 
+# number of lines written at once by _write_columns
+WRITE_LINES = 100000
+
+
+def _write_columns(out, fmt, *columns):
+    """
+    Writes columns of values, one line per value.
+
+    :param out: file handler
+    :param fmt: format of a line (e.g. '%d\t%d\t%s\n', float values formatted
+       with '%s' are written as Python would print them)
+    :param columns: NumPy arrays with the values of each column
+    """
+    for beg in xrange(0, len(columns[0]), WRITE_LINES):
+        values = [c[beg:beg + WRITE_LINES].tolist() for c in columns]
+        out.write((fmt * len(values[0])) %
+                  tuple(v for line in zip(*values) for v in line))
+
+
+def _bads_array(bads, size):
+    """
+    :returns: boolean array with True for bad columns
+    """
+    mask = np.zeros(size, dtype=bool)
+    mask[[b for b in bads if 0 <= b < size]] = True
+    return mask
+
+
+def _bias_array(bias, size):
+    """
+    :returns: array of biases (NaN where missing)
+    """
+    values = np.empty(size)
+    values.fill(np.nan)
+    for b, v in bias.iteritems():
+        if 0 <= b < size:
+            values[b] = v
+    return values
+
+
+def _decay_array(decay, refs):
+    """
+    :param decay: dictionary with, for each chromosome, a dictionary of
+       expected values per distance
+    :param refs: names of the chromosomes, in the order of the BAM header
+
+    :returns: the expected values of all chromosomes concatenated in one
+       array (NaN where missing), the position of the first value of each
+       chromosome and the number of values of each chromosome. Index -1 of the
+       last two arrays is for inter-chromosomal interactions (no value).
+    """
+    values = []
+    starts = []
+    sizes  = []
+    total  = 0
+    for crm in list(refs) + [None]:
+        dists = decay.get(crm, {}) if crm else {}
+        size = max(dists) + 1 if dists else 0
+        expc = np.empty(size)
+        expc.fill(np.nan)
+        for d, v in dists.iteritems():
+            expc[d] = v
+        values.append(expc)
+        starts.append(total)
+        sizes.append(size)
+        total += size
+    return (np.concatenate(values), np.array(starts, dtype=np.int64),
+            np.array(sizes, dtype=np.int64))
+
+
+def _decay_values(decay_array, crms, dists):
+    """
+    :param decay_array: expected values as returned by :func:`_decay_array`
+    :param crms: chromosome index of each interaction (-1 if
+       inter-chromosomal)
+    :param dists: distance (in bins) of each interaction
+
+    :returns: the expected value of each interaction (NaN where missing), and
+       a boolean array with True where the expected value was found
+    """
+    values, starts, sizes = decay_array
+    found = dists < sizes[crms]
+    expc = np.empty(len(dists))
+    expc.fill(np.nan)
+    expc[found] = values[starts[crms[found]] + dists[found]]
+    found[found] = ~np.isnan(expc[found])
+    return expc, found
+
+
 def _generate_name(regions, starts, ends, resolution):
     """
     Generate file name for write_matrix and get_matrix functions
@@ -770,8 +1820,12 @@ def write_matrix(inbam, resolution, biases, outdir,
     than the second coodinate can be skipped.
 
     :param inbam: path to BAM file (generated byt TADbit)
-    :param resolution: resolution at which we want to write the matrix
-    :param biases: path to a file with biases
+    :param resolution: resolution at which we want to write the matrix. It can
+       also be a list of resolutions (each one dividing the largest), in which
+       case the BAM file is read only once and the matrices of all resolutions
+       are written
+    :param biases: path to a file with biases (with a list of resolutions, a
+       dictionary of paths per resolution)
     :param outdir: path to a folder where to write output files
     :param (1, 2, 3, 4, 6, 7, 8, 9, 10) filter exclude: filters to define the
        set of valid pair of reads.
@@ -799,13 +1853,16 @@ def write_matrix(inbam, resolution, biases, outdir,
     :param True verbose: speak
     :param 100 nchunks: maximum number of chunks into which to cut the BAM
 
-    :returns: path to output files
+    :returns: path to output files (with a list of resolutions, a dictionary
+       of paths to output files per resolution)
     """
+    multi = isinstance(resolution, (list, tuple))
+    max_reso = max(resolution) if multi else resolution
     if start1 is not None and end1:
-        if end1 - start1 < resolution:
+        if end1 - start1 < max_reso:
             raise Exception('ERROR: region1 should be at least as big as resolution')
     if start2 is not None and end2:
-        if end2 - start2 < resolution:
+        if end2 - start2 < max_reso:
             raise Exception('ERROR: region2 should be at least as big as resolution')
 
     if isinstance(normalizations, list):
@@ -827,6 +1884,35 @@ def write_matrix(inbam, resolution, biases, outdir,
         if region2:
             regions.append(region2)
 
+    if multi:
+        biases = biases or {}
+        fnames = dict((reso, _write_matrix_from_chunks(
+            inbam, reso, biases.get(reso), outdir, chunks, rand_hash, regions,
+            bin_coords[reso], (start1, start2), (end1, end2), region2,
+            normalizations, extra, half_matrix, append_to_tar, cooler, clean,
+            tmpdir, verbose)) for reso in resolution)
+    else:
+        fnames = _write_matrix_from_chunks(
+            inbam, resolution, biases, outdir, chunks, rand_hash, regions,
+            bin_coords, (start1, start2), (end1, end2), region2,
+            normalizations, extra, half_matrix, append_to_tar, cooler, clean,
+            tmpdir, verbose)
+
+    # this is the last thing we do in case something goes wrong
+    if clean:
+        os.system('rm -rf %s' % (os.path.join(tmpdir, '_tmp_%s' % (rand_hash))))
+
+    return fnames
+
+
+def _write_matrix_from_chunks(inbam, resolution, biases, outdir, chunks,
+                              rand_hash, regions, bin_coords, starts, ends,
+                              region2, normalizations, extra, half_matrix,
+                              append_to_tar, cooler, clean, tmpdir, verbose):
+    """
+    Writes the interactions parsed by :func:`read_bam` at a given resolution
+    (see :func:`write_matrix`).
+    """
     bamfile = AlignmentFile(inbam, 'rb')
     sections = OrderedDict(zip(bamfile.references,
                                [x for x in bamfile.lengths]))
@@ -842,7 +1928,7 @@ def write_matrix(inbam, resolution, biases, outdir,
     if verbose:
         printime('  - Writing matrices')
     # define output file name
-    name = _generate_name(regions, (start1, start2), (end1, end2), resolution)
+    name = _generate_name(regions, starts, ends, resolution)
 
     # prepare file header
     outfiles = []
@@ -924,99 +2010,14 @@ def write_matrix(inbam, resolution, biases, outdir,
             else:
                 out_dec.write('# MASKED %s\n' % (','.join([str(b) for b in bads1])))
 
-    # functions to write lines of pairwise interactions
-    def write_raw(func=None):
-        def writer2(c, a, b, v):
-            func(c, a, b, v)
-            out_raw.write('{}\t{}\t{}\n'.format(a, b, v))
-        def writer(_, a, b, v):
-            out_raw.write('{}\t{}\t{}\n'.format(a, b, v))
-        return writer2 if func else writer
-
-    def write_bias(func=None):
-        def writer2(c, a, b, v):
-            func(c, a, b, v)
-            out_nrm.write('{}\t{}\t{}\n'.format(a, b, v / bias1[a] / bias2[b]))
-        def writer(_, a, b, v):
-            out_nrm.write('{}\t{}\t{}\n'.format(a, b, v / bias1[a] / bias2[b]))
-        return writer2 if func else writer
-
-    def write_expc(func=None):
-        def writer2(c, a, b, v):
-            func(c, a, b, v)
-            out_dec.write('{}\t{}\t{}\n'.format(
-                a, b, v / bias1[a] / bias2[b] / decay[c][abs(a-b)]))
-        def writer(c, a, b, v):
-            out_dec.write('{}\t{}\t{}\n'.format(
-                a, b, v / bias1[a] / bias2[b] / decay[c][abs(a-b)]))
-        return writer2 if func else writer
-
-    def write_expc_2reg(func=None):
-        def writer2(c, a, b, v):
-            func(c, a, b, v)
-            out_dec.write('{}\t{}\t{}\n'.format(
-                a, b, v / bias1[a] / bias2[b] / decay[c][abs((a + start_bin1) - (b + start_bin2))]))
-        def writer(c, a, b, v):
-            out_dec.write('{}\t{}\t{}\n'.format(
-                a, b, v / bias1[a] / bias2[b] / decay[c][abs((a + start_bin1) - (b + start_bin2))]))
-        return writer2 if func else writer
-
-    def write_expc_err(func=None):
-        def writer2(c, a, b, v):
-            func(c, a, b, v)
-            try:
-                out_dec.write('{}\t{}\t{}\n'.format(
-                    a, b, v / bias1[a] / bias2[b] / decay[c][abs(a-b)]))
-            except KeyError:  # different chromosomes
-                out_dec.write('{}\t{}\t{}\n'.format(a, b, 'nan'))
-        def writer(c, a, b, v):
-            try:
-                out_dec.write('{}\t{}\t{}\n'.format(
-                    a, b, v / bias1[a] / bias2[b] / decay[c][abs(a-b)]))
-            except KeyError:  # different chromosomes
-                out_dec.write('{}\t{}\t{}\n'.format(a, b, 'nan'))
-        return writer2 if func else writer
-
-    def write_raw_and_expc(func=None):
-        def writer2(c, a, b, v):
-            func(c, a, b, v)
-            try:
-                out_dec.write('{}\t{}\t{}\t{}\n'.format(
-                    a, b, v, v / bias1[a] / bias2[b] / decay[c][abs(a-b)]))
-            except KeyError:  # different chromosomes
-                out_dec.write('{}\t{}\t{}\t{}\n'.format(
-                    a, b, v, v / bias1[a] / bias2[b]))
-        def writer(c, a, b, v):
-            try:
-                out_dec.write('{}\t{}\t{}\t{}\n'.format(
-                    a, b, v, v / bias1[a] / bias2[b] / decay[c][abs(a-b)]))
-            except KeyError:  # different chromosomes
-                out_dec.write('{}\t{}\t{}\t{}\n'.format(
-                    a, b, v, v / bias1[a] / bias2[b]))
-        return writer2 if func else writer
-
-    write = None
-    if 'raw'   in normalizations:
-        write = write_raw(write)
-    if 'norm'  in normalizations and not cooler:
-        write = write_bias(write)
-    if 'decay' in normalizations and not cooler:
-        if len(regions) == 1:
-            if region2:
-                write = write_expc_2reg(write)
-            else:
-                write = write_expc(write)
-        else:
-            write = write_expc_err(write)
-    if 'raw&decay' in normalizations and not cooler:
-        write = write_raw_and_expc(write)
-
     # pull all sub-matrices and write full matrix
     if region2 is not None:  # already half-matrix in this case
         half_matrix = False
 
     if cooler:
         for ichunk, c, j, k, v in _iter_matrix_frags(chunks, tmpdir, rand_hash,
+                                                     resolution,
+                                                     bamfile.references,
                                                      verbose=verbose, clean=clean,
                                                      include_chunk_count=True):
             if j > k:
@@ -1025,18 +2026,44 @@ def write_matrix(inbam, resolution, biases, outdir,
                 out_raw.write_iter(ichunk, j, k, v)
         out_raw.close()
     else:
-        if half_matrix:
-            for c, j, k, v in _iter_matrix_frags(chunks, tmpdir, rand_hash,
-                                                 verbose=verbose, clean=clean):
-                if k > j:
-                    continue
-                if j not in bads1 and k not in bads2:
-                    write(c, j, k, v)
-        else:
-            for c, j, k, v in _iter_matrix_frags(chunks, tmpdir, rand_hash,
-                                                 verbose=verbose, clean=clean):
-                if j not in bads1 and k not in bads2:
-                    write(c, j, k, v)
+        end_bin1, end_bin2 = bin_coords[1::2]
+        bad_rows = _bads_array(bads1, end_bin1 - start_bin1)
+        bad_cols = _bads_array(bads2, end_bin2 - start_bin2)
+        if biases:
+            bias_rows = _bias_array(bias1, end_bin1 - start_bin1)
+            bias_cols = _bias_array(bias2, end_bin2 - start_bin2)
+            decay_array = _decay_array(decay, bamfile.references)
+        for _, dico in _iter_chunk_arrays(chunks, tmpdir, rand_hash,
+                                          resolution, clean=clean,
+                                          verbose=verbose):
+            if half_matrix:
+                dico = dico[dico['row'] >= dico['col']]
+            dico = dico[~bad_rows[dico['row']] & ~bad_cols[dico['col']]]
+            a = dico['row']
+            b = dico['col']
+            v = dico['count']
+            if 'raw' in normalizations:
+                _write_columns(out_raw, '%d\t%d\t%d\n', a, b, v)
+            if not biases:
+                continue
+            with np.errstate(divide='ignore', invalid='ignore'):
+                nrm = v / bias_rows[a] / bias_cols[b]
+                if 'norm' in normalizations:
+                    _write_columns(out_nrm, '%d\t%d\t%s\n', a, b, nrm)
+                if 'decay' in normalizations or 'raw&decay' in normalizations:
+                    # distance computed in the genome (regions may not start
+                    # at the same bin)
+                    expc, found = _decay_values(
+                        decay_array, dico['crm'],
+                        np.abs((a + start_bin1) - (b + start_bin2)))
+                    dec = nrm / expc
+                if 'decay' in normalizations:
+                    _write_columns(out_dec, '%d\t%d\t%s\n', a, b, dec)
+                if 'raw&decay' in normalizations:
+                    # without expected value (e.g. inter-chromosomal), only
+                    # normalized by biases
+                    _write_columns(out_dec, '%d\t%d\t%d\t%s\n', a, b, v,
+                                   np.where(found, dec, nrm))
 
     fnames = {}
     if append_to_tar:
@@ -1076,9 +2103,4 @@ def write_matrix(inbam, resolution, biases, outdir,
             if 'raw&decay' in normalizations:
                 out_dec.close()
                 fnames['RAW&DEC'] = out_dec.name
-
-    # this is the last thing we do in case something goes wrong
-    if clean:
-        os.system('rm -rf %s' % (os.path.join(tmpdir, '_tmp_%s' % (rand_hash))))
-
     return fnames
@@ -3,6 +3,7 @@ November 7, 2013.
 
 """
 
+from os                              import path
 from sys                             import stderr, modules
 from collections                     import OrderedDict
 from warnings                        import warn
@@ -13,7 +14,9 @@ from pysam                           import AlignmentFile
 
 from pytadbit.parsers.gzopen         import gzopen
 from pytadbit                        import HiC_data
-from pytadbit.parsers.hic_bam_parser import get_matrix
+from pytadbit.hic_data               import HiC_array, HiC_region
+from pytadbit.parsers.hic_bam_parser import get_matrix, get_contact_storage
+from pytadbit.utils.file_handling    import mkdir
 try:
     from pytadbit.parsers.cooler_parser import parse_cooler, is_cooler
 except ImportError:
@@ -383,7 +386,8 @@ def _header_to_section(header, resolution):
     return chromosomes, sections, resolution
 
 
-def read_matrix(things, parser=None, hic=True, resolution=1, **kwargs):
+def read_matrix(things, parser=None, hic=True, resolution=1, storage='dict',
+                **kwargs):
     """
     Read and checks a matrix from a file (using
     :func:`pytadbit.parser.hic_parser.autoreader`) or a list.
@@ -408,6 +412,9 @@ def read_matrix(things, parser=None, hic=True, resolution=1, **kwargs):
     :param 1 resolution: resolution of the matrix
     :param True hic: if False, TADbit assumes that files contains normalized
        data
+    :param 'dict' storage: how to store the interactions, either 'dict' for
+       :class:`pytadbit.hic_data.HiC_data` or 'array' for
+       :class:`pytadbit.hic_data.HiC_array` (much lower memory usage)
     :returns: the corresponding matrix concatenated into a huge list, also
        returns number or rows
 
@@ -415,12 +422,20 @@ def read_matrix(things, parser=None, hic=True, resolution=1, **kwargs):
     one = kwargs.get('one', True)
     global HIC_DATA
     HIC_DATA = hic
+    if storage == 'array':
+        HiC_class = HiC_array
+    elif storage == 'dict':
+        HiC_class = HiC_data
+    else:
+        raise NotImplementedError('ERROR: storage %s not implemented' % storage)
     if not isinstance(things, list):
         things = [things]
     matrices = []
     for thing in things:
         if isinstance(thing, HiC_data):
             matrices.append(thing)
+        elif isinstance(thing, HiC_region):
+            matrices.append(thing.to_hic_data())
         elif isinstance(thing, file):
             parser = parser or (abc_reader if __is_abc(thing) else autoreader)
             matrix, size, header, masked, sym = parser(thing)
@@ -428,10 +443,10 @@ def read_matrix(things, parser=None, hic=True, resolution=1, **kwargs):
             thing.close()
             chromosomes, sections, resolution = _header_to_section(header,
                                                                    resolution)
-            matrices.append(HiC_data(matrix, size, dict_sec=sections,
-                                     chromosomes=chromosomes,
-                                     resolution=resolution,
-                                     symmetricized=sym, masked=masked))
+            matrices.append(HiC_class(matrix, size, dict_sec=sections,
+                                      chromosomes=chromosomes,
+                                      resolution=resolution,
+                                      symmetricized=sym, masked=masked))
         elif isinstance(thing, str):
             if is_cooler(thing, resolution if resolution > 1 else None):
                 matrix, size, header, masked, sym = parse_cooler(thing,
@@ -450,10 +465,10 @@ def read_matrix(things, parser=None, hic=True, resolution=1, **kwargs):
             sections = dict([(h, i) for i, h in enumerate(header)])
             chromosomes, sections, resolution = _header_to_section(header,
                                                                    resolution)
-            matrices.append(HiC_data(matrix, size, dict_sec=sections,
-                                     chromosomes=chromosomes, masked=masked,
-                                     resolution=resolution,
-                                     symmetricized=sym))
+            matrices.append(HiC_class(matrix, size, dict_sec=sections,
+                                      chromosomes=chromosomes, masked=masked,
+                                      resolution=resolution,
+                                      symmetricized=sym))
         elif isinstance(thing, list):
             if all([len(thing)==len(l) for l in thing]):
                 size = len(thing)
@@ -461,7 +476,7 @@ def read_matrix(things, parser=None, hic=True, resolution=1, **kwargs):
                            for j, v in enumerate(l) if v]
             else:
                 raise Exception('must be list of lists, all with same length.')
-            matrices.append(HiC_data(matrix, size))
+            matrices.append(HiC_class(matrix, size))
         elif isinstance(thing, tuple):
             # case we know what we are doing and passing directly list of tuples
             matrix = thing
@@ -469,7 +484,7 @@ def read_matrix(things, parser=None, hic=True, resolution=1, **kwargs):
             if int(siz) != siz:
                 raise AttributeError('ERROR: matrix should be square.\n')
             size = int(siz)
-            matrices.append(HiC_data(matrix, size))
+            matrices.append(HiC_class(matrix, size))
         elif 'matrix' in str(type(thing)):
             try:
                 row, col = thing.shape
@@ -479,7 +494,7 @@ def read_matrix(things, parser=None, hic=True, resolution=1, **kwargs):
                 size = row
             except Exception as exc:
                 print 'Error found:', exc
-            matrices.append(HiC_data(matrix, size))
+            matrices.append(HiC_class(matrix, size))
         else:
             raise Exception('Unable to read this file or whatever it is :)')
     if one:
@@ -535,64 +550,157 @@ def load_hic_data_from_reads(fnam, resolution, **kwargs):
 
 def load_hic_data_from_bam(fnam, resolution, biases=None, tmpdir='.', ncpus=8,
                            filter_exclude=(1, 2, 3, 4, 6, 7, 8, 9, 10),
-                           region=None, verbose=True, clean=True):
+                           region=None, verbose=True, clean=True,
+                           storage='dict', mmap_dir=None, downsample_to=None,
+                           fraction=None, seed=0):
     """
     :param fnam: TADbit-generated BAM file with read-ends1 and read-ends2
     :param resolution: the resolution of the experiment (size of a bin in
-       bases)
+       bases). It can also be a list of resolutions (each one dividing the
+       largest), in which case the BAM file is read only once, and a
+       dictionary of HiC_data objects per resolution is returned
     :param None biases: path to pickle file where are stored the biases. Keys
-       in this file should be: 'biases', 'badcol', 'decay' and 'resolution'
+       in this file should be: 'biases', 'badcol', 'decay' and 'resolution'.
+       With a list of resolutions, a dictionary of paths per resolution.
     :param '.' tmpdir: path to folder where to create temporary files
     :param 8 ncpus:
     :param (1, 2, 3, 4, 6, 7, 8, 9, 10) filter exclude: filters to define the
        set of valid pair of reads.
     :param None region: chromosome name, if None, all genome will be loaded
+    :param 'dict' storage: 'dict' to store interactions in a Python
+       dictionary (HiC_data), 'array' to store them in sorted NumPy arrays
+       (HiC_array, about ten times less memory)
+    :param None mmap_dir: path to a directory where to write interactions,
+       biases, bad columns and expected values as binary files (implies
+       storage='array'). Interactions are written chunk by chunk, never being
+       all in memory, and the returned HiC_array is memory-mapped on these
+       files (see :func:`load_hic_data_from_mmap`). With a list of
+       resolutions, one sub-directory is created per resolution.
+    :param None downsample_to: number of contacts (pairs of read-ends passing
+       the filters) to randomly sample from the BAM file, while reading it
+       (see :func:`pytadbit.parsers.hic_bam_parser.get_matrix`)
+    :param None fraction: fraction of contacts to sample (ignored if
+       downsample_to is given)
+    :param 0 seed: seed of the sampling of contacts
 
     :returns: HiC_data object
     """
+    if mmap_dir:
+        storage = 'array'
+        mkdir(mmap_dir)
+    if storage not in ('dict', 'array'):
+        raise NotImplementedError('ERROR: storage should be "dict" or "array"')
+    multi = isinstance(resolution, (list, tuple))
+    resolutions = resolution if multi else [resolution]
+    if not multi:
+        biases = {resolution: biases}
+    elif not biases:
+        biases = {}
     bam = AlignmentFile(fnam)
-    genome_seq = OrderedDict((c, l) for c, l in
-                             zip(bam.references,
-                                 [x / resolution + 1 for x in bam.lengths]))
+    references, lengths = bam.references, bam.lengths
     bam.close()
 
-    sections = []
-    for crm in genome_seq:
-        len_crm = genome_seq[crm]
-        sections.extend([(crm, i) for i in xrange(len_crm)])
+    genomes = {}
+    sizes   = {}
+    for reso in resolutions:
+        genomes[reso] = OrderedDict((c, l) for c, l in
+                                    zip(references,
+                                        [x / reso + 1 for x in lengths]))
+        sizes[reso] = sum(genomes[reso].values())
+
+    if storage == 'array':
+        contacts = get_contact_storage(
+            fnam, resolution, filter_exclude=filter_exclude, region=region,
+            size=sizes if multi else sizes[resolution], dirname=mmap_dir,
+            clean=clean, tmpdir=tmpdir, ncpus=ncpus, verbose=verbose,
+            downsample_to=downsample_to, fraction=fraction, seed=seed)
+        if not multi:
+            contacts = {resolution: contacts}
+
+    hic_datas = {}
+    for reso in resolutions:
+        genome_seq = genomes[reso]
+        sections = []
+        for crm in genome_seq:
+            len_crm = genome_seq[crm]
+            sections.extend([(crm, i) for i in xrange(len_crm)])
 
-    size = sum(genome_seq.values())
+        size = sizes[reso]
 
-    chromosomes = {region: genome_seq[region]} if region else genome_seq
-    dict_sec = dict([(j, i) for i, j in enumerate(sections)])
-    imx = HiC_data((), size, chromosomes=chromosomes, dict_sec=dict_sec,
-                   resolution=resolution)
-
-    if biases:
-        if isinstance(biases, basestring):
-            biases = load(open(biases))
-        if biases['resolution'] != resolution:
-            raise Exception('ERROR: resolution of biases do not match to the '
-                            'one wanted (%d vs %d)' % (
-                                biases['resolution'], resolution))
-        if region:
-            chrom_start = 0
-            for crm in genome_seq:
-                if crm == region:
-                    break
-                len_crm = genome_seq[crm]
-                chrom_start += len_crm
-            imx.bads     = dict((b - chrom_start, biases['badcol'][b]) for b in biases['badcol'])
-            imx.bias     = dict((b - chrom_start, biases['biases'][b]) for b in biases['biases'])
+        chromosomes = {region: genome_seq[region]} if region else genome_seq
+        dict_sec = dict([(j, i) for i, j in enumerate(sections)])
+        if storage == 'array':
+            # interactions in TADbit BAM files are already symmetric
+            imx = HiC_array(contacts[reso], size, chromosomes=chromosomes,
+                            dict_sec=dict_sec, resolution=reso,
+                            check_symmetry=False)
         else:
-            imx.bads     = biases['badcol']
-            imx.bias     = biases['biases']
-        imx.expected = biases['decay']
-
-    get_matrix(fnam, resolution, biases=None, filter_exclude=filter_exclude,
-               normalization='raw', tmpdir=tmpdir, clean=clean,
-               ncpus=ncpus, dico=imx, region1=region, verbose=verbose)
-    imx._symmetricize()
-    imx.symmetricized = True
+            imx = HiC_data((), size, chromosomes=chromosomes,
+                           dict_sec=dict_sec, resolution=reso)
+        _load_biases_from_pickle(imx, biases.get(reso), reso, genome_seq,
+                                 region)
+        hic_datas[reso] = imx
+
+    if storage == 'dict':
+        get_matrix(fnam, resolution, biases=None, filter_exclude=filter_exclude,
+                   normalization='raw', tmpdir=tmpdir, clean=clean,
+                   ncpus=ncpus, region1=region, verbose=verbose,
+                   dico=hic_datas if multi else hic_datas[resolution],
+                   downsample_to=downsample_to, fraction=fraction, seed=seed)
+        for imx in hic_datas.values():
+            imx._symmetricize()
+    for imx in hic_datas.values():
+        imx.symmetricized = True
+
+    if mmap_dir:
+        for reso in resolutions:
+            reso_dir = path.join(mmap_dir, str(reso)) if multi else mmap_dir
+            hic_datas[reso].write_mmap(reso_dir)
+            hic_datas[reso] = load_hic_data_from_mmap(reso_dir)
+    if multi:
+        return hic_datas
+    return hic_datas[resolution]
+
+
+def _load_biases_from_pickle(imx, biases, resolution, genome_seq, region):
+    """
+    Sets biases, bad columns and expected values of an HiC_data object from a
+    pickle file (or from the dictionary loaded from it).
+    """
+    if not biases:
+        return
+    if isinstance(biases, basestring):
+        biases = load(open(biases))
+    if biases['resolution'] != resolution:
+        raise Exception('ERROR: resolution of biases do not match to the '
+                        'one wanted (%d vs %d)' % (
+                            biases['resolution'], resolution))
+    if region:
+        chrom_start = 0
+        for crm in genome_seq:
+            if crm == region:
+                break
+            len_crm = genome_seq[crm]
+            chrom_start += len_crm
+        imx.bads     = dict((b - chrom_start, biases['badcol'][b]) for b in biases['badcol'])
+        imx.bias     = dict((b - chrom_start, biases['biases'][b]) for b in biases['biases'])
+    else:
+        imx.bads     = biases['badcol']
+        imx.bias     = biases['biases']
+    imx.expected = biases['decay']
 
-    return imx
+
+def load_hic_data_from_mmap(dirname, mode='r'):
+    """
+    Opens an HiC_array written with :func:`HiC_array.write_mmap` (or with
+    :func:`load_hic_data_from_bam` and mmap_dir). Interactions, biases, bad
+    columns and expected values are memory-mapped: only the parts accessed are
+    read from disk, and the same files can be opened by several processes.
+
+    :param dirname: path to the directory containing the binary files
+    :param 'r' mode: 'r' to open files read-only, 'r+' to modify the values
+       on disk, 'c' for copy-on-write (modifications kept in memory)
+
+    :returns: HiC_array object
+    """
+    return HiC_array.from_mmap(dirname, mode=mode)
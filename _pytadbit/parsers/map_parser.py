@@ -2,19 +2,25 @@
 22 may 2015
 """
 
-from bisect                               import bisect_right as bisect
+from itertools                            import islice, izip
 from warnings                             import warn
-from sys                                  import stdout
 from subprocess                           import Popen
 import os
+import multiprocessing as mu
 
-from pytadbit.utils.file_handling         import magic_open
-from pytadbit.mapping.restriction_enzymes import map_re_sites
+from pytadbit.utils.file_handling         import magic_open, merge_sorted_files
+from pytadbit.utils.file_handling         import LINE_OVERHEAD
+from pytadbit.parsers.genome_parser       import genome_cache_prefix
+from pytadbit.mapping.restriction_enzymes import index_re_sites
+from pytadbit.mapping.restriction_enzymes import find_reads_re_sites
+
+# number of lines of MAP files parsed at once
+READ_BATCH = 100000
 
 
 def parse_map(f_names1, f_names2=None, out_file1=None, out_file2=None,
               genome_seq=None, re_name=None, verbose=False, clean=True,
-              **kwargs):
+              ncpus=1, **kwargs):
     """
     Parse map files
 
@@ -39,8 +45,15 @@ def parse_map(f_names1, f_names2=None, out_file1=None, out_file2=None,
     :param re_name: name of the restriction enzyme used
     :param True clean: remove temporary files required for indentification of
        multiple-contacts
+    :param 1 ncpus: number of input files parsed in parallel. Each file is
+       parsed and sorted by a different process, the output is the same.
+    :param None genome_path: path to the FASTA file(s) of the genome. If
+       given, RE sites are cached next to it, and loaded from this cache in
+       next runs
     :param False compress: compress (gzip) input map files. This is done in the
        background while next MAP files are parsed, or while files are sorted.
+    :param 250 max_memory: approximate memory (in Mb) used to sort reads. Above,
+       sorted reads are written to temporary files, merged at the end.
     """
     # not nice, dirty fix in order to allow this function to only parse
     # one SAM file
@@ -53,16 +66,17 @@ def parse_map(f_names1, f_names2=None, out_file1=None, out_file2=None,
     if (f_names2 and not out_file2) or (not f_names2 and out_file2):
         raise Exception('ERROR: out_file2 AND f_names2 needed\n')
 
-    frag_chunk = kwargs.get('frag_chunk', 100000)
     if verbose:
         print('Searching and mapping RE sites to the reference genome')
+    if kwargs.get('genome_path'):
+        cache_prefix = genome_cache_prefix(kwargs['genome_path'])
+    else:
+        cache_prefix = None
     if len(re_name) == 1 and re_name[0] in (None, 'None'):
-        frags = {}
-        read_read = read_read_nofrags
+        re_sites = None
     else:
-        frags = map_re_sites(re_name, genome_seq, frag_chunk=frag_chunk,
-                             verbose=verbose)
-        read_read = read_read_frags
+        re_sites = index_re_sites(re_name, genome_seq, verbose=verbose,
+                                  cache_prefix=cache_prefix)
 
     if isinstance(f_names1, str):
         f_names1 = [f_names1]
@@ -75,8 +89,36 @@ def parse_map(f_names1, f_names2=None, out_file1=None, out_file2=None,
         fnames = (f_names1,)
         outfiles = (out_file1, )
 
-    # max number of reads per intermediate files for sorting
-    max_size = 1000000
+    # max memory used to sort reads before writing intermediate files
+    max_memory = kwargs.get('max_memory', 250) * 1024**2
+    compress = kwargs.get('compress', False)
+
+    # input files, with the iteration number of the iterative mapping
+    inputs = {}
+    for read in range(len(fnames)):
+        inputs[read] = []
+        num = 0
+        for nfnam, fnam in enumerate(fnames[read]):
+            if not os.path.exists(fnam):
+                warn('WARNING: file "%s" not found\n' % fnam)
+                continue
+            try:
+                num = int(fnam.split('.')[-1].split(':')[0])
+            except:
+                num += 1
+            inputs[read].append((num, nfnam, fnam))
+
+    if ncpus > 1:
+        # each input file is parsed by a worker into sorted temporary files
+        pool = mu.Pool(ncpus, initializer=_init_parser,
+                       initargs=(re_sites, ))
+        jobs = {}
+        for read in inputs:
+            jobs[read] = [pool.apply_async(
+                _parse_file_worker, args=(
+                    fnam, '%s_%d' % (outfiles[read], nfnam), max_memory / ncpus))
+                          for _, nfnam, fnam in inputs[read]]
+        pool.close()
 
     windows = {}
     multis  = {}
@@ -85,69 +127,37 @@ def parse_map(f_names1, f_names2=None, out_file1=None, out_file2=None,
         if verbose:
             print('Loading read' + str(read + 1))
         windows[read] = {}
-        num = 0
         # iteration over reads
-        nfile = 0
         tmp_files = []
         reads     = []
-        for fnam in fnames[read]:
-            try:
-                fhandler = magic_open(fnam)
-            except IOError:
-                warn('WARNING: file "%s" not found\n' % fnam)
-                continue
-            # get the iteration number of the iterative mapping
-            try:
-                num = int(fnam.split('.')[-1].split(':')[0])
-            except:
-                num += 1
-            # set read counter
+        memory    = 0
+        for nfile, (num, _, fnam) in enumerate(inputs[read]):
             if verbose:
                 print('loading file: %s' % (fnam))
-            # start parsing
-            read_count = 0
-            try:
-                while not False:
-                    for _ in range(max_size):
-                        try:
-                            reads.append(read_read(fhandler.next(), frags,
-                                                   frag_chunk))
-                        except KeyError:
-                            # Chromosome not in hash
-                            continue
-                        read_count += 1
-                    nfile += 1
-                    write_reads_to_file(reads, outfiles[read], tmp_files, nfile)
-            except StopIteration:
-                fhandler.close()
-                nfile += 1
-                write_reads_to_file(reads, outfiles[read], tmp_files, nfile)
-            windows[read][num] = read_count
-            if kwargs.get('compress', False) and fnam.endswith('.map'):
+            # sorted temporary files are kept in the order of the input files
+            if ncpus > 1:
+                windows[read][num], runs = jobs[read][nfile].get()
+                tmp_files.extend(runs)
+            else:
+                windows[read][num], memory = _parse_file(
+                    fnam, reads, memory, max_memory, outfiles[read], tmp_files,
+                    re_sites)
+            if compress and fnam.endswith('.map'):
                 print('compressing input MAP file')
                 procs.append(Popen(['gzip', fnam]))
-        nfile += 1
-        write_reads_to_file(reads, outfiles[read], tmp_files, nfile)
 
-        # we have now sorted temporary files
-        # we do merge sort for eah pair
-        if verbose:
-            stdout.write('Merge sort')
-            stdout.flush()
-        while len(tmp_files) > 1:
-            file1 = tmp_files.pop(0)
-            try:
-                file2 = tmp_files.pop(0)
-            except IndexError:
-                break
+        # sorted reads, merged from the temporary files in a single pass (if
+        # they did not all fit in memory)
+        if tmp_files:
+            write_reads_to_file(reads, outfiles[read], tmp_files,
+                                len(tmp_files) + 1)
             if verbose:
-                stdout.write('.')
-            stdout.flush()
-            nfile += 1
-            tmp_files.append(merge_sort(file1, file2, outfiles[read], nfile))
-        if verbose:
-            stdout.write('\n')
-        tmp_name = tmp_files[0]
+                print('Merge sort (%d files)' % len(tmp_files))
+            sorted_reads = merge_sorted_files(tmp_files, _read_key,
+                                              clean=clean)
+        else:
+            sorted_reads = iter(sorted(reads, key=_read_key))
+            del(reads)
 
         if verbose:
             print('Getting Multiple contacts')
@@ -162,21 +172,18 @@ def parse_map(f_names1, f_names2=None, out_file1=None, out_file2=None,
             reads_fh.write('# MAPPED %d %d\n' % (size, windows[read][size]))
 
         ## Multicontacts
-        tmp_reads_fh = open(tmp_name)
         try:
-            read_line = tmp_reads_fh.next()
+            read_line = sorted_reads.next()
         except StopIteration:
             raise StopIteration('ERROR!\n Nothing parsed, check input files and'
                                 ' chromosome names (in genome.fasta and SAM/MAP'
                                 ' files).')
-        prev_head = read_line.split('\t', 1)[0]
-        prev_head = prev_head.split('~' , 1)[0]
+        prev_head = _read_key(read_line)
         prev_read = read_line
         multis[read] = {}
         multi = 0
-        for read_line in tmp_reads_fh:
-            head = read_line.split('\t', 1)[0]
-            head = head.split('~' , 1)[0]
+        for read_line in sorted_reads:
+            head = _read_key(read_line)
             if head == prev_head:
                 prev_read =  prev_read.strip() + '|||' + read_line
                 multi += 1
@@ -191,14 +198,82 @@ def parse_map(f_names1, f_names2=None, out_file1=None, out_file2=None,
             prev_head = head
         reads_fh.write(prev_read)
         reads_fh.close()
-        if clean:
-            os.system('rm -rf ' + tmp_name)
+    if ncpus > 1:
+        pool.join()
     # wait for compression to finish
     for p in procs:
         p.communicate()
     return windows, multis
 
 
+def _parse_file(fnam, reads, memory, max_memory, outfile, tmp_files,
+                re_sites):
+    """
+    Parses the reads of a MAP file. Reads are accumulated in a list, and
+    written, sorted, to temporary files when they exceed a given memory.
+
+    :param fnam: path to the MAP file
+    :param reads: list of parsed reads
+    :param memory: approximate memory used by the reads already in the list
+    :param max_memory: approximate memory (in bytes) above which reads are
+       written to a temporary file
+    :param outfile: path to the final output file (temporary files are written
+       next to it)
+    :param tmp_files: list of temporary files, new ones are appended to it
+    :param re_sites: RE sites per chromosome (see
+       :func:`pytadbit.mapping.restriction_enzymes.index_re_sites`), None to
+       skip the search of RE sites
+
+    :returns: the number of reads parsed and the approximate memory used by the
+       reads in the list
+    """
+    fhandler = magic_open(fnam)
+    read_count = 0
+    while True:
+        lines = list(islice(fhandler, READ_BATCH))
+        if not lines:
+            break
+        parsed = parse_reads(lines, re_sites)
+        read_count += len(parsed)
+        reads.extend(parsed)
+        memory += sum(len(r) for r in parsed) + LINE_OVERHEAD * len(parsed)
+        if memory > max_memory:
+            write_reads_to_file(reads, outfile, tmp_files, len(tmp_files) + 1)
+            memory = 0
+    fhandler.close()
+    return read_count, memory
+
+
+def _init_parser(*args):
+    """
+    Stores, in each worker, the arguments shared by all the files to parse
+    """
+    global _PARSER_ARGS
+    _PARSER_ARGS = args
+
+
+def _parse_file_worker(fnam, outfile, max_memory):
+    """
+    Parses a MAP file into sorted temporary files
+
+    :returns: the number of reads parsed and the list of temporary files
+    """
+    reads = []
+    tmp_files = []
+    read_count, _ = _parse_file(fnam, reads, 0, max_memory, outfile,
+                                tmp_files, *_PARSER_ARGS)
+    write_reads_to_file(reads, outfile, tmp_files, len(tmp_files) + 1)
+    return read_count, tmp_files
+
+
+def _read_key(read_line):
+    """
+    Sort key of a parsed read: its identifier (without the suffix of the
+    fragment, if any)
+    """
+    return read_line.split('\t', 1)[0].split('~', 1)[0]
+
+
 def write_reads_to_file(reads, outfiles, tmp_files, nfile):
     if not reads: # can be...
         return
@@ -207,93 +282,56 @@ def write_reads_to_file(reads, outfiles, tmp_files, nfile):
     tmp_name = ('/' * outfiles.startswith('/')) + tmp_name
     tmp_files.append(tmp_name)
     out = open(tmp_name, 'w')
-    out.write(''.join(sorted(reads, key=lambda x: x.split('\t', 1)[0].split('~')[0])))
+    out.write(''.join(sorted(reads, key=_read_key)))
     out.close()
     del(reads[:])  # empty list
 
 
-def merge_sort(file1, file2, outfiles, nfile):
-    tmp_name = os.path.join(*outfiles.split('/')[:-1] +
-                            [('tmp_merged_%03d_' % nfile) + outfiles.split('/')[-1]])
-    tmp_name = ('/' * outfiles.startswith('/')) + tmp_name
-    tmp_file = open(tmp_name, 'w')
-    fh1 = open(file1)
-    fh2 = open(file2)
-    greater = lambda x, y: x.split('\t', 1)[0].split('~')[0] > y.split('\t', 1)[0].split('~')[0]
-    read1 = fh1.next()
-    read2 = fh2.next()
-    while True:
-        if greater(read2, read1):
-            tmp_file.write(read1)
-            try:
-                read1 = fh1.next()
-            except StopIteration:
-                tmp_file.write(read2)
-                break
+def parse_reads(lines, re_sites=None):
+    """
+    Parses reads from lines of a MAP file. The RE sites around all reads are
+    searched at once.
+
+    :param lines: list of lines of a MAP file
+    :param None re_sites: RE sites per chromosome (see
+       :func:`pytadbit.mapping.restriction_enzymes.index_re_sites`), if None
+       RE sites are set to 0
+
+    :returns: a list of parsed reads, in TADbit format, in the order of the
+       lines. Unmapped reads, and reads mapped on chromosomes without RE sites,
+       are skipped
+    """
+    names = []
+    crms  = []
+    poss  = []
+    strds = []
+    lens  = []
+    for r in lines:
+        name, seq, _, _, ali = r.split('\t', 5)[:5]
+        try:
+            crm, strand, pos = ali.split(':')[:3]
+        except ValueError:
+            # not mapped
+            continue
+        len_seq = len(seq)
+        if re_sites is not None:
+            crm = crm.split()[0]
+            if not crm in re_sites:
+                # Chromosome not in hash
+                continue
+        if strand == '+':
+            poss.append(int(pos))
+            strds.append(1)
         else:
-            tmp_file.write(read2)
-            try:
-                read2 = fh2.next()
-            except StopIteration:
-                tmp_file.write(read1)
-                break
-    for read in fh1:
-        tmp_file.write(read)
-    for read in fh2:
-        tmp_file.write(read)
-    fh1.close()
-    fh2.close()
-    tmp_file.close()
-    os.system('rm -f ' + file1)
-    os.system('rm -f ' + file2)
-    return tmp_name
-
-
-def read_read_nofrags(r, _, __):
-    name, seq, _, _, ali = r.split('\t')[:5]
-    try:
-        crm, strand, pos = ali.split(':')[:3]
-    except ValueError:
-        raise KeyError()
-    positive = strand == '+'
-    len_seq  = len(seq)
-    if positive:
-        pos = int(pos)
-    else:
-        pos = int(pos) + len_seq - 1 # remove 1 because all inclusive
-    return ('%s\t%s\t%d\t%d\t%d\t0\t0\n' % (
-        name, crm, pos, positive, len_seq))
-
-
-def read_read_frags(r, frags, frag_chunk):
-    name, seq, _, _, ali = r.split('\t')[:5]
-    try:
-        crm, strand, pos = ali.split(':')[:3]
-    except ValueError:
-        raise KeyError()
-    crm = crm.split()[0]
-    positive = strand == '+'
-    len_seq  = len(seq)
-    if positive:
-        pos = int(pos)
-    else:
-        pos = int(pos) + len_seq - 1 # remove 1 because all inclusive
-    frag_piece = frags[crm][pos // frag_chunk]
-    idx = bisect(frag_piece, pos)
-    try:
-        next_re = frag_piece[idx]
-    except IndexError:
-        # case where part of the read is mapped outside chromosome
-        count = 0
-        while idx >= len(frag_piece) and count < len_seq:
-            pos -= 1
-            count += 1
-            frag_piece = frags[crm][pos // frag_chunk]
-            idx = bisect(frag_piece, pos)
-        if count >= len_seq:
-            raise Exception('Read mapped mostly outside ' +
-                            'chromosome\n')
-        next_re = frag_piece[idx]
-    prev_re = frag_piece[idx - 1 if idx else 0]
-    return ('%s\t%s\t%d\t%d\t%d\t%d\t%d\n' % (
-        name, crm, pos, positive, len_seq, prev_re, next_re))
+            poss.append(int(pos) + len_seq - 1) # remove 1 because all inclusive
+            strds.append(0)
+        names.append(name)
+        crms.append(crm)
+        lens.append(len_seq)
+    if re_sites is None:
+        return ['%s\t%s\t%d\t%d\t%d\t0\t0\n' % read
+                for read in izip(names, crms, poss, strds, lens)]
+    poss, prev_re, next_re = find_reads_re_sites(re_sites, crms, poss, lens)
+    return ['%s\t%s\t%d\t%d\t%d\t%d\t%d\n' % read
+            for read in izip(names, crms, poss.tolist(), strds, lens,
+                             prev_re.tolist(), next_re.tolist())]
@@ -2,18 +2,22 @@
 17 nov. 2014
 """
 
-from itertools import combinations
-from bisect import bisect_right as bisect
+from itertools import combinations, izip
 from pysam import Samfile
-from pytadbit.mapping.restriction_enzymes import map_re_sites
-from shutil import copyfileobj
+from pytadbit.parsers.genome_parser import genome_cache_prefix
+from pytadbit.mapping.restriction_enzymes import index_re_sites, find_re_sites
+from pytadbit.mapping.restriction_enzymes import find_reads_re_sites
+from pytadbit.utils.file_handling import merge_sorted_files, LINE_OVERHEAD
 from warnings import warn
 import os
-from sys import stdout
+import multiprocessing as mu
+
+# number of reads parsed at once
+READ_BATCH = 100000
 
 def parse_sam(f_names1, f_names2=None, out_file1=None, out_file2=None,
               genome_seq=None, re_name=None, verbose=False, clean=True,
-              mapper=None, **kwargs):
+              mapper=None, ncpus=1, **kwargs):
     """
     Parse sam/bam file using pysam tools.
 
@@ -35,6 +39,13 @@ def parse_sam(f_names1, f_names2=None, out_file1=None, out_file2=None,
     :param re_name: name of the restriction enzyme used
     :param None mapper: software used to map (supported are GEM and BOWTIE2).
        Guessed from file by default.
+    :param None genome_path: path to the FASTA file(s) of the genome. If
+       given, RE sites are cached next to it, and loaded from this cache in
+       next runs
+    :param 1 ncpus: number of input files parsed in parallel. Each file is
+       parsed and sorted by a different process, the output is the same.
+    :param 250 max_memory: approximate memory (in Mb) used to sort reads. Above,
+       sorted reads are written to temporary files, merged at the end.
     """
     # not nice, dirty fix in order to allow this function to only parse
     # one SAM file
@@ -47,11 +58,14 @@ def parse_sam(f_names1, f_names2=None, out_file1=None, out_file2=None,
     if (f_names2 and not out_file2) or (not f_names2 and out_file2):
         raise Exception('ERROR: out_file2 AND f_names2 needed\n')
 
-    frag_chunk = kwargs.get('frag_chunk', 100000)
     if verbose:
         print 'Searching and mapping RE sites to the reference genome'
-    frags = map_re_sites(re_name, genome_seq, frag_chunk=frag_chunk,
-                         verbose=verbose)
+    if kwargs.get('genome_path'):
+        cache_prefix = genome_cache_prefix(kwargs['genome_path'])
+    else:
+        cache_prefix = None
+    re_sites = index_re_sites(re_name, genome_seq, verbose=verbose,
+                              cache_prefix=cache_prefix)
 
     if isinstance(f_names1, str):
         f_names1 = [f_names1]
@@ -64,22 +78,15 @@ def parse_sam(f_names1, f_names2=None, out_file1=None, out_file2=None,
         fnames = (f_names1,)
         outfiles = (out_file1, )
 
-    # max number of reads per intermediate files for sorting
-    max_size = 1000000
+    # max memory used to sort reads before writing intermediate files
+    max_memory = kwargs.get('max_memory', 250) * 1024**2
 
-    windows = {}
-    multis  = {}
-    procs   = []
+    # input files, with the iteration number of the iterative mapping
+    inputs = {}
     for read in range(len(fnames)):
-        if verbose:
-            print 'Loading read' + str(read + 1)
-        windows[read] = {}
+        inputs[read] = []
         num = 0
-        # iteration over reads
-        nfile = 0
-        tmp_files = []
-        reads     = []
-        for fnam in fnames[read]:
+        for nfnam, fnam in enumerate(fnames[read]):
             try:
                 fhandler = Samfile(fnam)
             except IOError:
@@ -92,97 +99,63 @@ def parse_sam(f_names1, f_names2=None, out_file1=None, out_file2=None,
                 num = int(fnam.split('.')[-1].split(':')[0])
             except:
                 num += 1
-            # set read counter
-            windows[read].setdefault(num, 0)
             # guess mapper used
             if not mapper:
                 mapper = fhandler.header['PG'][0]['ID']
-            if mapper.lower()=='gem':
-                condition = lambda x: x[1][0][0] != 'N'
-            elif mapper.lower() in ['bowtie', 'bowtie2']:
-                condition = lambda x: 'XS' in dict(x)
-            else:
-                warn('WARNING: unrecognized mapper used to generate file\n')
-                condition = lambda x: x[1][1] != 1
-            if verbose:
-                print 'loading SAM file from %s: %s' % (mapper, fnam)
-            # getrname chromosome names
-            i = 0
-            crm_dict = {}
-            while True:
-                try:
-                    crm_dict[i] = fhandler.getrname(i)
-                    i += 1
-                except ValueError:
-                    break
-            # iteration over reads
-            sub_count = 0  # to empty read buffer
-            for r in fhandler:
-                if r.is_unmapped:
-                    continue
-                if condition(r.tags):
-                    continue
-                positive = not r.is_reverse
-                crm      = crm_dict[r.tid]
-                len_seq  = len(r.seq)
-                if positive:
-                    pos = r.pos + 1
-                else:
-                    pos = r.pos + len_seq
-                try:
-                    frag_piece = frags[crm][pos / frag_chunk]
-                except KeyError:
-                    # Chromosome not in hash
-                    continue
-                idx = bisect(frag_piece, pos)
-                try:
-                    next_re = frag_piece[idx]
-                except IndexError:
-                    # case where part of the read is mapped outside chromosome
-                    count = 0
-                    while idx >= len(frag_piece) and count < len_seq:
-                        pos -= 1
-                        count += 1
-                        frag_piece = frags[crm][pos / frag_chunk]
-                        idx = bisect(frag_piece, pos)
-                    if count >= len_seq:
-                        raise Exception('Read mapped mostly outside ' +
-                                        'chromosome\n')
-                    next_re    = frag_piece[idx]
-                prev_re    = frag_piece[idx - 1 if idx else 0]
-                name       = r.qname
-                reads.append('%s\t%s\t%d\t%d\t%d\t%d\t%d\n' % (
-                    name, crm, pos, positive, len_seq, prev_re, next_re))
-                windows[read][num] += 1
-                sub_count += 1
-                if sub_count >= max_size:
-                    sub_count = 0
-                    nfile += 1
-                    write_reads_to_file(reads, outfiles[read], tmp_files, nfile)
-            nfile += 1
-            write_reads_to_file(reads, outfiles[read], tmp_files, nfile)
+            fhandler.close()
+            inputs[read].append((num, nfnam, fnam))
 
+    if ncpus > 1:
+        # each input file is parsed by a worker into sorted temporary files
+        pool = mu.Pool(ncpus, initializer=_init_parser,
+                       initargs=(mapper, re_sites))
+        jobs = {}
+        for read in inputs:
+            jobs[read] = [pool.apply_async(
+                _parse_file_worker, args=(
+                    fnam, '%s_%d' % (outfiles[read], nfnam), max_memory / ncpus))
+                          for _, nfnam, fnam in inputs[read]]
+        pool.close()
 
-        # we have now sorted temporary files
-        # we do merge sort for eah pair
+    windows = {}
+    multis  = {}
+    procs   = []
+    for read in range(len(fnames)):
         if verbose:
-            stdout.write('Merge sort')
-            stdout.flush()
-        while len(tmp_files) > 1:
-            file1 = tmp_files.pop(0)
-            try:
-                file2 = tmp_files.pop(0)
-            except IndexError:
-                break
+            print 'Loading read' + str(read + 1)
+        windows[read] = {}
+        # iteration over reads
+        tmp_files = []
+        reads     = []
+        memory    = 0
+        for nfile, (num, _, fnam) in enumerate(inputs[read]):
+            # set read counter
+            windows[read].setdefault(num, 0)
             if verbose:
-                stdout.write('.')
-            stdout.flush()
-            nfile += 1
-            tmp_files.append(merge_sort(file1, file2, outfiles[read], nfile))
-        if verbose:
-            stdout.write('\n')
-        tmp_name = tmp_files[0]
-        
+                print 'loading SAM file from %s: %s' % (mapper, fnam)
+            # sorted temporary files are kept in the order of the input files
+            if ncpus > 1:
+                read_count, runs = jobs[read][nfile].get()
+                tmp_files.extend(runs)
+            else:
+                read_count, memory = _parse_file(
+                    fnam, reads, memory, max_memory, outfiles[read], tmp_files,
+                    mapper, re_sites)
+            windows[read][num] += read_count
+
+        # sorted reads, merged from the temporary files in a single pass (if
+        # they did not all fit in memory)
+        if tmp_files:
+            write_reads_to_file(reads, outfiles[read], tmp_files,
+                                len(tmp_files) + 1)
+            if verbose:
+                print 'Merge sort (%d files)' % len(tmp_files)
+            sorted_reads = merge_sorted_files(tmp_files, _read_key,
+                                              clean=clean)
+        else:
+            sorted_reads = iter(sorted(reads, key=_read_key))
+            del(reads)
+
         if verbose:
             print 'Getting Multiple contacts'
         reads_fh = open(outfiles[read], 'w')
@@ -196,20 +169,17 @@ def parse_sam(f_names1, f_names2=None, out_file1=None, out_file2=None,
             reads_fh.write('# MAPPED %d %d\n' % (size, windows[read][size]))
 
         ## Multicontacts
-        tmp_reads_fh = open(tmp_name)
         try:
-            read_line = tmp_reads_fh.next()
+            read_line = sorted_reads.next()
         except StopIteration:
             raise StopIteration('ERROR!\n Nothing parsed, check input files and'
                                 ' chromosome names (in genome.fasta and SAM/MAP'
                                 ' files).')
-        prev_head = read_line.split('\t', 1)[0]
-        prev_head = prev_head.split('~' , 1)[0]
+        prev_head = _read_key(read_line)
         prev_read = read_line
         multis[read] = 0
-        for read_line in tmp_reads_fh:
-            head = read_line.split('\t', 1)[0]
-            head = head.split('~' , 1)[0]
+        for read_line in sorted_reads:
+            head = _read_key(read_line)
             if head == prev_head:
                 multis[read] += 1
                 prev_read =  prev_read.strip() + '|||' + read_line
@@ -219,14 +189,130 @@ def parse_sam(f_names1, f_names2=None, out_file1=None, out_file2=None,
             prev_head = head
         reads_fh.write(prev_read)
         reads_fh.close()
-        if clean:
-            os.system('rm -rf ' + tmp_name)
+    if ncpus > 1:
+        pool.join()
     # wait for compression to finish
     for p in procs:
         p.communicate()
     return windows, multis
 
-def parse_gem_3c(f_name, out_file, genome_lengths, frags, verbose=False,
+def _parse_file(fnam, reads, memory, max_memory, outfile, tmp_files,
+                mapper, re_sites):
+    """
+    Parses the reads of a SAM/BAM file. Reads are accumulated in a list, and
+    written, sorted, to temporary files when they exceed a given memory.
+
+    :param fnam: path to the SAM/BAM file
+    :param reads: list of parsed reads
+    :param memory: approximate memory used by the reads already in the list
+    :param max_memory: approximate memory (in bytes) above which reads are
+       written to a temporary file
+    :param outfile: path to the final output file (temporary files are written
+       next to it)
+    :param tmp_files: list of temporary files, new ones are appended to it
+    :param mapper: software used to map
+    :param re_sites: RE sites per chromosome (see
+       :func:`pytadbit.mapping.restriction_enzymes.index_re_sites`)
+
+    :returns: the number of reads parsed and the approximate memory used by the
+       reads in the list
+    """
+    fhandler = Samfile(fnam)
+    if mapper.lower()=='gem':
+        condition = lambda x: x[1][0][0] != 'N'
+    elif mapper.lower() in ['bowtie', 'bowtie2']:
+        condition = lambda x: 'XS' in dict(x)
+    else:
+        warn('WARNING: unrecognized mapper used to generate file\n')
+        condition = lambda x: x[1][1] != 1
+    # getrname chromosome names
+    i = 0
+    crm_dict = {}
+    while True:
+        try:
+            crm_dict[i] = fhandler.getrname(i)
+            i += 1
+        except ValueError:
+            break
+    # iteration over reads, the RE sites around them are searched by batches
+    read_count = 0
+    batch = ([], [], [], [], [])
+    for r in fhandler:
+        if r.is_unmapped:
+            continue
+        if condition(r.tags):
+            continue
+        crm = crm_dict[r.tid]
+        if not crm in re_sites:
+            # Chromosome not in hash
+            continue
+        positive = not r.is_reverse
+        len_seq  = len(r.seq)
+        if positive:
+            pos = r.pos + 1
+        else:
+            pos = r.pos + len_seq
+        for column, value in izip(batch, (r.qname, crm, pos, positive, len_seq)):
+            column.append(value)
+        if len(batch[0]) < READ_BATCH:
+            continue
+        memory = _add_reads(batch, re_sites, reads, memory)
+        read_count += len(batch[0])
+        batch = ([], [], [], [], [])
+        if memory > max_memory:
+            memory = 0
+            write_reads_to_file(reads, outfile, tmp_files, len(tmp_files) + 1)
+    memory = _add_reads(batch, re_sites, reads, memory)
+    read_count += len(batch[0])
+    if memory > max_memory:
+        memory = 0
+        write_reads_to_file(reads, outfile, tmp_files, len(tmp_files) + 1)
+    fhandler.close()
+    return read_count, memory
+
+
+def _add_reads(batch, re_sites, reads, memory):
+    """
+    Formats a batch of reads (as columns of names, chromosomes, positions,
+    strands and lengths), with the RE sites around them, and appends them to a
+    list of reads.
+
+    :returns: the approximate memory used by the list of reads
+    """
+    names, crms, poss, strands, lens = batch
+    if not names:
+        return memory
+    poss, prev_re, next_re = find_reads_re_sites(re_sites, crms, poss, lens)
+    new = ['%s\t%s\t%d\t%d\t%d\t%d\t%d\n' % read
+           for read in izip(names, crms, poss.tolist(), strands, lens,
+                            prev_re.tolist(), next_re.tolist())]
+    reads.extend(new)
+    return memory + sum(len(r) for r in new) + LINE_OVERHEAD * len(new)
+
+
+def _init_parser(*args):
+    """
+    Stores, in each worker, the arguments shared by all the files to parse
+    """
+    global _PARSER_ARGS
+    _PARSER_ARGS = args
+
+
+def _parse_file_worker(fnam, outfile, max_memory):
+    """
+    Parses a SAM/BAM file into sorted temporary files
+
+    :returns: the number of reads parsed and the list of temporary files
+    """
+    reads = []
+    tmp_files = []
+    read_count, _ = _parse_file(fnam, reads, 0, max_memory, outfile,
+                                tmp_files, *_PARSER_ARGS)
+    write_reads_to_file(reads, outfile, tmp_files, len(tmp_files) + 1)
+    return read_count, tmp_files
+
+
+def parse_gem_3c(f_name, out_file, genome_lengths, re_sites, verbose=False,
                  tmp_format=False, **kwargs):
     """
     Parse gem 3c sam file using pysam tools.
@@ -235,10 +321,11 @@ def parse_gem_3c(f_name, out_file, genome_lengths, frags, verbose=False,
     :param out_file: path to outfile tab separated format containing paired read information
     :param genome_lengths: a dictionary generated containing the length of the genomic sequence
                            per chromosome
+    :param re_sites: RE sites per chromosome (see
+       :func:`pytadbit.mapping.restriction_enzymes.index_re_sites`)
     :param False tmp_format: If True leave the file prepared to be merged with other map files.
     """
 
-    frag_chunk = kwargs.get('frag_chunk', 100000)
     try:
         fhandler = Samfile(f_name)
     except IOError:
@@ -323,27 +410,13 @@ def parse_gem_3c(f_name, out_file, genome_lengths, frags, verbose=False,
                 else:
                     pos = read.pos + len_seq
                 try:
-                    frag_piece = frags[crm][pos / frag_chunk]
+                    sites = re_sites[crm]
                 except KeyError:
                     # Chromosome not in hash
                     read_multi = []
                     break
-                idx = bisect(frag_piece, pos)
-                try:
-                    next_re = frag_piece[idx]
-                except IndexError:
-                    # case where part of the read is mapped outside chromosome
-                    count = 0
-                    while idx >= len(frag_piece) and count < len_seq:
-                        pos -= 1
-                        count += 1
-                        frag_piece = frags[crm][pos / frag_chunk]
-                        idx = bisect(frag_piece, pos)
-                    if count >= len_seq:
-                        raise Exception('Read mapped mostly outside ' +
-                                        'chromosome\n')
-                    next_re    = frag_piece[idx]
-                prev_re    = frag_piece[idx - 1 if idx else 0]
+                pos, prev_re, next_re = [
+                    int(v[0]) for v in find_re_sites(sites, [pos], [len_seq])]
                 reads_grp.append([read.tid, crm, pos, positive,
                                   len_seq, prev_re, next_re])
             if len(reads_grp) > 2:
@@ -388,40 +461,57 @@ def parse_gem_3c(f_name, out_file, genome_lengths, frags, verbose=False,
         #map_out.write('\n'.join(reads))
 
     #map_out.close()
-    # we have now sorted temporary files
-    # we do merge sort for eah pair
-    if verbose:
-        stdout.write('Merge sort')
-        stdout.flush()
-    while len(tmp_files) > 1:
-        file1 = tmp_files.pop(0)
-        try:
-            file2 = tmp_files.pop(0)
-        except IndexError:
-            break
-        if verbose:
-            stdout.write('.')
-        stdout.flush()
-        nfile += 1
-        tmp_files.append(merge_sort(file1, file2, out_file, nfile, paired=True))
+    # we have now sorted temporary files, merged in a single pass
     if verbose:
-        stdout.write('\n')
-
-    if tmp_format:
+        print 'Merge sort (%d files)' % len(tmp_files)
+    if tmp_format and len(tmp_files) == 1:
         os.rename(tmp_files[0], out_file)
-    else:
-        map_out   = open(out_file, 'w')
-        tmp_reads_fh = open(tmp_files[0],'rb')
-        for crm in genome_lengths:
-            map_out.write('# CRM %s\t%d\n' % (crm, genome_lengths[crm]))
-        for read_line in tmp_reads_fh:
-            read = read_line.split('\t')
-            map_out.write('\t'.join([read[0]]+read[2:8]+read[9:]))
+    elif tmp_format:
+        map_out = open(out_file, 'w')
+        map_out.writelines(merge_sorted_files(tmp_files, _paired_read_key))
         map_out.close()
-        os.system('rm -rf ' + tmp_files[0])
+    else:
+        write_paired_reads(merge_sorted_files(tmp_files, _paired_read_key),
+                           out_file, genome_lengths)
 
     return out_file
 
+def _read_key(read_line):
+    """
+    Sort key of a parsed read: its identifier (without the suffix of the
+    fragment, if any)
+    """
+    return read_line.split('\t', 1)[0].split('~', 1)[0]
+
+
+def _paired_read_key(read_line):
+    """
+    Sort key of a parsed pair of reads (in the temporary format of
+    :func:`parse_gem_3c`): chromosome index and position of both read-ends
+    """
+    read = read_line.split('\t', 11)
+    return int(read[1]), int(read[3]), int(read[8]), int(read[10])
+
+
+def write_paired_reads(read_lines, out_file, genome_lengths):
+    """
+    Writes sorted pairs of reads (in the temporary format of
+    :func:`parse_gem_3c`) to the final TADbit paired-reads file
+
+    :param read_lines: iterable of sorted pairs of reads
+    :param out_file: path to the output file
+    :param genome_lengths: a dictionary containing the length of each
+       chromosome
+    """
+    map_out = open(out_file, 'w')
+    for crm in genome_lengths:
+        map_out.write('# CRM %s\t%d\n' % (crm, genome_lengths[crm]))
+    for read_line in read_lines:
+        read = read_line.split('\t')
+        map_out.write('\t'.join([read[0]] + read[2:8] + read[9:]))
+    map_out.close()
+
+
 def write_reads_to_file(reads, outfiles, tmp_files, nfile):
     if not reads: # can be...
         return
@@ -430,7 +520,7 @@ def write_reads_to_file(reads, outfiles, tmp_files, nfile):
     tmp_name = ('/' * outfiles.startswith('/')) + tmp_name
     tmp_files.append(tmp_name)
     out = open(tmp_name, 'w')
-    out.write(''.join(sorted(reads, key=lambda x: x.split('\t', 1)[0].split('~')[0])))
+    out.write(''.join(sorted(reads, key=_read_key)))
     out.close()
     del(reads[:]) # empty list
 
@@ -489,45 +579,3 @@ def _merge_multis(reads_multi):
 
     reads_multi = merged_reads
 
-
-def merge_sort(file1, file2, outfiles, nfile, paired=False):
-    tmp_name = os.path.join(*outfiles.split('/')[:-1] +
-                            [('tmp_merged_%03d_' % nfile) + outfiles.split('/')[-1]])
-    tmp_name = ('/' * outfiles.startswith('/')) + tmp_name
-    tmp_file = open(tmp_name, 'w')
-    fh1 = open(file1)
-    fh2 = open(file2)
-    if paired:
-        greater = lambda x, y: [y,x] == sorted([y,x], key=lambda j: (int(j.split('\t')[1]),
-                                                                 float(j.split('\t')[3]),
-                                                                 int(j.split('\t')[8]),
-                                                                 float(j.split('\t')[10])))
-    else:
-        greater = lambda x, y: x.split('\t', 1)[0].split('~')[0] > y.split('\t', 1)[0].split('~')[0]
-    read1 = fh1.next()
-    read2 = fh2.next()
-    while True:
-        if greater(read2, read1):
-            tmp_file.write(read1)
-            try:
-                read1 = fh1.next()
-            except StopIteration:
-                tmp_file.write(read2)
-                break
-        else:
-            tmp_file.write(read2)
-            try:
-                read2 = fh2.next()
-            except StopIteration:
-                tmp_file.write(read1)
-                break
-    for read in fh1:
-        tmp_file.write(read)
-    for read in fh2:
-        tmp_file.write(read)
-    fh1.close()
-    fh2.close()
-    tmp_file.close()
-    os.system('rm -f ' + file1)
-    os.system('rm -f ' + file2)
-    return tmp_name
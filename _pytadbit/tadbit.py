@@ -31,7 +31,8 @@ def tadbit(x, remove=None, n_cpus=1, verbose=True,
     :param x: a square matrix of interaction counts in the HI-C data or a list
        of such matrices for replicated experiments. The counts must be evenly
        sampled and not normalized. x might be either a list of list, a path to
-       a file or a file handler
+       a file, a file handler, a HiC_data object or a view of one of its
+       chromosomes (see :func:`pytadbit.hic_data.HiC_data.get_region`)
     :argument 'visibility' norm: kind of normalization to use. Choose between
        'visibility' of 'Imakaev'
     :argument None remove: a python list of lists of booleans mapping positively
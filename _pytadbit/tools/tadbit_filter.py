@@ -24,6 +24,8 @@ from pytadbit.utils.sqlite_utils     import already_run, digest_parameters
 from pytadbit.mapping.analyze        import fragment_size
 from pytadbit.mapping.filter         import filter_reads, apply_filter
 from pytadbit.parsers.hic_bam_parser import bed2D_to_BAMhic
+from pytadbit.parsers.contact_index  import build_contact_index
+from pytadbit.parsers.contact_index  import get_contact_index
 
 
 DESC = "Filter parsed Hi-C reads and get valid pair of reads to work with"
@@ -35,7 +37,7 @@ def run(opts):
 
     fname1, fname2 = load_parameters_fromdb(opts)
 
-    param_hash = digest_parameters(opts)
+    param_hash = digest_parameters(opts, extra=['contact_index', 'samtools'])
 
     reads = path.join(opts.workdir, '03_filtered_reads',
                       'all_r1-r2_intersection_%s.tsv' % param_hash)
@@ -97,6 +99,9 @@ def run(opts):
         infile = reads
     bed2D_to_BAMhic(infile, opts.valid, opts.cpus, outbam, opts.format, masked,
                     samtools=opts.samtools)
+    if opts.contact_index:
+        print 'Building contact index of the BAM file...'
+        build_contact_index(outbam + '.bam')
 
     finish_time = time.localtime()
     print median, max_f, mad
@@ -148,7 +153,8 @@ def save_to_db(opts, count, multiples, reads, mreads, n_valid_pairs, masked,
             unique (PATHid))""")
         try:
             parameters = digest_parameters(opts, get_md5=False)
-            param_hash = digest_parameters(opts, get_md5=True )
+            param_hash = digest_parameters(opts, get_md5=True ,
+                                           extra=['contact_index', 'samtools'])
             cur.execute("""
     insert into JOBs
      (Id  , Parameters, Launch_time, Finish_time,    Type, Parameters_md5)
@@ -438,9 +444,18 @@ def populate_args(parser):
                         with format "short" or valid options, this may results
                         in losing data''')
 
+    output.add_argument('--contact_index', dest='contact_index',
+                        default=False, action='store_true',
+                        help='''build a sidecar index of the contacts of the
+                        output BAM file (written next to it, with the ".tci"
+                        extension). Matrices of small regions are then
+                        extracted from this index, without reading the BAM
+                        file (e.g. with tadbit bin)''')
+
     glopts.add_argument('--samtools', dest='samtools', metavar="PATH",
-                        action='store', default='samtools', type=str,
-                        help='''path samtools binary''')
+                        action='store', default=None, type=str,
+                        help='''path samtools binary, if not given the output
+                        BAM is sorted, compressed and indexed with pysam''')
 
     parser.add_argument_group(glopts)
 
@@ -472,10 +487,22 @@ def check_options(opts):
             pass
 
     # check if job already run using md5 digestion of parameters
-    if already_run(opts):
+    if already_run(opts, extra=['contact_index', 'samtools']):
         if not opts.force:
             if 'tmpdb' in opts and opts.tmpdb:
                 remove(path.join(dbdir, dbfile))
+            # contact_index is not part of the parameter digestion, build the
+            # index of the BAM already filtered if it is missing
+            outbam = path.join(opts.workdir, '03_filtered_reads',
+                               'intersection_%s.bam' % digest_parameters(
+                                   opts, extra=['contact_index', 'samtools']))
+            if opts.contact_index and path.exists(outbam):
+                index = get_contact_index(outbam)
+                if index is None:
+                    print 'Building contact index of the BAM file...'
+                    build_contact_index(outbam)
+                else:
+                    index.close()
             exit('WARNING: exact same job already computed, see JOBs table above')
         else:
             warn('WARNING: exact same job already computed, overwriting...')
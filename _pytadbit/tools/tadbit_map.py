@@ -92,7 +92,8 @@ def run(opts):
                                 clean=not opts.keep_tmp, get_nread=True,
                                 mapper_binary=opts.mapper_binary,
                                 mapper_params=opts.mapper_param, suffix=param_hash,
-                                temp_dir=temp_dir, nthreads=opts.cpus)
+                                temp_dir=temp_dir, nthreads=opts.cpus,
+                                genome_path=opts.genome)
     else:
         logging.info('mapping %s read %s to %s', opts.fastq, opts.read, opts.workdir)
         outfiles = full_mapping(opts.index, opts.fastq,
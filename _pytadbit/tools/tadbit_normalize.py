@@ -6,13 +6,12 @@ information needed
 
 """
 from argparse                             import HelpFormatter
-from os                                   import path, remove, system
-from sys                                  import exc_info, stdout
+from os                                   import path, remove
 from string                               import ascii_letters
-from random                               import random
+from random                               import random, getrandbits
 from shutil                               import copyfile, rmtree
-from collections                          import OrderedDict, defaultdict
-from cPickle                              import dump, load, HIGHEST_PROTOCOL
+from collections                          import defaultdict
+from cPickle                              import dump, HIGHEST_PROTOCOL
 from traceback                            import print_exc
 from multiprocessing                      import cpu_count
 import multiprocessing  as mu
@@ -21,6 +20,7 @@ import time
 
 from pysam                                import AlignmentFile
 from numpy                                import nanmean, isnan, nansum, seterr
+import numpy as np
 
 from pytadbit                             import load_hic_data_from_bam
 from pytadbit.utils.sqlite_utils          import already_run, digest_parameters
@@ -29,13 +29,19 @@ from pytadbit.utils.file_handling         import mkdir
 from pytadbit.mapping.analyze             import plot_distance_vs_interactions
 from pytadbit.mapping.filter              import MASKED
 from pytadbit.parsers.hic_bam_parser      import printime, print_progress
-from pytadbit.parsers.hic_bam_parser      import filters_to_bin
+from pytadbit.parsers.hic_bam_parser      import filters_to_bin, plan_chunks
+from pytadbit.parsers.hic_bam_parser      import largest_first, timed_call
+from pytadbit.parsers.hic_bam_parser      import chunk_timing_report
+from pytadbit.parsers.hic_bam_parser      import _bam_bins, _read_bam_frag
+from pytadbit.parsers.hic_bam_parser      import _iter_chunk_arrays
 from pytadbit.parsers.bed_parser          import parse_mappability_bedGraph
 from pytadbit.utils.extraviews            import nicer
 from pytadbit.utils.hic_filtering         import filter_by_cis_percentage
 from pytadbit.utils.normalize_hic         import oneD
 from pytadbit.mapping.restriction_enzymes import RESTRICTION_ENZYMES
+from pytadbit.mapping.restriction_enzymes import index_re_sites
 from pytadbit.parsers.genome_parser       import parse_fasta, get_gc_content
+from pytadbit.parsers.genome_parser       import genome_cache_prefix
 
 # removes annoying message when normalizing...
 seterr(invalid='ignore')
@@ -109,15 +115,14 @@ def run(opts):
         printime('  - Computing GC content per bin (removing Ns)')
         gc_content = get_gc_content(genome, opts.reso, chromosomes=refs,
                                     n_cpus=opts.cpus)
-        # compute r_sites ~30 sec
-        # TODO: read from DB
+        # compute r_sites (RE sites cached next to the genome)
         printime('  - Computing number of RE sites per bin (+/- 200 bp)')
+        re_sites = index_re_sites(opts.renz, genome,
+                                  cache_prefix=genome_cache_prefix(opts.fasta))
         n_rsites  = []
-        re_site = RESTRICTION_ENZYMES[opts.renz].replace('|', '')
         for crm in refs:
-            for pos in xrange(200, len(genome[crm]) + 200, opts.reso):
-                seq = genome[crm][pos-200:pos + opts.reso + 200]
-                n_rsites.append(seq.count(re_site))
+            n_rsites.extend(_count_re_sites(re_sites[crm], len(genome[crm]),
+                                            opts.renz, opts.reso))
 
         ## CHECK TO BE REMOVED
         # out = open('tmp_mappability.txt', 'w')
@@ -136,7 +141,8 @@ def run(opts):
         p_fit=opts.p_fit, cg_content=gc_content, n_rsites=n_rsites,
         min_perc=opts.min_perc, max_perc=opts.max_perc, seed=opts.seed,
         normalize_only=opts.normalize_only, max_njobs=opts.max_njobs,
-        extra_bads=opts.badcols, biases_path=opts.biases_path)
+        extra_bads=opts.badcols, biases_path=opts.biases_path,
+        cis_only=opts.cis_only)
 
     bad_col_image = path.join(outdir, 'filtered_bins_%s_%s.png' % (
         nicer(opts.reso).replace(' ', ''), param_hash))
@@ -414,9 +420,16 @@ def populate_args(parser):
 
     normpt.add_argument('--normalization', dest='normalization', metavar="STR",
                         action='store', default='Vanilla', type=str,
-                        choices=['Vanilla', 'ICE', 'SQRT', 'oneD', 'custom'],
+                        choices=['Vanilla', 'ICE', 'KR', 'SQRT', 'oneD',
+                                 'custom'],
                         help='''[%(default)s] normalization(s) to apply.
                         Order matters. Choices: %(choices)s''')
+    normpt.add_argument('--cis_only', dest='cis_only', action='store_true',
+                        default=False,
+                        help='''Only for KR normalization: balance each
+                        chromosome independently, using only
+                        intra-chromosomal interactions''')
+
     normpt.add_argument('--biases_path', dest='biases_path', type=str,
                         default=None, help='''biases file to compute decay.
                         REQUIRED with "custom" normalization. Format: single
@@ -565,195 +578,129 @@ def nice(reso):
     return '%dkb' % (reso / 1000)
 
 
-################################################################################
-## TODO: This should be handled in the hic bam parser
+def _count_re_sites(sites, length, renz, reso, margin=200):
+    """
+    Number of complete RE sites in windows of the size of the bins, plus twice
+    a margin, starting every bin
 
-def read_bam_frag_valid(inbam, filter_exclude, all_bins, sections,
-                  resolution, outdir, extra_out,region, start, end):
-    bamfile = AlignmentFile(inbam, 'rb')
-    refs = bamfile.references
-    try:
-        dico = {}
-        for r in bamfile.fetch(region=region,
-                               start=start - (1 if start else 0), end=end,  # coords starts at 0
-                               multiple_iterators=True):
-            crm1 = r.reference_name
-            pos1 = r.reference_start + 1
-            crm2 = refs[r.mrnm]
-            pos2 = r.mpos + 1
-            try:
-                pos1 = sections[(crm1, pos1 / resolution)]
-                pos2 = sections[(crm2, pos2 / resolution)]
-            except KeyError:
-                continue  # not in the subset matrix we want
-            try:
-                dico[(pos1, pos2)] += 1
-            except KeyError:
-                dico[(pos1, pos2)] = 1
-        cisprc = {}
-        for (i, j), v in dico.iteritems():
-            if all_bins[i][0] == all_bins[j][0]:
-                try:
-                    cisprc[i][0] += v
-                    cisprc[i][1] += v
-                except KeyError:
-                    cisprc[i] = [v, v]
-            else:
-                try:
-                    cisprc[i][1] += v
-                except KeyError:
-                    cisprc[i] = [0, v]
-        out = open(path.join(outdir,
-                             'tmp_%s:%d-%d_%s.pickle' % (region, start, end, extra_out)), 'w')
-        dump(dico, out, HIGHEST_PROTOCOL)
-        out.close()
-        out = open(path.join(outdir,
-                             'tmp_bins_%s:%d-%d_%s.pickle' % (region, start, end, extra_out)), 'w')
-        dump(cisprc, out, HIGHEST_PROTOCOL)
-        out.close()
-    except Exception, e:
-        exc_type, exc_obj, exc_tb = exc_info()
-        fname = path.split(exc_tb.tb_frame.f_code.co_filename)[1]
-        print e
-        print(exc_type, fname, exc_tb.tb_lineno)
-
-
-def read_bam_frag_filter(inbam, filter_exclude, all_bins, sections,
-                         resolution, outdir, extra_out,region, start, end):
-    bamfile = AlignmentFile(inbam, 'rb')
-    refs = bamfile.references
-    try:
-        dico = {}
-        for r in bamfile.fetch(region=region,
-                               start=start - (1 if start else 0), end=end,  # coords starts at 0
-                               multiple_iterators=True):
-            if r.flag & filter_exclude:
-                continue
-            crm1 = r.reference_name
-            pos1 = r.reference_start + 1
-            crm2 = refs[r.mrnm]
-            pos2 = r.mpos + 1
-            try:
-                pos1 = sections[(crm1, pos1 / resolution)]
-                pos2 = sections[(crm2, pos2 / resolution)]
-            except KeyError:
-                continue  # not in the subset matrix we want
-            try:
-                dico[(pos1, pos2)] += 1
-            except KeyError:
-                dico[(pos1, pos2)] = 1
-        cisprc = {}
-        for (i, j), v in dico.iteritems():
-            if all_bins[i][0] == all_bins[j][0]:
-                try:
-                    cisprc[i][0] += v
-                    cisprc[i][1] += v
-                except KeyError:
-                    cisprc[i] = [v, v]
-            else:
-                try:
-                    cisprc[i][1] += v
-                except KeyError:
-                    cisprc[i] = [0, v]
-        out = open(path.join(outdir,
-                             'tmp_%s:%d-%d_%s.pickle' % (region, start, end, extra_out)), 'w')
-        dump(dico, out, HIGHEST_PROTOCOL)
-        out.close()
-        out = open(path.join(outdir, 'tmp_bins_%s:%d-%d_%s.pickle' % (
-            region, start, end, extra_out)), 'w')
-        dump(cisprc, out, HIGHEST_PROTOCOL)
-        out.close()
-    except Exception, e:
-        exc_type, exc_obj, exc_tb = exc_info()
-        fname = path.split(exc_tb.tb_frame.f_code.co_filename)[1]
-        print e
-        print(exc_type, fname, exc_tb.tb_lineno)
+    :param sites: sorted array of RE sites of a chromosome (from
+       :func:`pytadbit.mapping.restriction_enzymes.index_re_sites`)
+    :param length: length of the chromosome
+    :param renz: name of the restriction enzyme
+    :param reso: resolution
+    :param 200 margin: margin around each bin
+
+    :returns: a list with the number of RE sites in each bin
+    """
+    beg, end = RESTRICTION_ENZYMES[renz].split('|')
+    # remove the chromosome start and end added to the RE sites
+    sites = sites[1:]
+    sites = np.delete(sites, sites.searchsorted(length))
+    # RE sites are found after the cut, within the recognition sequence
+    starts = np.arange(margin, length + margin, reso) - margin
+    ends   = np.minimum(starts + reso + 2 * margin, length)
+    counts = (sites.searchsorted(ends - len(beg + end) + len(beg) + 1, 'right') -
+              sites.searchsorted(starts + len(beg) + 1, 'left'))
+    return np.maximum(counts, 0).tolist()
+
+
+def _valid_cells_per_diagonal(valid):
+    """
+    :param valid: boolean array, True for the valid bins of a chromosome
+
+    :returns: number of cells between two valid bins in each diagonal of the
+       matrix of the chromosome
+    """
+    size = len(valid)
+    fft = np.fft.rfft(valid.astype(float), 2 * size)
+    return np.rint(np.fft.irfft(fft * fft.conj(), 2 * size)[:size]).astype(int)
+
+
+def sum_normalized_chunks(arrays, biases, bads, first_bins, size):
+    """
+    Sums, in a single pass over the interactions parsed from a BAM file, the
+    normalized interactions needed to rescale biases, to compute the
+    percentage of cis interactions and the decay.
+
+    :param arrays: iterator over the interactions of each chunk (see
+       :func:`pytadbit.parsers.hic_bam_parser._iter_chunk_arrays`)
+    :param biases: array of biases
+    :param bads: boolean array, True for bad columns
+    :param first_bins: array with the first bin of each chromosome
+    :param size: number of bins in the genome
+
+    :returns: the sum of all normalized interactions, the sum of normalized
+       cis interactions and of all normalized interactions (between valid bins
+       in the lower half of the matrix), and the normalized and raw sums of
+       cis interactions per diagonal (indexed by the first bin of the
+       chromosome plus the distance in bins)
+    """
+    sumnrm = cis = total = 0.
+    nrmdec = np.zeros(size)
+    rawdec = np.zeros(size)
+    for _, dico in arrays:
+        rows, cols = dico['row'], dico['col']
+        counts = dico['count'].astype(float)
+        values = counts / biases[rows] / biases[cols]
+        sumnrm += nansum(values)
+        good = ~(bads[rows] | bads[cols])
+        same = dico['crm'] >= 0
+        lower = good & (rows > cols)
+        cis   += values[lower & same].sum()
+        total += values[lower].sum()
+        diag = good & same & (rows >= cols)
+        dists = first_bins[dico['crm'][diag]] + rows[diag] - cols[diag]
+        nrmdec += np.bincount(dists, weights=values[diag], minlength=size)
+        rawdec += np.bincount(dists, weights=counts[diag], minlength=size)
+    return sumnrm, cis, total, nrmdec, rawdec
 
 
 def read_bam(inbam, filter_exclude, resolution, min_count=2500, biases_path='',
              normalization='Vanilla', mappability=None, n_rsites=None,
              cg_content=None, sigma=2, ncpus=8, factor=1, outdir='.', seed=1,
              extra_out='', only_valid=False, normalize_only=False, p_fit=None,
-             max_njobs=100, min_perc=None, max_perc=None, extra_bads=None):
+             max_njobs=100, min_perc=None, max_perc=None, extra_bads=None,
+             cis_only=False):
     bamfile = AlignmentFile(inbam, 'rb')
-    sections = OrderedDict(zip(bamfile.references,
-                               [x / resolution + 1 for x in bamfile.lengths]))
-    total = 0
-    section_pos = dict()
-    for crm in sections:
-        section_pos[crm] = (total, total + sections[crm])
-        total += sections[crm]
-    bins = []
-    for crm in sections:
-        len_crm = sections[crm]
-        bins.extend([(crm, i) for i in xrange(len_crm)])
-
-    start_bin = 0
-    end_bin   = len(bins)
-    total     = len(bins)
-
-    regs = []
-    begs = []
-    ends = []
-    njobs = min(total, max_njobs) + 1
-    nbins = total / njobs + 1
-    for i in range(start_bin, end_bin, nbins):
-        if i + nbins > end_bin:  # make sure that we stop
-            nbins = end_bin - i
-        try:
-            (crm1, beg1), (crm2, end2) = bins[i], bins[i + nbins - 1]
-        except IndexError:
-            try:
-                (crm1, beg1), (crm2, end2) = bins[i], bins[-1]
-            except IndexError:
-                break
-        if crm1 != crm2:
-            end1 = sections[crm1]
-            beg2 = 0
-            regs.append(crm1)
-            regs.append(crm2)
-            begs.append(beg1 * resolution)
-            begs.append(beg2 * resolution)
-            ends.append(end1 * resolution + resolution)  # last nt included
-            ends.append(end2 * resolution + resolution - 1)  # last nt not included (overlap with next window)
-        else:
-            regs.append(crm1)
-            begs.append(beg1 * resolution)
-            ends.append(end2 * resolution + resolution - 1)
-    ends[-1] += 1  # last nucleotide included
+    sections, first_bins, bin_coords = _bam_bins(bamfile, resolution)
+    section_pos = dict((crm, (int(first_bins[i]),
+                              int(first_bins[i]) + sections[crm]))
+                       for i, crm in enumerate(sections))
+    total = bin_coords[1]
+
+    # chunks with similar number of reads
+    regs, begs, ends, nreads = plan_chunks(inbam, sections, 0, total,
+                                           resolution, max_njobs)
+    chunks = regs, begs, ends
 
-    # print '\n'.join(['%s %d %d' % (a, b, c) for a, b, c in zip(regs, begs, ends)])
     printime('  - Parsing BAM (%d chunks)' % (len(regs)))
-    bins_dict = dict([(j, i) for i, j in enumerate(bins)])
+    # each chunk is counted into a temporary array, and its marginals (sum of
+    # interactions, and of cis interactions, per bin) are returned
+    rand_hash = "%016x" % getrandbits(64)
+    mkdir(path.join(outdir, '_tmp_%s' % (rand_hash)))
     pool = mu.Pool(ncpus)
-    procs = []
-    read_bam_frag = read_bam_frag_valid if only_valid else read_bam_frag_filter
-    for i, (region, start, end) in enumerate(zip(regs, begs, ends)):
-        procs.append(pool.apply_async(
-            read_bam_frag, args=(inbam, filter_exclude, bins, bins_dict,
-                                 resolution, outdir, extra_out,
-                                 region, start, end,)))
+    procs = {}
+    for i in largest_first(nreads):
+        procs[i] = pool.apply_async(
+            timed_call, args=(_read_bam_frag, inbam,
+                              0 if only_valid else filter_exclude,
+                              first_bins, bin_coords, rand_hash, resolution,
+                              outdir, regs[i], begs[i], ends[i], False, True))
     pool.close()
-    print_progress(procs)
+    print_progress(procs.values())
     pool.join()
-    ## COLLECT RESULTS
-    cisprc = {}
-    printime('  - Collecting cis and total interactions per bin (%d chunks)' % (len(regs)))
-    stdout.write('     ')
-    for countbin, (region, start, end) in enumerate(zip(regs, begs, ends)):
-        if not countbin % 10 and countbin:
-            stdout.write(' ')
-        if not countbin % 50 and countbin:
-            stdout.write(' %9s\n     ' % ('%s/%s' % (countbin , len(regs))))
-        stdout.write('.')
-        stdout.flush()
-
-        fname = path.join(outdir,
-                          'tmp_bins_%s:%d-%d_%s.pickle' % (region, start, end, extra_out))
-        tmp_cisprc = load(open(fname))
-        system('rm -f %s' % fname)
-        cisprc.update(tmp_cisprc)
-    stdout.write('\n')
+    results = [procs[i].get() for i in xrange(len(regs))]
+    chunk_timing_report(chunks, nreads, [t for t, _ in results])
+
+    printime('  - Collecting cis and total interactions per bin')
+    sumcol = np.zeros(total, dtype=np.int64)
+    sumcis = np.zeros(total, dtype=np.int64)
+    for _, (rows, tot, cis) in results:
+        sumcol[rows] += tot
+        sumcis[rows] += cis
+    cisprc = dict((i, [c, t]) for i, c, t in zip(xrange(total),
+                                                 sumcis.tolist(),
+                                                 sumcol.tolist()) if t)
 
     printime('  - Removing columns with too few or too much interactions')
     if len(bamfile.references) == 1 and min_count is None:
@@ -766,17 +713,11 @@ def read_bam(inbam, filter_exclude, resolution, min_count=2500, biases_path='',
     else:
         print ('      -> too few interactions defined as less than %9d '
                'interactions') % (min_count)
-        badcol = {}
-        countL = 0
-        countZ = 0
-        for c in xrange(total):
-            if cisprc.get(c, [0, 0])[1] < min_count:
-                badcol[c] = cisprc.get(c, [0, 0])[1]
-                countL += 1
-                if not c in cisprc:
-                    countZ += 1
+        lows = np.flatnonzero(sumcol < min_count)
+        badcol = dict(zip(lows.tolist(), sumcol[lows].tolist()))
         print '      -> removed %d columns (%d/%d null/high counts) of %d (%.1f%%)' % (
-            len(badcol), countZ, countL, total, float(len(badcol)) / total * 100)
+            len(badcol), (sumcol[lows] == 0).sum(), len(lows), total,
+            float(len(badcol)) / total * 100)
 
     # no mappability will result in NaNs, better to filter out these columns
     if mappability:
@@ -797,7 +738,7 @@ def read_bam(inbam, filter_exclude, resolution, min_count=2500, biases_path='',
                      for k in cisprc if not k in badcol) / (len(cisprc) - len(badcol))
 
     printime('  - Rescaling sum of interactions per bins')
-    size = len(bins)
+    size = total
     biases = [float('nan') if k in badcol else cisprc.get(k, [0, 1.])[1]
               for k in xrange(size)]
 
@@ -807,7 +748,20 @@ def read_bam(inbam, filter_exclude, resolution, min_count=2500, biases_path='',
             inbam, resolution, filter_exclude=filter_exclude,
             tmpdir=outdir, ncpus=ncpus)
         hic_data.bads = badcol
-        hic_data.normalize_hic(iterations=100, max_dev=0.000001)
+        hic_data.normalize_hic(iterations=100, max_dev=0.000001, ncpus=ncpus)
+        biases = hic_data.bias.copy()
+        del(hic_data)
+    elif normalization == 'KR':
+        printime('  - KR normalization')
+        hic_data = load_hic_data_from_bam(
+            inbam, resolution, filter_exclude=filter_exclude,
+            tmpdir=outdir, ncpus=ncpus)
+        hic_data.bads = badcol
+        stats = hic_data.normalize_hic(normalization='KR', cis_only=cis_only,
+                                       silent=True)
+        for name, (nstep, nmvp, res) in sorted(stats.iteritems()):
+            print ('    -> %s: %d Newton steps (%d matrix-vector products), '
+                   'residual %g' % (name, nstep, nmvp, res))
         biases = hic_data.bias.copy()
         del(hic_data)
     elif normalization == 'Vanilla':
@@ -858,49 +812,25 @@ def read_bam(inbam, filter_exclude, resolution, min_count=2500, biases_path='',
         raise NotImplementedError('ERROR: method %s not implemented' %
                                   normalization)
 
-    # collect subset-matrices and write genomic one
-    # out = open(os.path.join(outdir,
-    #                         'hicdata_%s.abc' % (nicer(resolution).replace(' ', ''))), 'w')
-    printime('  - Getting sum of normalized bins')
-    pool = mu.Pool(ncpus)
-    procs = []
-    for i, (region, start, end) in enumerate(zip(regs, begs, ends)):
-        fname = path.join(outdir,
-                          'tmp_%s:%d-%d_%s.pickle' % (region, start, end, extra_out))
-        procs.append(pool.apply_async(sum_nrm_matrix,
-                                      args=(fname, biases,)))
-    pool.close()
-    print_progress(procs)
-    pool.join()
+    # sums of normalized interactions needed to rescale biases, and to compute
+    # the cis percentage and the decay, in a single pass over the chunks
+    printime('  - Getting sum of normalized bins, cis percentage and decay')
+    bias_array = np.array([biases.get(k, float('nan')) for k in xrange(size)])
+    bads = np.zeros(size, dtype=bool)
+    bads[[b for b in badcol if 0 <= b < size]] = True
+    sumnrm, cis, tot, nrmdec, rawdec = sum_normalized_chunks(
+        _iter_chunk_arrays(chunks, outdir, rand_hash, resolution, clean=True),
+        bias_array, bads, first_bins, size)
+    rmtree(path.join(outdir, '_tmp_%s' % (rand_hash)))
 
     # to correct biases
-    sumnrm = sum(p.get() for p in procs)
-
     target = (sumnrm / float(size * size * factor))**0.5
     biases = dict([(b, biases[b] * target) for b in biases])
+    # normalized sums were computed before rescaling biases
+    nrmdec /= target**2
 
     if not normalize_only:
-        printime('  - Computing Cis percentage')
-        # Calculate Cis percentage
-
-        pool = mu.Pool(ncpus)
-        procs = []
-        for i, (region, start, end) in enumerate(zip(regs, begs, ends)):
-            fname = path.join(outdir,
-                              'tmp_%s:%d-%d_%s.pickle' % (region, start, end, extra_out))
-            procs.append(pool.apply_async(get_cis_perc,
-                                          args=(fname, biases, badcol, bins)))
-        pool.close()
-        print_progress(procs)
-        pool.join()
-
-        # collect results
-        cis = total = 0
-        for proc in procs:
-            c, t = proc.get()
-            cis += c
-            total += t
-        norm_cisprc = float(cis) / total
+        norm_cisprc = cis / tot
         print '    * Cis-percentage: %.1f%%' % (norm_cisprc * 100)
     else:
         norm_cisprc = 0.
@@ -909,155 +839,52 @@ def read_bam(inbam, filter_exclude, resolution, min_count=2500, biases_path='',
     # normalize decay by size of the diagonal, and by Vanilla correction
     # (all cells must still be equals to 1 in average)
 
-    pool = mu.Pool(ncpus)
-    procs = []
-    for i, (region, start, end) in enumerate(zip(regs, begs, ends)):
-        fname = path.join(outdir,
-                          'tmp_%s:%d-%d_%s.pickle' % (region, start, end, extra_out))
-        procs.append(pool.apply_async(sum_dec_matrix,
-                                      args=(fname, biases, badcol, bins)))
-    pool.close()
-    print_progress(procs)
-    pool.join()
-
-    # collect results
-    nrmdec = {}
-    rawdec = {}
-    for proc in procs:
-        tmpnrm, tmpraw = proc.get()
-        for c, d in tmpnrm.iteritems():
-            for k, v in d.iteritems():
-                try:
-                    nrmdec[c][k] += v
-                    rawdec[c][k] += tmpraw[c][k]
-                except KeyError:
-                    try:
-                        nrmdec[c][k]  = v
-                        rawdec[c][k] = tmpraw[c][k]
-                    except KeyError:
-                        nrmdec[c] = {k: v}
-                        rawdec[c] = {k: tmpraw[c][k]}
-    # count the number of cells per diagonal
-    # TODO: parallelize
-    # find largest chromosome
-    len_crms = dict((c, section_pos[c][1] - section_pos[c][0]) for c in section_pos)
-    # initialize dictionary
-    ndiags = dict((c, dict((k, 0) for k in xrange(len_crms[c]))) for c in sections)
-    for crm in section_pos:
-        beg_chr, end_chr = section_pos[crm][0], section_pos[crm][1]
-        chr_size = end_chr - beg_chr
-        thesebads = [b for b in badcol if beg_chr <= b <= end_chr]
-        for dist in xrange(1, chr_size):
-            ndiags[crm][dist] += chr_size - dist
-            # from this we remove bad columns
-            # bad columns will only affect if they are at least as distant from
-            # a border as the distance between the longest diagonal and the
-            # current diagonal.
-            bad_diag = set()  # 2 bad rows can point to the same bad cell in diagonal
-            maxp = end_chr - dist
-            minp = beg_chr + dist
-            for b in thesebads:
-                if b < maxp:  # not inclusive!!
-                    bad_diag.add(b)
-                if b >= minp:
-                    bad_diag.add(b - dist)
-            ndiags[crm][dist] -= len(bad_diag)
-        # different behavior for longest diagonal:
-        ndiags[crm][0] += chr_size - sum(beg_chr <= b < end_chr for b in thesebads)
-
     # normalize sum per diagonal by total number of cells in diagonal
     signal_to_noise = 0.05
     min_n = signal_to_noise ** -2. # equals 400 when default
+    decay = {}
     for crm in sections:
-        if not crm in nrmdec:
-            nrmdec[crm] = {}
-            rawdec[crm] = {}
+        beg_chr, end_chr = section_pos[crm]
+        # count the number of cells per diagonal
+        ndiags = _valid_cells_per_diagonal(~bads[beg_chr:end_chr]).tolist()
+        crm_nrm = nrmdec[beg_chr:end_chr].tolist()
+        crm_raw = rawdec[beg_chr:end_chr].tolist()
+        decay[crm] = dict((k, crm_nrm[k]) for k in xrange(len(crm_raw))
+                          if crm_raw[k])
         tmpdec = 0  # store count by diagonal
         tmpsum = 0  # store count by diagonal
         ndiag  = 0
         val    = 0
         previous = [] # store diagonals to be summed in case not reaching the minimum
-        for k in ndiags[crm]:
-            tmpdec += nrmdec[crm].get(k, 0.)
-            tmpsum += rawdec[crm].get(k, 0.)
+        for k in xrange(len(ndiags)):
+            tmpdec += crm_nrm[k]
+            tmpsum += crm_raw[k]
             previous.append(k)
             if tmpsum > min_n:
-                ndiag = sum(ndiags[crm][k] for k in previous)
+                ndiag = sum(ndiags[k] for k in previous)
                 val = tmpdec  # backup of tmpdec kept for last ones outside the loop
                 try:
                     ratio = val / ndiag
                     for l in previous:
-                        nrmdec[crm][l] = ratio
+                        decay[crm][l] = ratio
                 except ZeroDivisionError:  # all columns at this distance are "bad"
                     pass
                 previous = []
                 tmpdec = 0
                 tmpsum = 0
         # last ones we average with previous result
-        if  len(previous) == len(ndiags[crm]):
-            nrmdec[crm] = {}
+        if  len(previous) == len(ndiags):
+            decay[crm] = {}
         elif tmpsum < min_n:
-            ndiag += sum(ndiags[crm][k] for k in previous)
+            ndiag += sum(ndiags[k] for k in previous)
             val += tmpdec
             try:
                 ratio = val / ndiag
                 for k in previous:
-                    nrmdec[crm][k] = ratio
+                    decay[crm][k] = ratio
             except ZeroDivisionError:  # all columns at this distance are "bad"
                 pass
-    return biases, nrmdec, badcol, raw_cisprc, norm_cisprc
-
-
-def sum_dec_matrix(fname, biases, badcol, bins):
-    dico = load(open(fname))
-    rawdec = {}
-    nrmdec = {}
-    for (i, j), v in dico.iteritems():
-        if i < j:
-            continue
-        # different chromosome
-        c = bins[i][0]
-        if c != bins[j][0]:
-            continue
-        if i in badcol or j in badcol:
-            continue
-        k = i - j
-        val = v / biases[i] / biases[j]
-        try:
-            nrmdec[c][k] += val
-            rawdec[c][k] += v
-        except KeyError:
-            try:
-                nrmdec[c][k] = val
-                rawdec[c][k] = v
-            except KeyError:
-                nrmdec[c] = {k: val}
-                rawdec[c] = {k: v}
-    system('rm -f %s' % (fname))
-    return nrmdec, rawdec
-
-
-def get_cis_perc(fname, biases, badcol, bins):
-    dico = load(open(fname))
-    cis = total = 0
-    for (i, j), v in dico.iteritems():
-        if i <= j:
-            continue
-        if i in badcol or j in badcol:
-            continue
-        val = v / biases[i] / biases[j]
-        # same chromosome
-        if bins[i][0] == bins[j][0]:
-            cis += val
-        total += val
-    return cis, total
-
-
-def sum_nrm_matrix(fname, biases):
-    dico = load(open(fname))
-    sumnrm = nansum([v / biases[i] / biases[j]
-                     for (i, j), v in dico.iteritems()])
-    return sumnrm
+    return biases, decay, badcol, raw_cisprc, norm_cisprc
 
 
 class SmartFormatter(HelpFormatter):
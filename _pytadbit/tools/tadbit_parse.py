@@ -13,6 +13,7 @@ from shutil                         import copyfile
 from argparse                       import HelpFormatter
 from cPickle                        import load, UnpicklingError
 from warnings                       import warn
+from multiprocessing                import cpu_count
 
 import time
 import logging
@@ -43,7 +44,8 @@ def run(opts):
 
     name = path.split(opts.workdir)[-1]
 
-    param_hash = digest_parameters(opts)
+    # number of cpus does not change the output
+    param_hash = digest_parameters(opts, extra=['cpus'])
 
     outdir = '02_parsed_reads'
 
@@ -73,7 +75,8 @@ def run(opts):
         logging.info('parsing reads in %s project', name)
         counts, multis = parse_map(f_names1, f_names2, out_file1=out_file1,
                                    out_file2=out_file2, re_name=renz, verbose=True,
-                                   genome_seq=genome, compress=opts.compress_input)
+                                   genome_seq=genome, compress=opts.compress_input,
+                                   ncpus=opts.cpus, genome_path=opts.genome)
     else:
         counts = {}
         counts[0] = {}
@@ -166,7 +169,7 @@ def save_to_db(opts, counts, multis, f_names1, f_names2, out_file1, out_file2,
             unique (PATHid))""")
         try:
             parameters = digest_parameters(opts, get_md5=False)
-            param_hash = digest_parameters(opts, get_md5=True )
+            param_hash = digest_parameters(opts, get_md5=True , extra=['cpus'])
             cur.execute("""
     insert into JOBs
      (Id  , Parameters, Launch_time, Finish_time,    Type, Parameters_md5)
@@ -312,6 +315,12 @@ def populate_args(parser):
                         help='''default: --filter_chrom "%(default)s", regexp
                         to consider only chromosome names passing''')
 
+    glopts.add_argument("-C", "--cpus", dest="cpus", type=int,
+                        default=cpu_count(), help='''[%(default)s] Maximum
+                        number of CPU cores  available in the execution host,
+                        used to parse input files in parallel (if 0 all
+                        available cores will be used)''')
+
     glopts.add_argument('--skip', dest='skip', action='store_true',
                       default=False,
                       help='[DEBUG] in case already mapped.')
@@ -363,6 +372,12 @@ def check_options(opts):
     if opts.workdir.endswith('/'):
         opts.workdir = opts.workdir[:-1]
 
+    # number of cpus
+    if opts.cpus == 0:
+        opts.cpus = cpu_count()
+    else:
+        opts.cpus = min(opts.cpus, cpu_count())
+
     # write log
     log_format = '[PARSING]   %(message)s'
 
@@ -406,7 +421,7 @@ def check_options(opts):
             pass
 
     # check if job already run using md5 digestion of parameters
-    if already_run(opts):
+    if already_run(opts, extra=['cpus']):
         if 'tmpdb' in opts and opts.tmpdb:
             remove(path.join(dbdir, dbfile))
         exit('WARNING: exact same job already computed, see JOBs table above')
@@ -9,11 +9,15 @@ import platform
 
 import bz2
 import gzip
+import zlib
 import zipfile
 import tarfile
 
+from collections import deque
+from heapq import merge
 from subprocess import Popen, PIPE
 from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 
 
 def check_pik(path):
@@ -81,6 +85,85 @@ def magic_open(filename, verbose=False, cpus=None):
     return fhandler
 
 
+def _gzip_member(data, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+class ParallelGzipFile(object):
+    """
+    Write-only gzip file compressed by several threads. Data is buffered in
+    blocks, each block being compressed independently as a gzip member (the
+    concatenation of gzip members is a valid gzip file). At most two blocks
+    per thread are kept in memory.
+
+    :param fname: path to output file
+    :param 1 cpus: number of threads used for compression
+    :param 6 level: compression level
+    :param 4194304 block_size: size (in bytes) of the uncompressed blocks
+    """
+    def __init__(self, fname, cpus=1, level=6, block_size=4194304):
+        self.fhandler   = open(fname, 'wb')
+        self.name       = fname
+        self.level      = level
+        self.block_size = block_size
+        self.buffer     = []
+        self.buffered   = 0
+        self.cpus       = cpus
+        self.pool       = ThreadPool(cpus) if cpus > 1 else None
+        self.pending    = deque()
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.block_size:
+            self._flush_block()
+
+    def _flush_block(self):
+        if not self.buffered:
+            return
+        data = ''.join(self.buffer)
+        self.buffer   = []
+        self.buffered = 0
+        if self.pool is None:
+            self.fhandler.write(_gzip_member(data, self.level))
+            return
+        self.pending.append(self.pool.apply_async(_gzip_member,
+                                                  (data, self.level)))
+        while len(self.pending) > 2 * self.cpus:
+            self.fhandler.write(self.pending.popleft().get())
+
+    def close(self):
+        self._flush_block()
+        while self.pending:
+            self.fhandler.write(self.pending.popleft().get())
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+        self.fhandler.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *unused):
+        self.close()
+
+
+def open_output(fname, cpus=1):
+    """
+    Opens a file for writing, compressed with gzip if its name ends with
+    '.gz'.
+
+    :param fname: path to output file
+    :param 1 cpus: number of threads used to compress the output
+
+    :returns: a file-like object
+    """
+    if fname.endswith('.gz'):
+        return ParallelGzipFile(fname, cpus=cpus)
+    return open(fname, 'w')
+
+
 def get_free_space_mb(folder, div=2):
     """
     Return folder/drive free space (in bytes)
@@ -123,6 +206,43 @@ def wc(fnam):
     return sum(1 for _ in open(fnam))
 
 
+# approximate memory used by Python to hold and sort a line of text, on top of
+# its length (string object, list slot and sort key)
+LINE_OVERHEAD = 100
+
+
+def _keyed_lines(fhandler, key, nfile):
+    for line in fhandler:
+        yield key(line), nfile, line
+
+
+def merge_sorted_files(fnames, key, clean=True):
+    """
+    Merges text files sorted by a given key in a single pass (k-way merge).
+
+    Lines with the same key are yielded in the order of the files, and, within
+    each file, in their original order. Merging runs of consecutive lines that
+    were sorted with a stable sort thus gives the same result as a stable sort
+    of all lines at once.
+
+    :param fnames: list of paths to sorted files
+    :param key: function returning the sort key of a line (computed once per
+       line)
+    :param True clean: remove the files once merged
+
+    :yields: lines, sorted
+    """
+    fhandlers = [open(fnam) for fnam in fnames]
+    for _, _, line in merge(*[_keyed_lines(fhandler, key, nfile)
+                              for nfile, fhandler in enumerate(fhandlers)]):
+        yield line
+    for fhandler in fhandlers:
+        fhandler.close()
+    if clean:
+        for fnam in fnames:
+            os.remove(fnam)
+
+
 def mkdir(dnam):
     try:
         os.mkdir(dnam)
@@ -0,0 +1,149 @@
+"""
+18 Oct 2026
+
+Single-file binary container of NumPy arrays.
+
+Layout of the file:
+
+  - magic string 'TADbitHC' (8 bytes)
+  - version of the format (unsigned 32 bits integer)
+  - position of the header in the file (unsigned 64 bits integer)
+  - arrays, cut into chunks, each chunk compressed independently with zlib
+  - JSON header, describing the arrays (dtype, length and position of each
+    chunk) and holding metadata
+
+As each chunk can be decompressed independently, a slice of an array can be
+read without reading the whole array.
+"""
+
+import json
+import zlib
+from bisect import bisect_right
+from struct import pack, unpack, calcsize
+
+import numpy as np
+
+MAGIC          = 'TADbitHC'
+FORMAT_VERSION = 1
+CHUNK          = 1000000
+
+_PREFIX = '<8sIQ'
+
+
+def _json_default(obj):
+    """
+    Converts NumPy scalars and arrays found in metadata
+    """
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError('%r is not JSON serializable' % (obj, ))
+
+
+class ContainerWriter(object):
+    """
+    Writes NumPy arrays, chunk by chunk, into a container file.
+
+    :param fnam: path to output file
+    :param 6 level: zlib compression level (0 for no compression, 9 for
+       maximum compression)
+    """
+    def __init__(self, fnam, level=6):
+        self.handler = open(fnam, 'wb')
+        self.handler.write(pack(_PREFIX, MAGIC, FORMAT_VERSION, 0))
+        self.level  = level
+        self.arrays = {}
+
+    def add_array(self, name, values, breaks=(), chunk=CHUNK):
+        """
+        :param name: name of the array
+        :param values: 1D NumPy array (can be memory-mapped)
+        :param () breaks: list of positions in the array where a chunk should
+           start (e.g. start of each chromosome), so that they can be read
+           without decompressing data of the previous chunk
+        :param 1000000 chunk: maximum number of values in a chunk
+        """
+        length = len(values)
+        bounds = sorted(set([0, length] + [b for b in breaks if 0 < b < length]))
+        starts = []
+        for beg, end in zip(bounds[:-1], bounds[1:]):
+            starts.extend(range(beg, end, chunk))
+        chunks = []
+        for beg, end in zip(starts, starts[1:] + [length]):
+            data = zlib.compress(
+                np.ascontiguousarray(values[beg:end]).tostring(), self.level)
+            chunks.append((self.handler.tell(), len(data), beg, end))
+            self.handler.write(data)
+        self.arrays[name] = {'dtype' : np.dtype(values.dtype).str,
+                             'length': length,
+                             'chunks': chunks}
+
+    def close(self, metadata=None):
+        """
+        Writes the header and closes the file.
+
+        :param None metadata: JSON serializable dictionary
+        """
+        offset = self.handler.tell()
+        json.dump({'arrays'  : self.arrays,
+                   'metadata': metadata or {}}, self.handler,
+                  default=_json_default)
+        self.handler.seek(0)
+        self.handler.write(pack(_PREFIX, MAGIC, FORMAT_VERSION, offset))
+        self.handler.close()
+
+
+class ContainerReader(object):
+    """
+    Reads arrays, or slices of arrays, from a container file.
+
+    :param fnam: path to container file
+    """
+    def __init__(self, fnam):
+        self.handler = open(fnam, 'rb')
+        magic, version, offset = unpack(
+            _PREFIX, self.handler.read(calcsize(_PREFIX)))
+        if magic != MAGIC:
+            raise Exception('ERROR: %s is not a TADbit binary file' % fnam)
+        if version > FORMAT_VERSION:
+            raise Exception('ERROR: %s written by a newer version of TADbit'
+                            % fnam)
+        self.version = version
+        self.handler.seek(offset)
+        header = json.loads(self.handler.read())
+        self.arrays   = header['arrays']
+        self.metadata = header['metadata']
+
+    def __contains__(self, name):
+        return name in self.arrays
+
+    def read(self, name, start=0, end=None):
+        """
+        :param name: name of the array
+        :param 0 start: first position to read
+        :param None end: last position to read (excluded), by default the end
+           of the array
+
+        :returns: a NumPy array with the values from start to end. Only the
+           chunks overlapping this range are read and decompressed.
+        """
+        desc   = self.arrays[name]
+        dtype  = np.dtype(str(desc['dtype']))
+        end    = desc['length'] if end is None else min(end, desc['length'])
+        chunks = desc['chunks']
+        if start >= end:
+            return np.zeros(0, dtype=dtype)
+        first = bisect_right([c[2] for c in chunks], start) - 1
+        parts = []
+        for offset, nbytes, beg, fin in chunks[first:]:
+            if beg >= end:
+                break
+            self.handler.seek(offset)
+            values = np.frombuffer(zlib.decompress(self.handler.read(nbytes)),
+                                   dtype=dtype)
+            parts.append(values[max(start - beg, 0):end - beg])
+        return np.concatenate(parts)
+
+    def close(self):
+        self.handler.close()
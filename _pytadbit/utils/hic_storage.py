@@ -0,0 +1,580 @@
+"""
+18 Oct 2026
+
+Array based storage of Hi-C contacts.
+
+Contacts of a square matrix are stored in Compressed Sparse Row (CSR) format:
+
+  - indptr : offsets of each row (size + 1 integers)
+  - indices: column of each non-zero cell (sorted inside each row, int32)
+  - data   : value of each non-zero cell (uint32 for counts, float32 otherwise)
+
+Cells are identified as in :class:`pytadbit.hic_data.HiC_data` by a linear key
+``row * size + col``.
+
+The three arrays can be written to raw binary files (indptr.bin, indices.bin
+and data.bin) and memory-mapped, in which case only the pages of the rows
+accessed are read from disk, and several processes can share the same files.
+"""
+
+import os
+from itertools import islice
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+CHUNK = 1000000
+
+
+def _best_dtype(values):
+    """
+    Smallest dtype that can hold a given array of values without loss: uint32
+    for counts, float32 otherwise.
+    """
+    if not len(values):
+        return np.uint32
+    if (values.min() >= 0 and values.max() < 2**32 and
+        np.all(np.mod(values, 1) == 0)):
+        return np.uint32
+    return np.float32
+
+
+def _write_array(arr, dirname, fname):
+    """
+    Writes an array in a raw binary file, unless it is already memory-mapped
+    on this same file.
+    """
+    fname = os.path.abspath(os.path.join(dirname, fname))
+    if getattr(arr, 'filename', None) == fname:
+        if arr.flags.writeable:
+            arr.flush()
+        return
+    np.asarray(arr).tofile(fname)
+
+
+def _open_array(dirname, fname, dtype, length, mode='r'):
+    """
+    Memory-maps an array written with :func:`_write_array`.
+    """
+    if not length:  # empty files cannot be memory-mapped
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(os.path.join(dirname, fname), dtype=dtype, mode=mode,
+                     shape=(length,))
+
+
+class ContactStorage(object):
+    """
+    Sparse square matrix of contacts stored as sorted NumPy arrays.
+
+    :param indptr: array of row offsets (length size + 1)
+    :param indices: array of column indexes
+    :param data: array of values
+    :param size: number of rows (and columns) of the matrix
+    """
+    def __init__(self, indptr, indices, data, size):
+        self.indptr   = indptr
+        self.indices  = indices
+        self.data     = data
+        self.size     = size
+        self._pending = {}
+
+    @classmethod
+    def from_coo(cls, rows, cols, vals, size, dtype=None, sum_duplicates=False):
+        """
+        Builds storage from coordinate arrays.
+
+        :param rows: array of row indexes
+        :param cols: array of column indexes
+        :param vals: array of values
+        :param size: number of rows (and columns) of the matrix
+        :param None dtype: dtype of the stored values, by default uint32 if
+           all values are positive integers, float32 otherwise.
+        :param False sum_duplicates: if True duplicated cells are summed,
+           otherwise the last value is kept (as in a dictionary)
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        cols = np.asarray(cols, dtype=np.int64)
+        vals = np.asarray(vals)
+        if len(rows) and (rows.max() >= size or cols.max() >= size or
+                          rows.min() < 0 or cols.min() < 0):
+            raise IndexError('ERROR: row or column larger than %s' % size)
+        keys  = rows * size + cols
+        order = np.argsort(keys, kind='mergesort')
+        keys  = keys[order]
+        vals  = vals[order]
+        if len(keys):
+            if sum_duplicates:
+                first = np.r_[True, keys[1:] != keys[:-1]]
+                vals  = np.add.reduceat(vals, np.flatnonzero(first))
+                keys  = keys[first]
+            else:
+                last = np.r_[keys[1:] != keys[:-1], True]
+                vals = vals[last]
+                keys = keys[last]
+        if dtype is None:
+            dtype = _best_dtype(vals)
+        rows = keys // size
+        indptr = np.zeros(size + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=size), out=indptr[1:])
+        return cls(indptr, (keys % size).astype(np.int32),
+                   vals.astype(dtype), size)
+
+    @classmethod
+    def from_items(cls, items, size, dtype=None):
+        """
+        Builds storage from an iterable of (key, value) pairs, keys being the
+        linear position of the cell (``row * size + col``). Items are consumed
+        by chunks, so the iterable is never copied into a Python list.
+
+        :param items: dictionary or iterable of (key, value)
+        :param size: number of rows (and columns) of the matrix
+        :param None dtype: dtype of the stored values
+        """
+        if hasattr(items, 'iteritems'):
+            items = items.iteritems()
+        items = iter(items)
+        keys = []
+        vals = []
+        while True:
+            chunk = list(islice(items, CHUNK))
+            if not chunk:
+                break
+            keys.append(np.fromiter((k for k, _ in chunk), dtype=np.int64,
+                                    count=len(chunk)))
+            vals.append(np.fromiter((v for _, v in chunk), dtype=np.float64,
+                                    count=len(chunk)))
+        keys = np.concatenate(keys) if keys else np.zeros(0, dtype=np.int64)
+        vals = np.concatenate(vals) if vals else np.zeros(0)
+        if len(keys) and (keys.max() >= size**2 or keys.min() < 0):
+            raise IndexError('ERROR: position %d larger than %s^2' % (
+                keys.max(), size))
+        return cls.from_coo(keys // size, keys % size, vals, size, dtype=dtype)
+
+    @classmethod
+    def from_csr(cls, matrix):
+        """
+        Builds storage from a scipy sparse matrix (no copy if already in
+        canonical CSR format).
+        """
+        matrix = matrix.tocsr()
+        matrix.sum_duplicates()
+        return cls(matrix.indptr.astype(np.int64, copy=False),
+                   matrix.indices.astype(np.int32, copy=False),
+                   matrix.data, matrix.shape[0])
+
+    @classmethod
+    def from_row_blocks(cls, blocks, size, dtype=np.uint32, dirname=None):
+        """
+        Builds storage from blocks of cells, each block containing cells of
+        rows strictly greater than the rows of the previous blocks (e.g.
+        chunks of a BAM file parsed in genomic order).
+
+        :param blocks: iterable of (rows, cols, vals) arrays
+        :param size: number of rows (and columns) of the matrix
+        :param uint32 dtype: dtype of the stored values
+        :param None dirname: if given, arrays are written to binary files in
+           this directory and memory-mapped, otherwise they are kept in memory
+        """
+        counts = np.zeros(size, dtype=np.int64)
+        if dirname:
+            out_indices = open(os.path.join(dirname, 'indices.bin'), 'wb')
+            out_data    = open(os.path.join(dirname, 'data.bin'), 'wb')
+        else:
+            indices = []
+            data    = []
+        last_row = -1
+        for rows, cols, vals in blocks:
+            if not len(rows):
+                continue
+            order = np.lexsort((cols, rows))
+            rows, cols, vals = rows[order], cols[order], vals[order]
+            if rows[0] <= last_row:
+                raise ValueError('ERROR: blocks of cells should be sorted by row')
+            last_row = rows[-1]
+            counts += np.bincount(rows, minlength=size)
+            cols = cols.astype(np.int32)
+            vals = vals.astype(dtype)
+            if dirname:
+                cols.tofile(out_indices)
+                vals.tofile(out_data)
+            else:
+                indices.append(cols)
+                data.append(vals)
+        indptr = np.zeros(size + 1, dtype=np.int64)
+        np.cumsum(counts, out=indptr[1:])
+        if dirname:
+            out_indices.close()
+            out_data.close()
+            indptr.tofile(os.path.join(dirname, 'indptr.bin'))
+            return cls.open_mmap(dirname, size, indptr[-1], dtype)
+        return cls(indptr,
+                   np.concatenate(indices) if indices else np.zeros(0, np.int32),
+                   np.concatenate(data) if data else np.zeros(0, dtype), size)
+
+    @classmethod
+    def open_mmap(cls, dirname, size, nnz, dtype, mode='r'):
+        """
+        Memory-maps storage previously written with
+        :func:`ContactStorage.save_mmap`.
+
+        :param dirname: directory containing the binary files
+        :param size: number of rows (and columns) of the matrix
+        :param nnz: number of non-zero cells
+        :param dtype: dtype of the stored values
+        :param 'r' mode: 'r' for read-only (can be shared by many processes),
+           'r+' to modify the values on disk or 'c' for copy-on-write
+        """
+        return cls(_open_array(dirname, 'indptr.bin', np.int64, size + 1, mode),
+                   _open_array(dirname, 'indices.bin', np.int32, nnz, mode),
+                   _open_array(dirname, 'data.bin', dtype, nnz, mode), size)
+
+    def save_mmap(self, dirname):
+        """
+        Writes the arrays into binary files that can be memory-mapped with
+        :func:`ContactStorage.open_mmap`.
+
+        :param dirname: path to an existing directory
+
+        :returns: a dictionary with the size, the number of non-zero cells and
+           the dtype of the values
+        """
+        self.consolidate()
+        _write_array(self.indptr , dirname, 'indptr.bin' )
+        _write_array(self.indices, dirname, 'indices.bin')
+        _write_array(self.data   , dirname, 'data.bin'   )
+        return {'size' : self.size,
+                'nnz'  : len(self.data),
+                'dtype': self.data.dtype.name}
+
+    @property
+    def nnz(self):
+        self.consolidate()
+        return len(self.data)
+
+    @property
+    def dtype(self):
+        return self.data.dtype
+
+    def _find(self, row, col):
+        """
+        position of a cell in the data array, or -1 if it is empty
+        """
+        beg = self.indptr[row]
+        end = self.indptr[row + 1]
+        pos = beg + self.indices[beg:end].searchsorted(col)
+        if pos < end and self.indices[pos] == col:
+            return pos
+        return -1
+
+    def get(self, row, col, default=0):
+        """
+        :returns: the value of a given cell as a Python number
+        """
+        if self._pending:
+            try:
+                return self._pending[row * self.size + col]
+            except KeyError:
+                pass
+        pos = self._find(row, col)
+        if pos < 0:
+            return default
+        return self.data[pos].item()
+
+    def set(self, row, col, val):
+        """
+        Sets the value of a given cell. Cells already present are modified in
+        place, new cells are kept aside until the next bulk operation.
+        Integer values are converted to float32 if the value does not fit
+        (e.g. normalized values).
+        """
+        pos = self._find(row, col)
+        if pos < 0 or not self.data.flags.writeable:  # e.g. read-only memmap
+            self._pending[row * self.size + col] = val
+        else:
+            if (np.issubdtype(self.data.dtype, np.integer) and
+                not np.issubdtype(_best_dtype(np.array([val])), np.integer)):
+                self.data = self.data.astype(np.float32)
+            self.data[pos] = val
+
+    def remove(self, row, col):
+        """
+        Removes a given cell. The arrays are copied without it.
+
+        :returns: the value of the cell as a Python number, or None if the
+           cell is empty
+        """
+        self.consolidate()
+        pos = self._find(row, col)
+        if pos < 0:
+            return None
+        val = self.data[pos].item()
+        self.indices = np.delete(self.indices, pos)
+        self.data    = np.delete(self.data, pos)
+        self.indptr  = self.indptr.copy()
+        self.indptr[row + 1:] -= 1
+        return val
+
+    def clear(self):
+        """
+        Removes all the cells.
+        """
+        self._pending = {}
+        self.indptr  = np.zeros(self.size + 1, dtype=self.indptr.dtype)
+        self.indices = np.zeros(0, dtype=self.indices.dtype)
+        self.data    = np.zeros(0, dtype=self.data.dtype)
+
+    def consolidate(self):
+        """
+        Inserts new cells (set one by one) into the arrays.
+        """
+        if not self._pending:
+            return
+        keys = np.fromiter(self._pending.iterkeys(), dtype=np.int64,
+                           count=len(self._pending))
+        vals = np.fromiter(self._pending.itervalues(), dtype=np.float64,
+                           count=len(self._pending))
+        self._pending = {}
+        dtype = self.data.dtype
+        if (np.issubdtype(dtype, np.integer) and
+            not np.issubdtype(_best_dtype(vals), np.integer)):
+            dtype = np.float32
+        rows = np.repeat(np.arange(self.size, dtype=np.int64),
+                         np.diff(self.indptr))
+        new = ContactStorage.from_coo(
+            np.concatenate((rows, keys // self.size)),
+            np.concatenate((self.indices, keys % self.size)),
+            np.concatenate((self.data.astype(dtype), vals.astype(dtype))),
+            self.size, dtype=dtype)
+        self.indptr, self.indices, self.data = new.indptr, new.indices, new.data
+
+    def iter_row_blocks(self, start=0, end=None, max_nnz=CHUNK):
+        """
+        Iterates over blocks of consecutive rows, each holding at most
+        max_nnz non-zero cells (unless a single row holds more).
+
+        :yields: arrays of rows, columns and values of each block
+        """
+        self.consolidate()
+        end = self.size if end is None else end
+        beg = start
+        while beg < end:
+            stop = self.indptr.searchsorted(self.indptr[beg] + max_nnz,
+                                            side='right') - 1
+            stop = min(max(stop, beg + 1), end)
+            pbeg, pend = self.indptr[beg], self.indptr[stop]
+            rows = np.repeat(np.arange(beg, stop, dtype=np.int64),
+                             np.diff(self.indptr[beg:stop + 1]))
+            yield rows, self.indices[pbeg:pend], self.data[pbeg:pend]
+            beg = stop
+
+    def iteritems(self):
+        """
+        :yields: (key, value) pairs as Python numbers, in key order
+        """
+        for rows, cols, vals in self.iter_row_blocks():
+            for kv in zip((rows * self.size + cols).tolist(), vals.tolist()):
+                yield kv
+
+    def keys(self):
+        """
+        :returns: array of keys of non-zero cells
+        """
+        return np.concatenate(
+            [rows * self.size + cols for rows, cols, _ in self.iter_row_blocks()]
+            or [np.zeros(0, dtype=np.int64)])
+
+    def get_row(self, row, start=0, end=None):
+        """
+        :returns: dense array with the values of a given row between columns
+           start and end
+        """
+        self.consolidate()
+        end = self.size if end is None else end
+        out = np.zeros(end - start, dtype=self.data.dtype)
+        beg, fin = self.indptr[row], self.indptr[row + 1]
+        cols = self.indices[beg:fin]
+        lo, hi = cols.searchsorted([start, end])
+        out[cols[lo:hi] - start] = self.data[beg + lo:beg + hi]
+        return out
+
+    def get_band(self, k=0):
+        """
+        :param 0 k: diagonal offset (k > 0 above the main diagonal)
+
+        :returns: dense array of the values of cells (i, i + k)
+        """
+        out = np.zeros(self.size - abs(k), dtype=self.data.dtype)
+        start, end = (0, self.size - k) if k >= 0 else (-k, self.size)
+        for rows, cols, vals in self.iter_row_blocks(start, end):
+            sel = cols == rows + k
+            out[rows[sel] - start] = vals[sel]
+        return out
+
+    def get_block(self, start1, end1, start2, end2):
+        """
+        :returns: dense 2D array with the values of rows start1 to end1 and
+           columns start2 to end2 (end excluded)
+        """
+        out = np.zeros((end1 - start1, end2 - start2), dtype=self.data.dtype)
+        for rows, cols, vals in self.iter_row_blocks(start1, end1):
+            sel = (cols >= start2) & (cols < end2)
+            out[rows[sel] - start1, cols[sel] - start2] = vals[sel]
+        return out
+
+    def tocsr(self):
+        """
+        :returns: scipy sparse matrix in CSR format sharing the arrays
+        """
+        self.consolidate()
+        return csr_matrix((self.data, self.indices, self.indptr),
+                          shape=(self.size, self.size), copy=False)
+
+    def copy(self):
+        self.consolidate()
+        return ContactStorage(self.indptr.copy(), self.indices.copy(),
+                              self.data.copy(), self.size)
+
+
+class ArrayDict(object):
+    """
+    Read-only dictionary view over (possibly memory-mapped) arrays, used to
+    hold biases, bad columns or expected values without loading them.
+
+    :param values: array of values
+    :param None keys: sorted array of integer keys. If None, keys are the
+       indexes of the values array.
+    """
+    def __init__(self, values, keys=None):
+        self.values_array = values
+        self.keys_array   = keys
+
+    def _index(self, key):
+        if self.keys_array is None:
+            if 0 <= key < len(self.values_array):
+                return key
+            raise KeyError(key)
+        pos = self.keys_array.searchsorted(key)
+        if pos < len(self.keys_array) and self.keys_array[pos] == key:
+            return pos
+        raise KeyError(key)
+
+    def __getitem__(self, key):
+        return self.values_array[self._index(key)].item()
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except (KeyError, TypeError):
+            return default
+
+    def __contains__(self, key):
+        try:
+            self._index(key)
+            return True
+        except (KeyError, TypeError):
+            return False
+
+    def __len__(self):
+        return len(self.values_array)
+
+    def iterkeys(self):
+        if self.keys_array is None:
+            return iter(xrange(len(self.values_array)))
+        return iter(self.keys_array.tolist())
+
+    __iter__ = iterkeys
+
+    def itervalues(self):
+        return iter(self.values_array.tolist())
+
+    def iteritems(self):
+        return zip(self.iterkeys(), self.itervalues()).__iter__()
+
+    def keys(self):
+        return list(self.iterkeys())
+
+    def values(self):
+        return list(self.itervalues())
+
+    def items(self):
+        return list(self.iteritems())
+
+    def copy(self):
+        return dict(self.iteritems())
+
+    def slice(self, start, end):
+        """
+        :returns: array of the values of keys from start to end (excluded),
+           NaN for missing keys.
+        """
+        if self.keys_array is None:
+            return np.asarray(self.values_array[start:end], dtype=float)
+        out = np.empty(end - start)
+        out.fill(np.nan)
+        beg, fin = self.keys_array.searchsorted([start, end])
+        out[self.keys_array[beg:fin] - start] = self.values_array[beg:fin]
+        return out
+
+
+def dict_to_arrays(dico, dtype=np.float64):
+    """
+    Converts a dictionary with integer keys into arrays.
+
+    :param dico: dictionary or :class:`ArrayDict`
+    :param float64 dtype: dtype of the values
+
+    :returns: array of sorted keys (None if keys are a contiguous range
+       starting at 0) and array of values
+    """
+    if isinstance(dico, ArrayDict):
+        keys, values = dico.keys_array, dico.values_array
+    else:
+        keys = np.fromiter(sorted(dico), dtype=np.int64, count=len(dico))
+        values = np.fromiter((dico[k] for k in keys.tolist()), dtype=dtype,
+                             count=len(keys))
+    if keys is not None and (not len(keys) or
+                             (keys[0] == 0 and keys[-1] == len(keys) - 1)):
+        keys = None
+    return keys, values
+
+
+def save_array_dict(dico, dirname, name, dtype=np.float64):
+    """
+    Writes a dictionary with integer keys (biases, bad columns, expected
+    values...) into raw binary files (<name>.bin for values, and
+    <name>_keys.bin for keys if they are not a contiguous range starting at 0).
+
+    :param dico: dictionary or :class:`ArrayDict`
+    :param dirname: path to an existing directory
+    :param name: prefix of the binary files
+    :param float64 dtype: dtype of the stored values
+
+    :returns: a dictionary describing the arrays written, to be passed to
+       :func:`open_array_dict`
+    """
+    keys, values = dict_to_arrays(dico, dtype)
+    _write_array(values, dirname, name + '.bin')
+    if keys is not None:
+        _write_array(keys, dirname, name + '_keys.bin')
+    return {'length': len(values),
+            'dtype' : np.dtype(values.dtype).name,
+            'keyed' : keys is not None}
+
+
+def open_array_dict(dirname, name, description, mode='r'):
+    """
+    Memory-maps a dictionary written with :func:`save_array_dict`.
+
+    :param dirname: directory containing the binary files
+    :param name: prefix of the binary files
+    :param description: dictionary returned by :func:`save_array_dict`
+    :param 'r' mode: memory-map mode ('r', 'r+' or 'c')
+
+    :returns: an :class:`ArrayDict`
+    """
+    length = description['length']
+    keys = None
+    if description['keyed']:
+        keys = _open_array(dirname, name + '_keys.bin', np.int64, length, mode)
+    return ArrayDict(_open_array(dirname, name + '.bin',
+                                 str(description['dtype']), length, mode), keys)
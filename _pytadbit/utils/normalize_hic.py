@@ -66,8 +66,14 @@ matrix W of size N:
 
 from subprocess import Popen, PIPE
 from os import path
+from warnings import warn
 
-from numpy import genfromtxt
+from multiprocessing.pool import ThreadPool
+
+from numpy import genfromtxt, fromiter, int64, float64, ones, zeros, repeat
+from numpy import arange, diff, concatenate, cumsum, bincount, searchsorted
+from numpy import linspace, dot, asarray
+from scipy.sparse import csr_matrix
 
 from pytadbit.utils.file_handling import which
 
@@ -132,55 +138,58 @@ def oneD(tmp_dir='.', form='tot ~ s(map) + s(cg) + s(res)', p_fit=None,
     return biases_oneD
 
 
-def _update_S(W):
-    S = {}
-    meanS = 0.0
-    for bin1 in W:
-        S[bin1] = sum(W[bin1].values())
-        meanS += S[bin1]
-    meanS /= len(W)
-    return S, meanS
-
-
-def _updateDB(S, meanS, B):
-    DB = {}
-    for bin1 in S:
-        DB[bin1] = float(S[bin1]) / meanS
-        B[bin1] *= DB[bin1]
-    return DB
-
-
-def _update_W(W, DB):
-    for bin1 in W:
-        DBbin1 = DB[bin1]
-        W1 = W[bin1]
-        for bin2 in W1:
-            try:
-                W1[bin2] /= DBbin1 * DB[bin2]
-            except ZeroDivisionError: # whole row is empty
-                continue
-
-
-def copy_matrix(hic_data, bads):
-    W = {}
-    N = len(hic_data)
-    for k, v in hic_data.iteritems():
-        i, j = divmod(k, N)
-        if i in bads or j in bads:
-            continue
-        try:
-            W[i][j] = v
-        except KeyError:
-            W[i] = {}
-            W[i][j] = v
-    return W
+def _sparse_matrix(hic_data):
+    """
+    :returns: the interaction matrix in scipy CSR format (shared with the Hi-C
+       data object when possible)
+    """
+    try:
+        return hic_data._csr_view()
+    except AttributeError:
+        size = len(hic_data)
+        keys = fromiter(hic_data.iterkeys(), dtype=int64, count=len(hic_data))
+        vals = fromiter(hic_data.itervalues(), dtype=float, count=len(hic_data))
+        return csr_matrix((vals, divmod(keys, size)), shape=(size, size))
+
+
+def _filtered_blocks(hic_data, bads, dtype, ncpus):
+    """
+    Removes bad columns from the interaction matrix and cuts it into blocks of
+    rows (one per CPU) with similar number of interactions.
+
+    :returns: list of (start, end, CSR matrix) and a boolean array marking
+       rows with at least one interaction
+    """
+    matrix = _sparse_matrix(hic_data)
+    size   = matrix.shape[0]
+    good   = ones(size, dtype=bool)
+    good[[b for b in bads if 0 <= b < size]] = False
+    rows   = repeat(arange(size), diff(matrix.indptr))
+    keep   = good[rows] & good[matrix.indices]
+    rows   = rows[keep]
+    matrix = csr_matrix((matrix.data[keep].astype(dtype),
+                         matrix.indices[keep], concatenate(
+                             ([0], cumsum(bincount(rows, minlength=size))))),
+                        shape=(size, size))
+    present = diff(matrix.indptr) > 0
+    if ncpus < 2:
+        return [(0, size, matrix)], present
+    cuts = searchsorted(matrix.indptr,
+                        linspace(0, matrix.nnz, ncpus + 1)[1:-1])
+    cuts = [0] + sorted(set(cuts.tolist()) - set([0, size])) + [size]
+    return [(beg, end, matrix[beg:end])
+            for beg, end in zip(cuts[:-1], cuts[1:])], present
 
 
 def iterative(hic_data, bads=None, iterations=0, max_dev=0.00001,
-              verbose=False, **kwargs):
+              verbose=False, ncpus=1, dtype=float64, **kwargs):
     """
     Implementation of iterative correction Imakaev 2012
 
+    The matrix is kept in sparse format and never modified; at each iteration
+    the sum of the rows of the corrected matrix is computed from the raw matrix
+    and the current biases with a matrix-vector product.
+
     :param hic_data: dictionary containing the interaction data
     :param None bads: dictionary with column not to be considered
     :param None remove: columns not to consider
@@ -188,6 +197,9 @@ def iterative(hic_data, bads=None, iterations=0, max_dev=0.00001,
        matrix with no visibility differences between columns is desired)
     :param 0.00001 max_dev: maximum difference allowed between a row and the
        mean value of all raws
+    :param 1 ncpus: number of threads used to compute the sums of rows
+    :param float64 dtype: precision used for the computation (float32 halves
+       the memory needed)
     :returns: a vector of biases (length equal to the size of the matrix)
     """
     if verbose:
@@ -195,96 +207,318 @@ def iterative(hic_data, bads=None, iterations=0, max_dev=0.00001,
     size = len(hic_data)
     if not bads:
         bads = {}
-    remove = [i in bads for i in xrange(size)]
-    remove = remove or tuple([int(hic_data[i+i*size]==0) for i in xrange(size)])
-
     if verbose:
         print "  - copying matrix"
 
-    W = copy_matrix(hic_data, bads)
-    B = dict([(b, 1.) for b in W])
-    if len(B) == 0:
+    blocks, present = _filtered_blocks(hic_data, bads, dtype, ncpus)
+    if not present.any():
         raise ZeroDivisionError('ERROR: normalization failed, all bad columns')
+    nrows = present.sum()
+    B     = ones(size, dtype=float64)
+    invB  = ones(size, dtype=dtype)
+    S     = zeros(size, dtype=float64)
+    pool  = ThreadPool(len(blocks)) if len(blocks) > 1 else None
+
+    def _row_sums(block):
+        beg, end, matrix = block
+        S[beg:end] = matrix.dot(invB) * invB[beg:end]
+
     if verbose:
         print "  - computing biases"
     for it in xrange(iterations + 1):
-        S, meanS = _update_S(W)
-        DB = _updateDB(S, meanS, B)
+        if pool:
+            pool.map(_row_sums, blocks)
+        else:
+            _row_sums(blocks[0])
+        meanS = S[present].sum() / nrows
+        DB = S / meanS
+        B *= DB
         if iterations == 0: # exit before, we do not need to update W
             break
-        _update_W(W, DB)
-        S = sorted(S.values())
-        dev = max(abs(S[0]  / meanS - 1), abs(S[-1] / meanS - 1))
+        # rows summing to zero are left as they are
+        nonzero = DB != 0
+        invB[nonzero] /= DB[nonzero]
+        dev = max(abs(S[present].min() / meanS - 1),
+                  abs(S[present].max() / meanS - 1))
         if verbose:
-            print '   %15.3f %15.3f %15.3f %4s %9.5f' % (S[0], meanS, S[-1], it, dev)
+            print '   %15.3f %15.3f %15.3f %4s %9.5f' % (
+                S[present].min(), meanS, S[present].max(), it, dev)
         if dev < max_dev:
             break
-    for i in xrange(size):
-        try:
-            if B[i]:
-                B[i] *= meanS**.5
+    if pool:
+        pool.close()
+    B[present] *= meanS**.5
+    B[~present | (B == 0)] = 1.
+    return dict(enumerate(B.tolist()))
+
+
+def _bnewt(matrix, tol=1e-6, delta=0.1, Delta=3, max_iter=1000):
+    """
+    Balancing of a symmetric non-negative matrix, without empty rows, by the
+    inexact Newton method of Knight and Ruiz (Algorithm 'bnewt' from Knight, P.
+    A., Ruiz, D. (2013). A fast algorithm for matrix balancing. IMA Journal of
+    Numerical Analysis, 33(3), 1029-1047), each step being solved by conjugate
+    gradient.
+
+    :returns: the balancing vector x (x_i A_ij x_j sums to one in every row),
+       the number of Newton steps, the total number of matrix-vector products
+       and the residual (norm of the difference between the sums of the rows
+       and one)
+    """
+    g        = 0.9
+    etamax   = 0.1
+    eta      = etamax
+    stop_tol = tol * 0.5
+    n        = matrix.shape[0]
+    x        = ones(n)
+    rt       = tol**2
+    v        = x * matrix.dot(x)
+    rk       = 1 - v
+    rho_km1  = dot(rk, rk)
+    rout     = rold = rho_km1
+    nmvp     = 0
+    it       = 0
+    while rout > rt and it < max_iter:
+        it += 1
+        k = 0
+        y = ones(n)
+        innertol = max(eta**2 * rout, rt)
+        while rho_km1 > innertol:
+            k += 1
+            if k == 1:
+                Z = rk / v
+                p = Z
+                rho_km1 = dot(rk, Z)
             else:
-                B[i] = 1.
-        except KeyError:
-            B[i] = 1.
-    return B
+                beta = rho_km1 / rho_km2
+                p = Z + beta * p
+            # update search direction
+            w = x * matrix.dot(x * p) + v * p
+            alpha = rho_km1 / dot(p, w)
+            ap = alpha * p
+            # stay away from the boundary of the cone
+            ynew = y + ap
+            if ynew.min() <= delta:
+                if delta == 0:
+                    break
+                ind = ap < 0
+                gamma = ((delta - y[ind]) / ap[ind]).min()
+                y += gamma * ap
+                break
+            if ynew.max() >= Delta:
+                ind = ynew > Delta
+                gamma = ((Delta - y[ind]) / ap[ind]).min()
+                y += gamma * ap
+                break
+            y = ynew
+            rk = rk - alpha * w
+            rho_km2 = rho_km1
+            Z = rk / v
+            rho_km1 = dot(rk, Z)
+        x *= y
+        v = x * matrix.dot(x)
+        rk = 1 - v
+        rho_km1 = dot(rk, rk)
+        rout = rho_km1
+        nmvp += k + 1
+        # update inner iteration stopping criterion
+        rat = rout / rold
+        rold = rout
+        res_norm = rout**0.5
+        eta_o = eta
+        eta = g * rat
+        if g * eta_o**2 > 0.1:
+            eta = max(eta, g * eta_o**2)
+        eta = max(min(eta, etamax), stop_tol / res_norm)
+    return x, it, nmvp, rout**0.5
+
+
+def knight_ruiz(hic_data, bads=None, tol=1e-6, max_iter=1000, cis_only=False,
+                verbose=False, **kwargs):
+    """
+    Knight and Ruiz matrix balancing (Knight, P. A., Ruiz, D. (2013). A fast
+    algorithm for matrix balancing. IMA Journal of Numerical Analysis, 33(3),
+    1029-1047), converging in much less matrix-vector products than the
+    iterative correction.
+
+    :param hic_data: dictionary containing the interaction data
+    :param None bads: dictionary with column not to be considered
+    :param 1e-6 tol: maximum residual allowed (norm of the difference between
+       the sums of the rows of the normalized matrix and one)
+    :param 1000 max_iter: maximum number of Newton steps
+    :param False cis_only: balance each chromosome independently, using only
+       intra-chromosomal interactions
+    :returns: a vector of biases (length equal to the size of the matrix), in
+       the same format as :func:`iterative`, and a dictionary with, for each
+       chromosome (or for 'genome' if not cis_only), the number of Newton
+       steps, the number of matrix-vector products and the final residual
+    """
+    if verbose:
+        print 'Knight-Ruiz balancing'
+    matrix = _sparse_matrix(hic_data)
+    size   = matrix.shape[0]
+    good   = ones(size, dtype=bool)
+    good[[b for b in bads or {} if 0 <= b < size]] = False
+    if cis_only:
+        if not getattr(hic_data, 'section_pos', None):
+            raise Exception('ERROR: chromosome positions needed to balance '
+                            'each chromosome')
+        regions = sorted(hic_data.section_pos.iteritems(), key=lambda x: x[1])
+    else:
+        regions = [('genome', (0, size))]
+    B = ones(size)
+    stats = {}
+    for name, (beg, end) in regions:
+        idx = good[beg:end].nonzero()[0]
+        sub = matrix[beg:end, beg:end][idx][:, idx].astype(float64)
+        # empty rows can not be balanced
+        full = asarray(sub.sum(axis=1)).ravel() > 0
+        if not full.any():
+            continue
+        if not full.all():
+            idx = idx[full]
+            sub = sub[full][:, full]
+        x, it, nmvp, res = _bnewt(sub, tol=tol, max_iter=max_iter)
+        B[beg + idx] = 1. / x
+        stats[name] = it, nmvp, res
+        if verbose:
+            print '   %-15s %4d steps %6d products residual %9.2g' % (
+                name, it, nmvp, res)
+        if res > tol:
+            warn('WARNING: KR balancing of %s did not converge (residual %g)'
+                 % (name, res))
+    return dict(enumerate(B.tolist())), stats
 
 
-def expected(hic_data, bads=None, signal_to_noise=0.05, inter_chrom=False, **kwargs):
+def _diagonal_sums(indptr, indices, data, first_row, offsets, chrom_of,
+                   length):
+    """
+    Sums the interactions of a block of rows by genomic distance, for each
+    chromosome.
+
+    :param indptr: CSR row pointers of the block (not rebased)
+    :param first_row: index of the first row of the block in the matrix
+    :param offsets: position of the first bin of the chromosome of each bin
+       (-1 for bins of no chromosome or not to be considered)
+    :param chrom_of: index of the chromosome of each bin
+    :param length: length of the output array
+
+    :returns: an array where position offsets[i] + d holds the sum of the
+       interactions at distance d of the chromosome of bin i
+    """
+    nrows = len(indptr) - 1
+    rows  = repeat(arange(first_row, first_row + nrows), diff(indptr))
+    cols  = indices[indptr[0]:indptr[-1]]
+    data  = data[indptr[0]:indptr[-1]]
+    dist  = cols - rows
+    keep  = ((dist >= 0) & (offsets[rows] >= 0) &
+             (chrom_of[rows] == chrom_of[cols]))
+    return bincount(offsets[rows[keep]] + dist[keep],
+                    weights=data[keep], minlength=length)
+
+
+def _merge_diagonals(sums, counts, size, min_n):
+    """
+    Merges consecutive diagonals until the sum of their interactions is over
+    min_n, and averages them.
+
+    :param sums: sum of the interactions at each distance (at least size + 1
+       long)
+    :param counts: number of cells at each distance
+
+    :returns: a dictionary of expected values per distance
+    """
+    expc = {}
+    dist = 0
+    while dist < size:
+        sum_diag = num_diag = 0
+        end = dist
+        while True:
+            sum_diag += sums[end]
+            num_diag += counts[end]
+            if not num_diag:
+                val = 0.
+                break
+            if sum_diag > min_n or end >= size:
+                val = float(sum_diag) / num_diag
+                break
+            end += 1
+        for dist in xrange(dist, end + 2):
+            expc[dist] = val
+    return expc
+
+
+def expected(hic_data, bads=None, signal_to_noise=0.05, inter_chrom=False,
+             per_chromosome=False, ncpus=1, **kwargs):
     """
     Computes the expected values by averaging observed interactions at a given
     distance in a given HiC matrix.
 
+    The sums of the interactions at each distance are computed in a single pass
+    over the interactions; only cells between bins of a same chromosome are
+    considered (if chromosomes are defined), and cells from bad rows are
+    skipped.
+
     :param hic_data: dictionary containing the interaction data
     :param None bads: dictionary with column not to be considered
     :param 0.05 signal_to_noise: to calculate expected interaction counts,
        if not enough reads are observed at a given distance the observations
        of the distance+1 are summed. a signal to noise ratio of < 0.05
        corresponds to > 400 reads.
-
-    :returns: a vector of biases (length equal to the size of the matrix)
+    :param False per_chromosome: computes expected values independently for
+       each chromosome
+    :param 1 ncpus: not used, kept for backward compatibility (interactions
+       are summed in a single vectorized pass, faster than sending them to
+       other processes)
+
+    :returns: a dictionary of expected values per distance, or, if
+       per_chromosome, a dictionary of such dictionaries per chromosome
     """
     min_n = signal_to_noise ** -2. # equals 400 when default
 
-    size = len(hic_data)
+    matrix = _sparse_matrix(hic_data)
+    size   = matrix.shape[0]
+    good   = ones(size, dtype=bool)
+    good[[b for b in bads or {} if 0 <= b < size]] = False
+    section_pos = getattr(hic_data, 'section_pos', None)
+    if section_pos:
+        regions = sorted(section_pos.iteritems(), key=lambda x: x[1])
+    else:
+        regions = [(None, (0, size))]
+    # each bin points to the start of its chromosome
+    offsets  = -ones(size, dtype=int64)
+    chrom_of = -ones(size, dtype=int64)
+    for num, (_, (beg, end)) in enumerate(regions):
+        offsets[beg:end]  = beg
+        chrom_of[beg:end] = num
+    offsets[~good] = -1
+
+    sums = _diagonal_sums(matrix.indptr, matrix.indices, matrix.data, 0,
+                          offsets, chrom_of, size)
+    # number of good bins in each chromosome, up to each bin
+    cumgood = concatenate(([0], cumsum(good)))
+
+    if per_chromosome:
+        expc = {}
+        for crm, (beg, end) in regions:
+            length = end - beg
+            dists  = arange(length + 1)
+            counts = cumgood[end - dists] - cumgood[beg]
+            expc[crm] = _merge_diagonals(
+                concatenate((sums[beg:end], [0])), counts, length, min_n)
+        return expc
+
+    max_size = size
     try:
         if not inter_chrom:
-            size = max(hic_data.chromosomes.values())
+            max_size = max(hic_data.chromosomes.values())
     except AttributeError:
         pass
-
-    if size > 1200:
-        import sys
-        sys.setrecursionlimit(size + 100)
-
-    expc = {}
-    dist = 0
-    while dist < size:
-        diag = []
-        new_dist, val = _meandiag(hic_data, dist, diag, min_n, size, bads)
-        for dist in range(dist, new_dist + 1):
-            expc[dist] = val
-    return expc
-
-
-def _meandiag(hic_data, dist, diag, min_n, size, bads):
-    if hic_data.section_pos:
-        for crm in hic_data.section_pos:
-            for i in xrange(hic_data.section_pos[crm][0],
-                            hic_data.section_pos[crm][1] - dist):
-                if i in bads:
-                    continue
-                diag.append(hic_data[i, i + dist])
-    else:
-        for i in xrange(size - dist):
-            if i in bads:
-                continue
-            diag.append(hic_data[i, i + dist])
-    sum_diag = sum(diag)
-    if not diag:
-        return dist + 1, 0.
-    if sum_diag > min_n:
-        return dist + 1, float(sum_diag) / len(diag)
-    if dist >= size:
-        return dist + 1, float(sum_diag) / len(diag)
-    return _meandiag(hic_data, dist + 1, diag, min_n, size, bads)
+    all_sums   = zeros(max_size + 1)
+    all_counts = zeros(max_size + 1, dtype=int64)
+    for crm, (beg, end) in regions:
+        length = min(end - beg, max_size + 1)
+        dists  = arange(length)
+        all_sums[:length]   += sums[beg:beg + length]
+        all_counts[:length] += cumgood[end - dists] - cumgood[beg]
+    return _merge_diagonals(all_sums, all_counts, max_size, min_n)
@@ -10,6 +10,7 @@ matplotlib.use('Agg')
 import unittest
 from pytadbit                             import Chromosome, load_chromosome
 from pytadbit                             import tadbit, batch_tadbit
+from pytadbit                             import HiC_data, HiC_array
 from pytadbit.tad_clustering.tad_cmo      import optimal_cmo
 from pytadbit.modelling.structuralmodels        import load_structuralmodels
 from pytadbit.modelling.impmodel                import load_impmodel_from_cmm
@@ -17,13 +18,18 @@ from pytadbit.eqv_rms_drms                import rmsdRMSD_wrapper
 from pytadbit.parsers.genome_parser       import parse_fasta
 from pytadbit.mapping.restriction_enzymes import map_re_sites, RESTRICTION_ENZYMES
 from pytadbit.parsers.hic_parser          import load_hic_data_from_reads, read_matrix
+from pytadbit.parsers.hic_parser          import load_hic_data_from_mmap
 from pytadbit.mapping.analyze             import hic_map, plot_distance_vs_interactions
 from pytadbit.mapping.analyze             import insert_sizes, plot_iterative_mapping
 from pytadbit.mapping.analyze             import correlate_matrices, eig_correlate_matrices
 from pytadbit.mapping.filter              import filter_reads, apply_filter
+from pytadbit.mapping                     import get_intersection
+from pytadbit.parsers.hic_bam_parser      import bed2D_to_BAMhic, get_matrix
+from pytadbit.parsers.contact_index       import build_contact_index
+from pytadbit.utils.normalize_hic         import expected
 
 from random                               import random, seed
-from os                                   import system, path, chdir
+from os                                   import system, path, chdir, listdir
 from re                                   import finditer
 from warnings                             import warn, catch_warnings, simplefilter
 from distutils.spawn                      import find_executable
@@ -818,6 +824,1104 @@ class TestTadbit(unittest.TestCase):
             self.assertEqual(True, True)
             print "20", time() - t0
 
+    def test_21_hic_array(self):
+        """
+        Array based storage of Hi-C data should behave as the dictionary one
+        """
+        if ONLY and not "21" in ONLY:
+            return
+        if CHKTIME:
+            t0 = time()
+        hic_dict  = read_matrix(PATH + "/20Kb/chrT/chrT_A.tsv", resolution=20000)
+        hic_array = read_matrix(PATH + "/20Kb/chrT/chrT_A.tsv", resolution=20000,
+                                storage="array")
+        self.assertEqual(sorted(hic_dict.items()), hic_array.items())
+        self.assertEqual(hic_dict.get_matrix(focus=(10, 40)),
+                         hic_array.get_matrix(focus=(10, 40)))
+        self.assertEqual(hic_dict[12, 25], hic_array[12, 25])
+        self.assertEqual(list(hic_array.get_band(3)),
+                         [hic_dict[i, i + 3] for i in xrange(len(hic_dict) - 3)])
+        # float values in a matrix of counts
+        hic_array[3, 5] = hic_dict[3, 5] = 7.5
+        self.assertEqual(hic_array[3, 5], 7.5)
+        self.assertEqual(hic_dict.get_matrix(focus=(1, 20)),
+                         hic_array.get_matrix(focus=(1, 20)))
+        hic_dict.normalize_hic(iterations=10, silent=True)
+        hic_array.normalize_hic(iterations=10, silent=True)
+        self.assertEqual([round(hic_dict.bias[i], 5) for i in hic_dict.bias],
+                         [round(hic_array.bias[i], 5) for i in hic_dict.bias])
+        # cells removed, with the sparse matrix kept up to date
+        size = len(hic_dict)
+        for hic in [hic_dict, hic_array]:
+            csr = hic.get_hic_data_as_csr()
+            self.assertTrue(csr is hic.get_hic_data_as_csr())
+            val = hic[12, 25]
+            self.assertEqual(hic.pop(12 * size + 25), val)
+            self.assertFalse(12 * size + 25 in hic)
+            self.assertEqual(hic.get_hic_data_as_csr()[12, 25], 0)
+            self.assertEqual(hic.pop(12 * size + 25, None), None)
+            self.assertRaises(KeyError, hic.pop, 12 * size + 25)
+            del hic[25 * size + 12]
+            self.assertEqual(hic.get_hic_data_as_csr()[25, 12], 0)
+            self.assertRaises(KeyError, hic.__delitem__, 25 * size + 12)
+            hic.setdefault(12 * size + 25, 3)
+            self.assertEqual(hic.get_hic_data_as_csr()[12, 25], 3)
+            self.assertEqual(hic.setdefault(12 * size + 25, 5), 3)
+        pos, val = hic_array.popitem()
+        self.assertEqual(hic_dict.pop(pos), val)
+        self.assertFalse(pos in hic_array)
+        self.assertEqual(hic_array.get_hic_data_as_csr().nnz,
+                         len(hic_array.items()))
+        self.assertEqual(sorted(hic_dict.items()), hic_array.items())
+        self.assertEqual(sum(hic_dict.values()), sum(hic_array.values()))
+        for hic in [hic_dict, hic_array]:
+            hic.clear()
+            self.assertEqual(hic.items(), [])
+            self.assertEqual(sum(hic.values()), 0)
+            self.assertEqual(hic.get_hic_data_as_csr().nnz, 0)
+        self.assertRaises(KeyError, hic_array.popitem)
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print "21", time() - t0
+
+    def test_22_hic_mmap(self):
+        """
+        Memory-mapped Hi-C data should be the same as the one written
+        """
+        if ONLY and not "22" in ONLY:
+            return
+        if CHKTIME:
+            t0 = time()
+        hic_array = read_matrix(PATH + "/20Kb/chrT/chrT_A.tsv", resolution=20000,
+                                storage="array")
+        hic_array.normalize_hic(iterations=10, silent=True)
+        hic_array.normalize_expected()
+        hic_array.write_mmap("lala-mmap~")
+        hic_mmap = load_hic_data_from_mmap("lala-mmap~")
+        self.assertEqual(hic_array.items(), hic_mmap.items())
+        self.assertEqual(hic_array.get_matrix(focus=(10, 40), normalized=True),
+                         hic_mmap.get_matrix(focus=(10, 40), normalized=True))
+        self.assertEqual(hic_array.bads.keys(), hic_mmap.bads.keys())
+        self.assertEqual(hic_array.expected[10], hic_mmap.expected[10])
+        self.assertEqual(hic_array.sum(), hic_mmap.sum())
+        system("rm -rf lala-mmap~")
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print "22", time() - t0
+
+    def test_23_hic_save_load(self):
+        """
+        Hi-C data saved in binary format should be loaded unchanged
+        """
+        if ONLY and not "23" in ONLY:
+            return
+        if CHKTIME:
+            t0 = time()
+        hic_data = read_matrix(PATH + "/20Kb/chrT/chrT_A.tsv", resolution=20000)
+        hic_data.normalize_hic(iterations=10, silent=True)
+        hic_data.normalize_expected()
+        hic_data.save("lala-hic~")
+        for hic_class in (HiC_data, HiC_array):
+            new_hic = hic_class.load("lala-hic~")
+            self.assertEqual(sorted(hic_data.items()), sorted(new_hic.items()))
+            self.assertEqual(hic_data.bias, new_hic.bias)
+            self.assertEqual(hic_data.bads, new_hic.bads)
+            self.assertEqual(hic_data.expected, new_hic.expected)
+            self.assertEqual(hic_data.sections, new_hic.sections)
+        system("rm -f lala-hic~")
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print "23", time() - t0
+
+    def test_24_coarsen(self):
+        """
+        Lower resolutions derived from an Hi-C matrix
+        """
+        if ONLY and not "24" in ONLY:
+            return
+        if CHKTIME:
+            t0 = time()
+        hic_data = read_matrix(PATH + "/20Kb/chrT/chrT_A.tsv", resolution=20000)
+        levels = hic_data.pyramid([20000, 40000, 120000])
+        self.assertEqual(levels.keys(), [20000, 40000, 120000])
+        self.assertEqual(len(levels[40000]), (len(hic_data) + 1) / 2)
+        self.assertEqual(len(levels[120000]), (len(hic_data) + 5) / 6)
+        self.assertEqual(levels[40000][3, 5],
+                         sum(hic_data[i, j] for i in (6, 7) for j in (10, 11)))
+        self.assertEqual(levels[120000].sum(), hic_data.sum())
+        self.assertEqual(hic_data.coarsen(6).items(), levels[120000].items())
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print "24", time() - t0
+
+    def test_25_write_matrix(self):
+        """
+        Matrices written by blocks, with compression, should be read back
+        """
+        if ONLY and not "25" in ONLY:
+            return
+        if CHKTIME:
+            t0 = time()
+        hic_data = read_matrix(PATH + "/20Kb/chrT/chrT_A.tsv", resolution=20000)
+        hic_data.write_matrix("lala-mat~.gz", ncpus=2)
+        new_hic = read_matrix("lala-mat~.gz", resolution=20000)
+        self.assertEqual(hic_data.get_matrix(), new_hic.get_matrix())
+        hic_data.write_coord_table("lala-mat~", format="long-range")
+        lines = open("lala-mat~").readlines()
+        self.assertEqual(len(lines), sum(1 for k in hic_data
+                                         if k / len(hic_data) <= k % len(hic_data)))
+        system("rm -f lala-mat~ lala-mat~.gz")
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print "25", time() - t0
+
+    def test_26_region_view(self):
+        """
+        Views of a region should give the same values as get_matrix
+        """
+        if ONLY and not "26" in ONLY:
+            return
+        if CHKTIME:
+            t0 = time()
+        hic_data = read_matrix(PATH + "/20Kb/chrT/chrT_A.tsv", resolution=20000)
+        for focus in [None, (10, 50), (1, 20, 31, 60)]:
+            region = hic_data.get_region(focus)
+            matrix = hic_data.get_matrix(focus=focus)
+            self.assertEqual(region.toarray().tolist(), matrix)
+            self.assertEqual(region.tocsr().toarray().tolist(), matrix)
+        region = hic_data.get_region((10, 50))
+        self.assertEqual(region.diagonals(2).tolist(),
+                         [hic_data[i, i + 2] for i in xrange(9, 48)])
+        new_hic = region.to_hic_data()
+        self.assertEqual(new_hic.get_matrix(), region.toarray().tolist())
+        self.assertEqual(tadbit(region)["start"], tadbit(new_hic)["start"])
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print "26", time() - t0
+
+    def test_27_iterative_threads(self):
+        """
+        Iterative correction should not depend on threads or precision
+        """
+        if ONLY and not "27" in ONLY:
+            return
+        if CHKTIME:
+            t0 = time()
+        hic_data = read_matrix(PATH + "/20Kb/chrT/chrT_A.tsv", resolution=20000)
+        hic_data.normalize_hic(iterations=50, max_dev=0.00001, silent=True)
+        bias = hic_data.bias
+        hic_data.normalize_hic(iterations=50, max_dev=0.00001, silent=True,
+                               ncpus=3, dtype='float32')
+        self.assertEqual(sorted(bias), sorted(hic_data.bias))
+        for b in bias:
+            self.assertAlmostEqual(bias[b], hic_data.bias[b], places=4)
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print "27", time() - t0
+
+    def test_28_knight_ruiz(self):
+        """
+        Knight-Ruiz balancing should give rows summing to the same value
+        """
+        if ONLY and not "28" in ONLY:
+            return
+        if CHKTIME:
+            t0 = time()
+        hic_data = read_matrix(PATH + "/20Kb/chrT/chrT_A.tsv", resolution=20000)
+        hic_data.bads = {3: True}
+        stats = hic_data.normalize_hic(normalization='KR', silent=True)
+        nstep, nmvp, res = stats['genome']
+        self.assertTrue(res < 1e-6)
+        self.assertTrue(nstep <= nmvp)
+        matrix = hic_data.get_matrix(normalized=True)
+        sums = [sum(matrix[i][j] for j in xrange(len(matrix)) if j != 3)
+                for i in xrange(len(matrix)) if i != 3]
+        self.assertAlmostEqual(min(sums) / max(sums), 1, places=5)
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print "28", time() - t0
+
+    def test_29_expected(self):
+        """
+        Expected values computed for the whole matrix or per chromosome
+        """
+        if ONLY and not "29" in ONLY:
+            return
+        if CHKTIME:
+            t0 = time()
+        hic_data = read_matrix(PATH + "/20Kb/chrT/chrT_A.tsv", resolution=20000)
+        bads = {3: True, 10: True}
+        expc = expected(hic_data, bads=bads)
+        self.assertEqual(len(expc), len(hic_data) + 2)
+        self.assertEqual(expc, expected(hic_data, bads=bads, ncpus=2))
+        self.assertEqual([expc], expected(hic_data, bads=bads,
+                                          per_chromosome=True).values())
+        # first diagonal
+        self.assertAlmostEqual(expc[0], sum(hic_data[i, i] for i in xrange(100)
+                                            if not i in bads) / 98.)
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print "29", time() - t0
+
+    def test_30_symmetricize(self):
+        """
+        Asymmetric matrices are made symmetric, summing both halves if needed
+        """
+        if ONLY and not "30" in ONLY:
+            return
+        if CHKTIME:
+            t0 = time()
+        # half matrix: values copied to the other half
+        hic_data = HiC_data({1: 3, 2: 5, 5: 1}, 4)
+        self.assertEqual(hic_data.get_matrix(), [[0, 3, 5, 0],
+                                                 [3, 1, 0, 0],
+                                                 [5, 0, 0, 0],
+                                                 [0, 0, 0, 0]])
+        # both halves filled: values summed, diagonal counted once
+        hic_data = HiC_data({0: 7, 1: 3, 4: 2, 11: 4}, 4)
+        self.assertEqual(hic_data.get_matrix(), [[7, 5, 0, 0],
+                                                 [5, 0, 0, 0],
+                                                 [0, 0, 0, 4],
+                                                 [0, 0, 4, 0]])
+        # already symmetric: unchanged
+        items = {1: 3, 4: 3, 10: 2}
+        self.assertEqual(dict(HiC_data(items, 4)), items)
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print "30", time() - t0
+
+    def test_31_csr_cache(self):
+        """
+        Sparse matrix returned by HiC_data up to date with the modifications
+        """
+        if ONLY and not "31" in ONLY:
+            return
+        if CHKTIME:
+            t0 = time()
+        hic_data = HiC_data({1: 3, 4: 3}, 4)
+        csr = hic_data.get_hic_data_as_csr()
+        self.assertTrue(csr is hic_data.get_hic_data_as_csr())
+        self.assertEqual(csr[0, 1], 3)
+        hic_data[2, 2] = 4
+        self.assertEqual(hic_data.get_hic_data_as_csr()[2, 2], 4)
+        hic_data.setdefault(7, 5)
+        self.assertEqual(hic_data.get_hic_data_as_csr()[1, 3], 5)
+        hic_data.pop(1)
+        self.assertEqual(hic_data.get_hic_data_as_csr()[0, 1], 0)
+        del hic_data[4]
+        hic_data.popitem()
+        self.assertEqual(hic_data.get_hic_data_as_csr().nnz, len(dict(hic_data)))
+        hic_data.update({5: 2})
+        self.assertEqual(hic_data.get_hic_data_as_csr()[1, 1], 2)
+        hic_data.clear()
+        self.assertEqual(hic_data.get_hic_data_as_csr().nnz, 0)
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print "31", time() - t0
+
+    def test_32_bam_resolutions(self):
+        """
+        Matrices extracted at several resolutions at once, or one by one
+        """
+        if ONLY and not "32" in ONLY:
+            return
+        if CHKTIME:
+            t0 = time()
+        inbam = generate_test_bam()
+        resolutions = [1000, 5000, 10000]
+        for region in [dict(region1="chr1", start1=15000, end1=47000),
+                       dict(region1="chr1", start1=15000, end1=47000,
+                            region2="chr3", start2=3000, end2=98000),
+                       dict(region1="chr2")]:
+            matrices = get_matrix(inbam, resolutions, filter_exclude=0,
+                                  ncpus=2, nchunks=10, clean=True, **region)
+            for reso in resolutions:
+                matrix = get_matrix(inbam, reso, filter_exclude=0, ncpus=2,
+                                    nchunks=10, clean=True, use_index=False,
+                                    **region)
+                self.assertTrue(sum(matrix.values()) > 0)
+                self.assertEqual(matrices[reso], matrix)
+        system("rm -rf lala*")
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print "32", time() - t0
+
+    def test_33_contact_index(self):
+        """
+        Matrices extracted from the contact index, or from the BAM file
+        """
+        if ONLY and not "33" in ONLY:
+            return
+        if CHKTIME:
+            t0 = time()
+        from pysam import AlignmentFile
+        inbam = generate_test_bam()
+        # blocks of the index not aligned on bins
+        build_contact_index(inbam, block=3000)
+        crms = AlignmentFile(inbam).references
+        regions = []
+        for crm1, crm2 in zip(crms, crms[1:] + crms[:1]):
+            regions.append(dict(region1=crm1))
+            regions.append(dict(region1=crm1, region2=crm2))
+        regions.append(dict(region1="chr2", start1=20000, end1=60000,
+                            region2="chr3", start2=5000, end2=420000))
+        for region in regions:
+            matrix = get_matrix(inbam, 5000, filter_exclude=0, ncpus=2,
+                                nchunks=10, clean=True, use_index=False,
+                                **region)
+            self.assertEqual(get_matrix(inbam, 5000, filter_exclude=0,
+                                        **region), matrix)
+        system("rm -rf lala*")
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print "33", time() - t0
+
+    def test_34_bam_writer(self):
+        """
+        TADbit BAM files written with pysam, with the same records as the SAM
+        lines piped to samtools
+        """
+        if ONLY and not "34" in ONLY:
+            return
+        if CHKTIME:
+            t0 = time()
+        from pysam import AlignmentFile, AlignedSegment
+        from pytadbit.parsers.hic_bam_parser import _map2sam_short
+        from pytadbit.parsers.hic_bam_parser import _map2sam_mid, _map2sam_long
+        generate_test_bam()
+        for frmt, map2sam in [("short", _map2sam_short), ("mid", _map2sam_mid),
+                              ("long", _map2sam_long)]:
+            bed2D_to_BAMhic("lala-hic~", True, 2, "lala-bam1", frmt)
+            # sorted by chunks of records merged at the end
+            bed2D_to_BAMhic("lala-hic~", True, 2, "lala-bam2", frmt,
+                            max_records=1000)
+            bamfile = AlignmentFile("lala-bam1.bam")
+            reads = [r.to_string() for r in bamfile.fetch()]
+            self.assertTrue(reads == [r.to_string() for r in
+                                      AlignmentFile("lala-bam2.bam").fetch()])
+            sam_lines = []
+            for line in open("lala-hic~"):
+                if line.startswith("#"):
+                    continue
+                # short SAM lines have no template length (read as 0)
+                sam_lines.extend(
+                    AlignedSegment.fromstring(sam.replace("\t*\t*\t*\t",
+                                                          "\t0\t*\t*\t"),
+                                              bamfile.header).to_string()
+                    for sam in map2sam(line, 0).splitlines())
+            self.assertEqual(len(reads), 12000)
+            self.assertTrue(sorted(reads) == sorted(sam_lines))
+        system("rm -rf lala*")
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print "34", time() - t0
+
+    def test_35_downsample(self):
+        """
+        Same sample of reads with the same seed, whatever the resolution,
+        region or number of chunks
+        """
+        if ONLY and not "35" in ONLY:
+            return
+        if CHKTIME:
+            t0 = time()
+        from pytadbit.parsers.hic_parser import load_hic_data_from_bam
+        inbam = generate_test_bam()
+        kwargs = dict(filter_exclude=0, ncpus=2, clean=True)
+        full = get_matrix(inbam, 10000, nchunks=10, **kwargs)
+        half = get_matrix(inbam, 10000, nchunks=10, fraction=0.5, **kwargs)
+        self.assertEqual(half, get_matrix(inbam, 10000, nchunks=3,
+                                          fraction=0.5, **kwargs))
+        self.assertNotEqual(half, get_matrix(inbam, 10000, nchunks=10,
+                                             fraction=0.5, seed=1, **kwargs))
+        self.assertTrue(all(half[k] <= full[k] for k in half))
+        total = sum(full.values())
+        self.assertTrue(0.4 * total < sum(half.values()) < 0.6 * total)
+        # same reads at other resolutions or in a region
+        self.assertEqual(sum(half.values()),
+                         sum(get_matrix(inbam, 50000, nchunks=10,
+                                        fraction=0.5, **kwargs).values()))
+        # chr3 from bin 22 to 64
+        region = get_matrix(inbam, 10000, region1="chr3", fraction=0.5,
+                            **kwargs)
+        self.assertEqual(sum(region.values()),
+                         sum(half[k] for k in half if 22 <= k[0] < 65 and
+                             22 <= k[1] < 65))
+        # number of contacts wanted
+        hic_data = load_hic_data_from_bam(inbam, 10000, ncpus=2,
+                                          filter_exclude=0,
+                                          downsample_to=1000)
+        self.assertTrue(1800 < hic_data.sum() < 2200)
+        system("rm -rf lala*")
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print "35", time() - t0
+
+    def test_36_iter_contacts(self):
+        """
+        Contacts iterated by batches, as read one by one from the BAM file
+        """
+        if ONLY and not "36" in ONLY:
+            return
+        if CHKTIME:
+            t0 = time()
+        from numpy import concatenate
+        from pysam import AlignmentFile
+        from pytadbit.parsers.hic_bam_parser import iter_contacts, filters_to_bin
+        inbam = generate_test_bam()
+        reads = [(r.reference_id, r.reference_start + 1, r.mrnm, r.mpos + 1,
+                  r.flag) for r in AlignmentFile(inbam).fetch()]
+        batches = list(iter_contacts(inbam, filter_exclude=0, batch_size=1000,
+                                     nchunks=10))
+        self.assertTrue(all(len(batch) <= 1000 for batch in batches))
+        contacts = concatenate(batches)
+        self.assertEqual(len(contacts), 12000)
+        self.assertEqual(zip(contacts['crm1'].tolist(), contacts['pos1'].tolist(),
+                             contacts['crm2'].tolist(), contacts['pos2'].tolist(),
+                             contacts['flag'].tolist()), reads)
+        self.assertTrue((contacts['tc'] >= 1).all())
+        self.assertTrue(set(contacts['strand1'].tolist()) <= set([0, 1]))
+        # in parallel, with filters
+        filtered = concatenate(list(iter_contacts(inbam, ncpus=2,
+                                                  nchunks=10)))
+        self.assertEqual(len(filtered),
+                         sum(1 for r in reads if not r[4] & filters_to_bin(
+                             (1, 2, 3, 4, 6, 7, 8, 9, 10))))
+        # a region
+        region = concatenate(list(iter_contacts(inbam, filter_exclude=0,
+                                                region="chr3", start=20001,
+                                                end=250000)))
+        self.assertEqual(len(region),
+                         sum(1 for r in reads if r[0] == 2 and
+                             20001 <= r[1] < 250000))
+        system("rm -rf lala*")
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print "36", time() - t0
+
+    def test_37_parse_max_memory(self):
+        """
+        Reads sorted through temporary files, as sorted in memory
+        """
+        if ONLY and not "37" in ONLY:
+            return
+        if CHKTIME:
+            t0 = time()
+        for ali in ["map", "sam"]:
+            if ali == "map":
+                from pytadbit.parsers.map_parser import parse_map as parser
+            else:
+                try:
+                    from pytadbit.parsers.sam_parser import parse_sam as parser
+                except ImportError:
+                    print "ERROR: PYSAM not found, skipping test\n"
+                    continue
+            # each file is sorted in a different temporary file
+            fnames1, fnames2 = split_test_ali(ali, 3)
+            genome = parse_fasta("test.fa~", save_cache=False, verbose=False)
+            outputs = []
+            for max_memory in [250, 0.01]:
+                counts = parser(fnames1, fnames2,
+                                "lala1-%s~" % (ali), "lala2-%s~" % (ali),
+                                genome, re_name="DPNII", mapper="GEM",
+                                max_memory=max_memory)
+                outputs.append((counts, open("lala1-%s~" % (ali)).read(),
+                                open("lala2-%s~" % (ali)).read()))
+            self.assertEqual(outputs[0][0], outputs[1][0])
+            self.assertTrue(outputs[0] == outputs[1])
+            # temporary files removed
+            self.assertEqual([f for f in listdir(".") if f.startswith("tmp_")],
+                             [])
+        system("rm -rf lala*")
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print "37", time() - t0
+
+    def test_38_parse_parallel(self):
+        """
+        Input files parsed in parallel, as parsed one after the other
+        """
+        if ONLY and not "38" in ONLY:
+            return
+        if CHKTIME:
+            t0 = time()
+        for ali in ["map", "sam"]:
+            if ali == "map":
+                from pytadbit.parsers.map_parser import parse_map as parser
+            else:
+                try:
+                    from pytadbit.parsers.sam_parser import parse_sam as parser
+                except ImportError:
+                    print "ERROR: PYSAM not found, skipping test\n"
+                    continue
+            fnames1, fnames2 = split_test_ali(ali, 3)
+            genome = parse_fasta("test.fa~", save_cache=False, verbose=False)
+            outputs = []
+            for ncpus, max_memory in [(1, 250), (2, 250), (2, 0.01)]:
+                counts = parser(fnames1, fnames2,
+                                "lala1-%s~" % (ali), "lala2-%s~" % (ali),
+                                genome, re_name="DPNII", mapper="GEM",
+                                ncpus=ncpus, max_memory=max_memory)
+                outputs.append((counts, open("lala1-%s~" % (ali)).read(),
+                                open("lala2-%s~" % (ali)).read()))
+            self.assertEqual(outputs[0][0][0], {0: {1: 2000, 2: 2000, 3: 2000},
+                                                1: {1: 2000, 2: 2000, 3: 2000}})
+            self.assertEqual(outputs[0][0], outputs[1][0])
+            self.assertTrue(outputs[0] == outputs[1])
+            self.assertTrue(outputs[0] == outputs[2])
+            self.assertEqual([f for f in listdir(".") if f.startswith("tmp_")],
+                             [])
+        system("rm -rf lala*")
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print "38", time() - t0
+
+    def test_39_re_sites(self):
+        """
+        RE sites searched in sorted arrays, as in chunks of the chromosomes
+        """
+        if ONLY and not "39" in ONLY:
+            return
+        if CHKTIME:
+            t0 = time()
+        from bisect import bisect_left, bisect_right
+        from pytadbit.mapping.restriction_enzymes import map_re_sites_nochunk
+        from pytadbit.mapping.restriction_enzymes import index_re_sites
+        from pytadbit.mapping.restriction_enzymes import find_reads_re_sites
+        if not path.exists("test.fa~"):
+            seed(1)
+            generate_random_ali("map")
+        genome = parse_fasta("test.fa~", save_cache=False, verbose=False)
+        for enzyme in ["DpnII", "HindIII", ["DpnII", "HinfI"]]:
+            sites = map_re_sites_nochunk(enzyme, genome)
+            index = index_re_sites(enzyme, genome)
+            self.assertEqual(index.keys(), genome.keys())
+            for crm in genome:
+                self.assertEqual(index[crm].tolist(), sites[crm])
+            # chunks of RE sites, with the last RE site of the previous chunks
+            # and the first RE site of the next chunks
+            for frag_chunk in [1000, 100000]:
+                frags = map_re_sites(enzyme, genome, frag_chunk=frag_chunk)
+                for crm in genome:
+                    expected = {}
+                    for i in xrange(len(genome[crm]) // frag_chunk + 1):
+                        beg = bisect_left(sites[crm], i * frag_chunk)
+                        end = bisect_left(sites[crm], (i + 1) * frag_chunk)
+                        expected[i] = sites[crm][max(beg - 1, 0):end + 1]
+                    self.assertTrue(frags[crm] == expected)
+            # RE sites around reads, reads overhanging the end of the
+            # chromosome are moved back inside it
+            crms, positions, exp_pos, exp_prev, exp_next = [], [], [], [], []
+            for crm in genome:
+                for pos in (sites[crm][::50] + [s - 1 for s in sites[crm][1::50]] +
+                            [int(random() * len(genome[crm])) + 1
+                             for _ in xrange(100)] + [sites[crm][-1] + 2]):
+                    crms.append(crm)
+                    positions.append(pos)
+                    pos = min(pos, sites[crm][-1] - 1)
+                    idx = bisect_right(sites[crm], pos)
+                    exp_pos.append(pos)
+                    exp_prev.append(sites[crm][idx - 1 if idx else 0])
+                    exp_next.append(sites[crm][idx])
+            new_pos, prev_re, next_re = find_reads_re_sites(
+                index, crms, positions, [5] * len(positions))
+            self.assertEqual(new_pos.tolist(), exp_pos)
+            self.assertEqual(prev_re.tolist(), exp_prev)
+            self.assertEqual(next_re.tolist(), exp_next)
+            self.assertRaises(Exception, find_reads_re_sites, index, ["chr1"],
+                              [len(genome["chr1"]) + 5], [5])
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print "39", time() - t0
+
+    def test_40_re_sites_cache(self):
+        """
+        RE sites loaded from their cache, as searched in the genome
+        """
+        if ONLY and not "40" in ONLY:
+            return
+        if CHKTIME:
+            t0 = time()
+        from glob import glob
+        from numpy import memmap
+        from pytadbit.mapping.restriction_enzymes import index_re_sites
+        from pytadbit.parsers.genome_parser import genome_checksum
+        from pytadbit.parsers.map_parser import parse_map
+        seed(1)
+        generate_random_ali("map")
+        system("rm -f test.fa~_re_sites_*")
+        genome = parse_fasta("test.fa~", save_cache=False, verbose=False)
+        sites = index_re_sites(["DpnII", "HindIII"], genome,
+                               cache_prefix="lala-")
+        self.assertTrue(path.exists("lala-re_sites_DpnII-HindIII_%s.npy" % (
+            genome_checksum(genome))))
+        # same cache whatever the order of the enzymes
+        cached = index_re_sites(["HindIII", "DpnII"], genome,
+                                cache_prefix="lala-")
+        self.assertEqual(cached.keys(), sites.keys())
+        for crm in sites:
+            self.assertTrue(isinstance(cached[crm], memmap))
+            self.assertEqual(cached[crm].tolist(), sites[crm].tolist())
+        # another genome gets another cache
+        genome.pop("chr9")
+        sub_sites = index_re_sites(["DpnII", "HindIII"], genome,
+                                   cache_prefix="lala-")
+        self.assertEqual(len(glob("lala-re_sites_*")), 2)
+        self.assertEqual(sub_sites.keys(), sites.keys()[:-1])
+        # reads parsed with the cached RE sites
+        genome = parse_fasta("test.fa~", save_cache=False, verbose=False)
+        outputs = []
+        for genome_path in [None, "test.fa~", "test.fa~"]:
+            parse_map(["test_read1.map~"], ["test_read2.map~"], "lala1-map~",
+                      "lala2-map~", genome, re_name="DPNII",
+                      genome_path=genome_path)
+            outputs.append((open("lala1-map~").read(),
+                            open("lala2-map~").read()))
+            if genome_path:
+                self.assertEqual(len(glob("test.fa~_re_sites_DPNII_*.npy")),
+                                 1)
+        self.assertTrue(outputs[0] == outputs[1])
+        self.assertTrue(outputs[0] == outputs[2])
+        system("rm -rf lala* test.fa~_re_sites_*")
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print "40", time() - t0
+
+    def test_41_genome_cache(self):
+        """
+        Genome memory-mapped from its cache, as parsed from the FASTA file
+        """
+        if ONLY and not "41" in ONLY:
+            return
+        if CHKTIME:
+            t0 = time()
+        from cPickle import dumps, loads
+        from pytadbit.parsers.genome_parser import CachedGenome, get_gc_content
+        from pytadbit.parsers.genome_parser import genome_checksum
+        if not path.exists("test.fa~"):
+            seed(1)
+            generate_random_ali("map")
+        system("rm -f test.fa~_genome*.TADbit")
+        genome = parse_fasta("test.fa~", verbose=False)
+        self.assertTrue(path.exists("test.fa~_genome_bin.TADbit"))
+        cached = parse_fasta("test.fa~", verbose=False)
+        self.assertTrue(isinstance(cached, CachedGenome))
+        self.assertEqual(cached.keys(), genome.keys())
+        self.assertEqual(len(cached), len(genome))
+        self.assertTrue("chr3" in cached)
+        self.assertFalse("chr10" in cached)
+        for crm in genome:
+            self.assertTrue(cached[crm] == genome[crm])
+            self.assertEqual(cached.sequence_array(crm).tostring(), genome[crm])
+        self.assertEqual(cached.lengths().items(),
+                         [(crm, len(genome[crm])) for crm in genome])
+        self.assertEqual(parse_fasta("test.fa~", verbose=False,
+                                     only_length=True), cached.lengths())
+        self.assertEqual(genome_checksum(cached), genome_checksum(genome))
+        # sent to other processes
+        self.assertEqual(loads(dumps(cached)).keys(), genome.keys())
+        # GC content
+        for resolution in [7000, 100000]:
+            expected = {}
+            for crm in genome:
+                seq = genome[crm]
+                expected[crm] = {}
+                for i, beg in enumerate(xrange(0, len(seq), resolution)):
+                    sub = seq[beg:beg + resolution]
+                    expected[crm][i] = (float(sub.count("G") + sub.count("C")) /
+                                        (len(sub) - sub.count("N")))
+            for gnm in [genome, cached]:
+                self.assertEqual(get_gc_content(gnm, resolution, by_chrom=True),
+                                 expected)
+                self.assertEqual(get_gc_content(gnm, resolution),
+                                 [expected[crm][i] for crm in genome
+                                  for i in sorted(expected[crm])])
+                self.assertEqual(get_gc_content(gnm, resolution,
+                                                chromosomes=["chr2", "chr1"]),
+                                 [expected[crm][i] for crm in ["chr2", "chr1"]
+                                  for i in sorted(expected[crm])])
+        # genome cached by former versions of TADbit, in FASTA format
+        system("rm -f test.fa~_genome*.TADbit")
+        out = open("test.fa~_genome.TADbit", "w")
+        for crm in genome:
+            out.write(">%s\n%s\n" % (crm, genome[crm]))
+        out.close()
+        self.assertEqual(parse_fasta("test.fa~", verbose=False), genome)
+        self.assertTrue(isinstance(parse_fasta("test.fa~", verbose=False),
+                                   CachedGenome))
+        system("rm -f test.fa~_genome*.TADbit")
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print "41", time() - t0
+
+    def test_42_normalize_bam(self):
+        """
+        Bad columns, cis percentage and decay of a normalization, as counted
+        from the reads of the BAM file
+        """
+        if ONLY and not "42" in ONLY:
+            return
+        if CHKTIME:
+            t0 = time()
+        from pysam import AlignmentFile
+        from pytadbit.tools.tadbit_normalize import read_bam
+        inbam = generate_test_bam()
+        reso = 10000
+        bamfile = AlignmentFile(inbam)
+        first_bin = {}
+        crm_of = []
+        for crm, length in zip(bamfile.references, bamfile.lengths):
+            first_bin[crm] = len(crm_of)
+            crm_of.extend([crm] * (length / reso + 1))
+        size = len(crm_of)
+        # interactions counted read by read
+        inter = {}
+        for r in bamfile.fetch():
+            crm1, crm2 = r.reference_name, r.next_reference_name
+            i = first_bin[crm1] + (r.reference_start + 1) / reso
+            j = first_bin[crm2] + (r.next_reference_start + 1) / reso
+            inter[i, j] = inter.get((i, j), 0) + 1
+        bamfile.close()
+        sumcol = {}
+        sumcis = {}
+        for (i, j), v in inter.iteritems():
+            sumcol[i] = sumcol.get(i, 0) + v
+            if crm_of[i] == crm_of[j]:
+                sumcis[i] = sumcis.get(i, 0) + v
+        biases, decay, badcol, raw_cisprc, norm_cisprc = read_bam(
+            inbam, 0, reso, min_count=10, ncpus=2, outdir=".", max_njobs=7)
+        system("rm -rf _tmp_*")
+        bads = set(i for i in xrange(size) if sumcol.get(i, 0) < 10)
+        self.assertTrue(len(bads) > 0)
+        self.assertEqual(sorted(badcol), sorted(bads))
+        # raw cis percentage, averaged over columns
+        goods = [i for i in sumcol if not i in bads]
+        self.assertAlmostEqual(raw_cisprc,
+                               sum(float(sumcis.get(i, 0)) / sumcol[i]
+                                   for i in goods) /
+                               (len(sumcol) - len(bads)))
+        # Vanilla biases proportional to the sum of interactions
+        for i in goods:
+            self.assertAlmostEqual(biases[i] / biases[goods[0]],
+                                   float(sumcol[i]) / sumcol[goods[0]])
+        # normalized cis percentage, in the lower half of the matrix
+        cis = tot = 0.
+        for (i, j), v in inter.iteritems():
+            if i <= j or i in bads or j in bads:
+                continue
+            tot += v / biases[i] / biases[j]
+            if crm_of[i] == crm_of[j]:
+                cis += v / biases[i] / biases[j]
+        self.assertAlmostEqual(norm_cisprc, cis / tot)
+        # first diagonal of the decay of chr3 (enough interactions not to be
+        # merged with the next diagonals)
+        beg = first_bin["chr3"]
+        valid = [i for i in xrange(beg, size)
+                 if crm_of[i] == "chr3" and not i in bads]
+        self.assertTrue(sum(inter.get((i, i), 0) for i in valid) > 400)
+        self.assertAlmostEqual(decay["chr3"][0],
+                               sum(inter.get((i, i), 0) / biases[i]**2
+                                   for i in valid) / len(valid))
+        system("rm -rf lala*")
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print "42", time() - t0
+
+    def test_43_write_bam_matrix(self):
+        """
+        Raw, normalized and decay matrices written from a BAM file, as computed
+        from the interactions and the biases
+        """
+        if ONLY and not "43" in ONLY:
+            return
+        if CHKTIME:
+            t0 = time()
+        from pysam import AlignmentFile
+        from pytadbit.parsers.hic_bam_parser import write_matrix
+        inbam = generate_test_bam()
+        reso = 10000
+        bamfile = AlignmentFile(inbam)
+        crm_of = []
+        for crm, length in zip(bamfile.references, bamfile.lengths):
+            crm_of.extend([crm] * (length / reso + 1))
+        bamfile.close()
+        biases = {"resolution": reso,
+                  "biases": dict((k, 0.5 + random())
+                                 for k in xrange(len(crm_of))),
+                  "badcol": dict((k, 0) for k in xrange(3, len(crm_of), 7)),
+                  "decay": dict((crm, dict((d, 1. + d) for d in xrange(20)))
+                                for crm in set(crm_of))}
+        matrix = get_matrix(inbam, reso, filter_exclude=0, ncpus=2,
+                            clean=True)
+        system("mkdir -p lala-mat~")
+        fnames = write_matrix(inbam, reso, biases, "lala-mat~",
+                              filter_exclude=0, ncpus=2, nchunks=7,
+                              normalizations=("raw", "norm", "decay"),
+                              tmpdir="lala-mat~", verbose=False)
+        values = {}
+        for norm in ["RAW", "NRM", "DEC"]:
+            values[norm] = {}
+            for line in open(fnames[norm]):
+                if line.startswith("#"):
+                    continue
+                i, j, v = line.split()
+                values[norm][int(i), int(j)] = float(v)
+        # half matrix, without bad columns
+        bads = biases["badcol"]
+        self.assertTrue(values["RAW"] ==
+                        dict(((i, j), v) for (i, j), v in matrix.iteritems()
+                             if i >= j and not i in bads and not j in bads))
+        self.assertEqual(sorted(values["NRM"]), sorted(values["RAW"]))
+        self.assertEqual(sorted(values["DEC"]), sorted(values["RAW"]))
+        bias = biases["biases"]
+        for (i, j), v in values["RAW"].iteritems():
+            nrm = v / bias[i] / bias[j]
+            self.assertAlmostEqual(values["NRM"][i, j], nrm)
+            if crm_of[i] == crm_of[j] and i - j < 20:
+                self.assertAlmostEqual(values["DEC"][i, j], nrm / (1. + i - j))
+            else:  # no expected value
+                self.assertTrue(values["DEC"][i, j] != values["DEC"][i, j])
+        system("rm -rf lala*")
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print "43", time() - t0
+
+    def test_44_bam_chunk_arrays(self):
+        """
+        Interactions saved by the workers reading chunks of a BAM file
+        """
+        if ONLY and not "44" in ONLY:
+            return
+        if CHKTIME:
+            t0 = time()
+        from numpy import load
+        from pysam import AlignmentFile
+        from pytadbit.parsers.hic_bam_parser import _bam_bins, _read_bam_frag
+        from pytadbit.parsers.hic_bam_parser import _chunk_fname
+        inbam = generate_test_bam()
+        reso = 10000
+        bamfile = AlignmentFile(inbam)
+        sections, offsets, bin_coords = _bam_bins(bamfile, reso)
+        system("mkdir -p lala-chunks~/_tmp_lala")
+        # chunks not aligned on bins, and at the start/end of chromosomes
+        for region, start, end in [("chr3", 15000, 132000),
+                                   ("chr3", 0, 10000),
+                                   ("chr1", 130000, 140000),
+                                   ("chr2", 0, 80000)]:
+            rows, tot, cis = _read_bam_frag(inbam, 0, offsets, bin_coords,
+                                            "lala", reso, "lala-chunks~",
+                                            region, start, end, False, True)
+            dico = load(_chunk_fname("lala-chunks~", "lala", region, start,
+                                     end, reso))
+            # reads starting in the bins of the chunk
+            first_pos = start / reso * reso
+            last_pos  = ((end - 1) / reso + 1) * reso
+            counts = {}
+            for r in bamfile.fetch(region):
+                if not first_pos <= r.reference_start + 1 < last_pos:
+                    continue
+                crm = r.reference_id
+                key = (crm if crm == r.next_reference_id else -1,
+                       offsets[crm] + (r.reference_start + 1) / reso,
+                       offsets[r.next_reference_id] +
+                       (r.next_reference_start + 1) / reso)
+                counts[key] = counts.get(key, 0) + 1
+            self.assertTrue(len(counts) > 0)
+            self.assertEqual(sorted(zip(dico['crm'].tolist(),
+                                        dico['row'].tolist(),
+                                        dico['col'].tolist(),
+                                        dico['count'].tolist())),
+                             sorted(k + (v, ) for k, v in counts.iteritems()))
+            # marginals of the chunk
+            sums = {}
+            for (crm, i, _), v in counts.iteritems():
+                sums.setdefault(i, [0, 0])
+                sums[i][0] += v
+                sums[i][1] += v if crm >= 0 else 0
+            self.assertEqual(zip(rows.tolist(), tot.tolist(), cis.tolist()),
+                             [(i, t, c) for i, (t, c) in sorted(sums.items())])
+        bamfile.close()
+        system("rm -rf lala*")
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print "44", time() - t0
+
+    def test_45_plan_chunks(self):
+        """
+        Chunks of a BAM file with similar number of reads, covering all bins
+        """
+        if ONLY and not "45" in ONLY:
+            return
+        if CHKTIME:
+            t0 = time()
+        from pysam import AlignmentFile, AlignedSegment, index
+        from pytadbit.parsers.hic_bam_parser import _bam_bins, plan_chunks
+        from pytadbit.parsers.hic_bam_parser import largest_first
+        self.assertEqual(largest_first([3, 10, 1, 7, 10]), [1, 4, 3, 0, 2])
+        self.assertEqual(largest_first([]), [])
+        # reads 10 times denser in the first 200 kb of chrA
+        seed(1)
+        positions = [sorted(int(random() * 200000) for _ in xrange(50000)) +
+                     sorted(200000 + int(random() * 1800000)
+                            for _ in xrange(50000)),
+                     sorted(int(random() * 500000) for _ in xrange(20000))]
+        header = {"HD": {"VN": "1.0", "SO": "coordinate"},
+                  "SQ": [{"SN": "chrA", "LN": 2000000},
+                         {"SN": "chrB", "LN": 500000}]}
+        out = AlignmentFile("lala-dense.bam", "wb", header=header)
+        for crm, poss in enumerate(positions):
+            for num, pos in enumerate(poss):
+                r = AlignedSegment()
+                r.query_name = "read%d_%d" % (crm, num)
+                r.reference_id = crm
+                r.reference_start = pos
+                r.query_sequence = "A" * 50
+                r.cigartuples = [(0, 50)]
+                r.mapping_quality = 30
+                out.write(r)
+        out.close()
+        index("lala-dense.bam")
+        reso = 10000
+        for inbam, nchunks in [(generate_test_bam(), 7),
+                               ("lala-dense.bam", 10)]:
+            bamfile = AlignmentFile(inbam)
+            sections, offsets, bin_coords = _bam_bins(bamfile, reso)
+            total = bin_coords[1]
+            for start_bin, end_bin in [(3, total - 5), (0, total)]:
+                regs, begs, ends, nreads = plan_chunks(inbam, sections,
+                                                       start_bin, end_bin,
+                                                       reso, nchunks)
+                # each bin of the region in one chunk
+                bins = []
+                for reg, beg, end in zip(regs, begs, ends):
+                    self.assertEqual(beg % reso, 0)
+                    self.assertEqual(end % reso, 0)
+                    self.assertTrue(end <= sections[reg] * reso)
+                    ibeg = offsets[bamfile.references.index(reg)] + beg / reso
+                    bins.extend(range(ibeg, ibeg + (end - beg) / reso))
+                self.assertEqual(bins, range(start_bin, end_bin))
+                self.assertEqual(largest_first(nreads),
+                                 sorted(range(len(nreads)),
+                                        key=lambda i: nreads[i],
+                                        reverse=True))
+            # number of reads starting in each chunk of the genome
+            counts = [sum(1 for r in bamfile.fetch(reg, beg, end)
+                          if beg <= r.reference_start < end)
+                      for reg, beg, end in zip(regs, begs, ends)]
+            self.assertEqual(sum(counts), sum(1 for _ in bamfile.fetch()))
+            # estimated from the reads mapped on each chromosome
+            self.assertTrue(abs(sum(nreads) - bamfile.mapped) <
+                            0.01 * bamfile.mapped)
+            bamfile.close()
+        # chromosome boundaries add chunks, none should be much larger
+        self.assertTrue(max(counts) < 1.5 * sum(counts) / nchunks)
+        system("rm -rf lala*")
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print "45", time() - t0
+
+    def test_46_bam_bins(self):
+        """
+        Reads mapped to bins with the offsets of the chromosomes, as with a
+        dictionary of bins
+        """
+        if ONLY and not "46" in ONLY:
+            return
+        if CHKTIME:
+            t0 = time()
+        from numpy import array
+        from pysam import AlignmentFile
+        from pytadbit.parsers.hic_bam_parser import _bam_bins
+        inbam = generate_test_bam()
+        bamfile = AlignmentFile(inbam)
+        refs = bamfile.references
+        reads = [(r.reference_id, r.reference_start + 1,
+                  r.next_reference_id, r.next_reference_start + 1)
+                 for r in bamfile.fetch()]
+        crms1, poss1, crms2, poss2 = [array(v) for v in zip(*reads)]
+        for reso in [1000, 10000, 100000]:
+            nbins = [l / reso + 1 for l in bamfile.lengths]
+            for region1, region2 in [(None, None),
+                                     (("chr3", None, None), None),
+                                     (("chr3", 15000, 320000), None),
+                                     (("chr2", None, None),
+                                      ("chr3", 100000, 426203))]:
+                kwargs = {}
+                for num, region in [("1", region1), ("2", region2)]:
+                    if region:
+                        kwargs.update(zip(["region" + num, "start" + num,
+                                           "end" + num], region))
+                sections, offsets, bin_coords = _bam_bins(bamfile, reso,
+                                                          **kwargs)
+                self.assertEqual(sections.items(), zip(refs, nbins))
+                start_bin1, end_bin1, start_bin2, end_bin2 = bin_coords
+                # one (chromosome, bin) tuple per bin of each region
+                dicts = []
+                for region in [region1, region2 or region1]:
+                    if region:
+                        crm, beg, end = region
+                        bins = [(crm, i) for i in xrange(
+                            (beg or 0) / reso,
+                            end / reso if end else nbins[refs.index(crm)])]
+                    else:
+                        bins = [(crm, i) for crm, n in zip(refs, nbins)
+                                for i in xrange(n)]
+                    dicts.append(dict((b, i) for i, b in enumerate(bins)))
+                self.assertEqual(end_bin1 - start_bin1, len(dicts[0]))
+                self.assertEqual(end_bin2 - start_bin2, len(dicts[1]))
+                rows = offsets[crms1] + poss1 / reso - start_bin1
+                cols = offsets[crms2] + poss2 / reso - start_bin2
+                rows[(rows < 0) | (rows >= end_bin1 - start_bin1)] = -1
+                cols[(cols < 0) | (cols >= end_bin2 - start_bin2)] = -1
+                self.assertTrue(rows.tolist() ==
+                                [dicts[0].get((refs[c], p / reso), -1)
+                                 for c, p in zip(crms1, poss1)])
+                self.assertTrue(cols.tolist() ==
+                                [dicts[1].get((refs[c], p / reso), -1)
+                                 for c, p in zip(crms2, poss2)])
+        bamfile.close()
+        system("rm -rf lala*")
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print "46", time() - t0
+
+    def test_47_count_re_sites(self):
+        """
+        RE sites counted per bin from the index of RE sites, as counted in the
+        sequence of each bin
+        """
+        if ONLY and not "47" in ONLY:
+            return
+        if CHKTIME:
+            t0 = time()
+        from re import findall
+        from pytadbit.mapping.restriction_enzymes import index_re_sites
+        from pytadbit.mapping.restriction_enzymes import iupac2regex
+        from pytadbit.tools.tadbit_normalize import _count_re_sites
+        seed(1)
+        generate_random_ali("map")
+        genome = parse_fasta("test.fa~", save_cache=False, verbose=False)
+        for enzyme in ["DpnII", "HindIII", "HinfI"]:
+            re_site = RESTRICTION_ENZYMES[enzyme].replace("|", "")
+            sites = index_re_sites(enzyme, genome)
+            for reso in [1000, 7000]:
+                for crm in genome:
+                    seq = genome[crm]
+                    windows = [seq[pos - 200:pos + reso + 200]
+                               for pos in xrange(200, len(seq) + 200, reso)]
+                    if enzyme == "HinfI":  # IUPAC nomenclature (GANTC)
+                        pattern = "(?=%s)" % iupac2regex(re_site)
+                        expected = [len(findall(pattern, win))
+                                    for win in windows]
+                    else:
+                        expected = [win.count(re_site) for win in windows]
+                    self.assertTrue(sum(expected) > 0)
+                    self.assertEqual(_count_re_sites(sites[crm], len(seq),
+                                                     enzyme, reso), expected)
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print "47", time() - t0
+
 
 def generate_random_ali(ali="map"):
     # VARIABLES
@@ -1061,6 +2165,52 @@ def generate_random_ali(ali="map"):
     return genome
 
 
+def generate_test_bam():
+    """
+    TADbit BAM file built from random reads (generated again, with their
+    genome, so that it does not depend on the tests run before)
+
+    :returns: path to the BAM file
+    """
+    if path.exists("lala-hic.bam"):
+        return "lala-hic.bam"
+    seed(1)
+    generate_random_ali("map")
+    from pytadbit.parsers.map_parser import parse_map
+    genome = parse_fasta("test.fa~", save_cache=False, verbose=False)
+    parse_map(["test_read1.map~"], ["test_read2.map~"], "lala-hic1~",
+              "lala-hic2~", genome, re_name="DPNII", mapper="GEM")
+    get_intersection("lala-hic1~", "lala-hic2~", "lala-hic~")
+    masked = filter_reads("lala-hic~", verbose=False, fast=True)
+    bed2D_to_BAMhic("lala-hic~", False, 2, "lala-hic", "mid", masked)
+    return "lala-hic.bam"
+
+def split_test_ali(ali, nfiles):
+    """
+    Splits random reads (generated again, with their genome) in several
+    files per read-end, as from an iterative mapping
+
+    :param ali: format of the reads ('map' or 'sam')
+    :param nfiles: number of files per read-end
+
+    :returns: the lists of paths to the files of read1 and of read2
+    """
+    seed(1)
+    generate_random_ali(ali)
+    fnames = []
+    for read in [1, 2]:
+        lines = open("test_read%d.%s~" % (read, ali)).readlines()
+        header = [l for l in lines if l.startswith("@")]
+        lines = lines[len(header):]
+        fnames.append([])
+        for num in range(nfiles):
+            fnam = "lala-read%d-%d.%s~" % (read, num, ali)
+            out = open(fnam, "w")
+            out.write("".join(header + lines[num::nfiles]))
+            out.close()
+            fnames[-1].append(fnam)
+    return fnames
+
 if __name__ == "__main__":
     if len(sys.argv) > 1:
         CHKTIME = bool(int(sys.argv.pop()))